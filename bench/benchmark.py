@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""Copyright (C) 2019  Andres Barreto and Rich Murphey
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+An end-to-end benchmark of kumodd against a synthetic drive.
+
+A fake Drive server (fakedrive.py) is started on a local port, and kumodd is
+run against it, using -api_url, once for each scenario: list, download,
+usecsv and verify.  For each run, it reports the files and megabytes per
+second, the API calls by method and status, and the peak resident memory of
+the kumodd process.
+
+    python3 bench/benchmark.py -files 100 -depth 2 -size 100000 -jobs 4
+"""
+
+from absl import app, flags
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fakedrive
+
+FLAGS = flags.FLAGS
+
+fakedrive.define_drive_flags()
+flags.DEFINE_list('scenarios', ['list', 'download', 'usecsv', 'verify'], 'Scenarios to run, in order.  usecsv uses the CSV written by list, and verify the files written by download.')
+flags.DEFINE_integer('jobs', 1, 'kumodd -jobs, for download, usecsv and verify.', lower_bound=1)
+flags.DEFINE_integer('accounts', 1, 'Number of accounts that list and download collect at once, with kumodd -accounts.  Each account sees the same drive.', lower_bound=1)
+flags.DEFINE_list('kumodd_args', [], 'Additional kumodd arguments, for every scenario, eg. -kumodd_args=-walk,flat')
+flags.DEFINE_string('kumodd', os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ))), 'kumodd' ), 'kumodd script to benchmark.')
+flags.DEFINE_string('workdir', None, 'Folder in which kumodd runs.  By default, a temporary folder that is removed afterwards.')
+flags.DEFINE_string('json', None, 'Write the results to this JSON file.')
+
+# kumodd arguments of each scenario
+scenario_args = {
+    'list':     [ '-l', 'all', '-col', 'normal', '-p', 'download', '-m', 'download/metadata' ],
+    'download': [ '-d', 'all', '-p', 'download', '-m', 'download/metadata' ],
+    'usecsv':   [ '-p', 'usecsv', '-m', 'usecsv/metadata' ],
+    'verify':   [ '-V', '-p', 'download', '-m', 'download/metadata' ],
+}
+
+def write_credentials( workdir, url ):
+    """Write OAuth client and user credentials that kumodd accepts without a browser.
+
+    Returns:
+      the user credential files of -accounts accounts.  The first is that of the drive's user.
+    """
+    with open( os.path.join( workdir, 'google_api_credentials.json' ), 'w' ) as handle:
+        json.dump({ 'installed': { 'client_id': 'bench', 'client_secret': 'bench',
+                                   'auth_uri': url + 'auth', 'token_uri': url + 'token',
+                                   'redirect_uris': [ 'urn:ietf:wg:oauth:2.0:oob' ]}}, handle )
+    user_creds = [ 'google_drive_user_credentials.json' ]
+    write_user_credentials( os.path.join( workdir, user_creds[0] ), url, 'bench' )
+    for i in range( 2, FLAGS.accounts + 1 ):
+        user_creds.append( f'config/bench{i}.json' )
+        write_user_credentials( os.path.join( workdir, user_creds[-1] ), url, f'user:bench{i}@example.com' )
+    return user_creds
+
+# the fake drive reports the account of an access token 'user:<email>' as <email>.
+def write_user_credentials( path, url, access_token ):
+    with open( path, 'w' ) as handle:
+        json.dump({ '_module': 'oauth2client.client', '_class': 'OAuth2Credentials',
+                    'access_token': access_token, 'client_id': 'bench', 'client_secret': 'bench',
+                    'refresh_token': 'bench', 'token_expiry': '2999-01-01T00:00:00Z',
+                    'token_uri': url + 'token', 'user_agent': None, 'revoke_uri': None,
+                    'id_token': None, 'id_token_jwt': None, 'token_response': None,
+                    'scopes': [], 'token_info_uri': None, 'invalid': False }, handle )
+
+def bytes_on_disk( folder ):
+    total = 0
+    for root, dirs, files in os.walk( folder ):
+        if 'metadata' in dirs:
+            dirs.remove( 'metadata' )
+        total += sum( os.path.getsize( os.path.join( root, name )) for name in files )
+    return total
+
+# run a command, and return its exit status and peak resident set size in bytes, or
+# None where the platform does not report it.
+def run( command, cwd, log ):
+    with open( log, 'w' ) as handle:
+        process = subprocess.Popen( command, cwd=cwd, stdout=handle, stderr=subprocess.STDOUT )
+        if hasattr( os, 'wait4' ):
+            pid, status, usage = os.wait4( process.pid, 0 )
+            process.returncode = os.waitstatus_to_exitcode( status )
+            # ru_maxrss is in kilobytes on Linux, and bytes on macOS.
+            rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+        else:
+            process.wait()
+            rss = None
+    return process.returncode, rss
+
+def run_scenario( scenario, drive, server, workdir, user_creds ):
+    args = list( scenario_args[ scenario ])
+    files = drive.file_count
+    if scenario == 'usecsv':
+        args += [ '-csv', f'filelist-{drive.user}.csv' ]
+    if scenario != 'list':
+        args += [ '-jobs', str( FLAGS.jobs ) ]
+    if scenario in ( 'list', 'download' ) and len( user_creds ) > 1:
+        args += [ '-accounts', ','.join( user_creds ), '-account_jobs', str( len( user_creds )) ]
+        files *= len( user_creds )
+    elif scenario == 'verify':
+        files *= len( user_creds )
+    command = ( [ sys.executable, FLAGS.kumodd, '-c', 'config/config.yml', '-api_url', server.url, '-nobrowser' ]
+                + args + FLAGS.kumodd_args )
+    drive.reset_counters()
+    start = time.perf_counter()
+    status, rss = run( command, workdir, os.path.join( workdir, f'{scenario}.log' ))
+    seconds = time.perf_counter() - start
+    counters = drive.counters()
+    # verify reads the downloaded files rather than the network.
+    data_bytes = bytes_on_disk( os.path.join( workdir, 'download' )) if scenario == 'verify' else counters['bytes_sent']
+    return {
+        'scenario': scenario,
+        'exit_status': status,
+        'seconds': round( seconds, 3 ),
+        'files': files,
+        'files_per_second': round( files / seconds, 1 ),
+        'megabytes': round( data_bytes / 1e6, 3 ),
+        'megabytes_per_second': round( data_bytes / 1e6 / seconds, 2 ),
+        'api_calls': sum( counters['calls'].values() ),
+        'api_calls_by_method': counters['calls'],
+        'api_responses_by_status': counters['statuses'],
+        'peak_rss_megabytes': round( rss / 1e6, 1 ) if rss else None,
+        'command': command,
+    }
+
+def print_results( results ):
+    print( f"{'Scenario':10} {'Status':>6} {'Seconds':>8} {'Files/s':>8} {'MB':>9} {'MB/s':>8} {'API calls':>9} {'Peak RSS MB':>11}" )
+    for r in results:
+        print( f"{r['scenario']:10} {r['exit_status']:>6} {r['seconds']:>8.2f} {r['files_per_second']:>8.1f} "
+               f"{r['megabytes']:>9.2f} {r['megabytes_per_second']:>8.2f} {r['api_calls']:>9} "
+               f"{r['peak_rss_megabytes'] if r['peak_rss_megabytes'] is not None else 'n/a':>11}" )
+    for r in results:
+        calls = ', '.join( f'{method} {count}' for method, count in sorted( r['api_calls_by_method'].items() ))
+        statuses = ', '.join( f'{status}: {count}' for status, count in sorted( r['api_responses_by_status'].items() ))
+        print( f"{r['scenario']:10} calls: {calls or 'none'}; responses: {statuses or 'none'}" )
+
+def main( argv ):
+    for scenario in FLAGS.scenarios:
+        if scenario not in scenario_args:
+            print( f'Error: unknown scenario {scenario}.  Choose from: {", ".join( scenario_args )}' )
+            return 1
+    drive = fakedrive.drive_from_flags()
+    server = fakedrive.FakeDriveServer( drive ).start()
+    workdir = FLAGS.workdir or tempfile.mkdtemp( prefix='kumodd-bench-' )
+    os.makedirs( os.path.join( workdir, 'config' ), exist_ok=True )
+    user_creds = write_credentials( workdir, server.url )
+    print( f'Drive: {drive.file_count} files, {drive.total_size / 1e6:.1f} MB, served at {server.url}' )
+    print( f'Work folder: {workdir}' )
+    results = []
+    try:
+        for scenario in FLAGS.scenarios:
+            results.append( run_scenario( scenario, drive, server, workdir, user_creds ))
+    finally:
+        server.stop()
+        if not FLAGS.workdir:
+            shutil.rmtree( workdir, ignore_errors=True )
+    print_results( results )
+    if FLAGS.json:
+        with open( FLAGS.json, 'w' ) as handle:
+            json.dump({ 'drive': { 'files': drive.file_count, 'bytes': drive.total_size,
+                                   'folders': FLAGS.folders, 'files_per_folder': FLAGS.files, 'depth': FLAGS.depth,
+                                   'revisions': FLAGS.revisions, 'size': FLAGS.size, 'native': FLAGS.native,
+                                   'error_rate': FLAGS.error_rate, 'seed': FLAGS.seed },
+                        'jobs': FLAGS.jobs, 'accounts': FLAGS.accounts, 'kumodd_args': FLAGS.kumodd_args,
+                        'results': results }, handle, indent=2 )
+    return 0 if all( r['exit_status'] == 0 for r in results ) else 1
+
+if __name__ == '__main__':
+    app.run( main )
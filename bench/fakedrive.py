@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+"""Copyright (C) 2019  Andres Barreto and Rich Murphey
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+A local stand-in for Google Drive, serving a synthetic drive over HTTP.
+
+It implements the subset of the Drive v3 API that kumodd uses: about,
+files.list with paging, files.get, get_media with Range requests,
+export_media, revisions.list, revision export links, the changes feed and
+batch requests.  Requests are not authorized, and queries are limited to
+"'<folder id>' in parents", optionally with "name='<name>'".  Errors can be
+injected at random, to exercise retries and rate limiting.
+
+All accounts see the same drive.  An access token of the form 'user:<email>'
+selects the email address that about reports, so that several accounts can be
+collected at once.
+
+To serve a drive for kumodd -api_url:
+
+    python3 bench/fakedrive.py -port 8080 -files 100 -depth 2
+"""
+
+from absl import app, flags
+from email import message_from_bytes, policy
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import collections
+import json
+import random
+import re
+import threading
+import urllib.parse
+
+FOLDER = 'application/vnd.google-apps.folder'
+DOCUMENT = 'application/vnd.google-apps.document'
+
+# injected errors, by name: ( HTTP status, reason )
+injected_errors = {
+    'rate_limit':   ( 403, 'userRateLimitExceeded' ),
+    'too_many':     ( 429, 'rateLimitExceeded' ),
+    'server_error': ( 503, 'backendError' ),
+}
+
+class FakeDrive( object ):
+    def __init__( self, folders=3, files=10, depth=2, revisions=2, size=65536, native=0.1,
+                  error_rate=0.0, errors=( 'rate_limit', 'too_many', 'server_error' ), seed=1,
+                  user='bench@example.com' ):
+        """Generate a synthetic drive.
+
+        Args:
+          folders: number of sub-folders in each folder above the deepest level.
+          files: number of files in each folder.
+          depth: number of levels of sub-folders below the root.
+          revisions: number of revisions of each file.
+          size: average size of a file in bytes.  Sizes vary from half to one and a half times this.
+          native: fraction of files that are native Google Docs, which are exported as PDF.
+          error_rate: fraction of requests that fail with one of the injected errors.
+          errors: names of the injected errors, from injected_errors.
+          seed: seed of the random number generator, so that a drive can be reproduced.
+          user: email address of the account.
+        """
+        self.user = user
+        self.error_rate = error_rate
+        self.errors = [ injected_errors[ name ] for name in errors ]
+        self.random = random.Random( seed )
+        self.block = bytes( self.random.getrandbits( 8 ) for _ in range( 65536 ))
+        self.items = {}
+        self.children = collections.defaultdict( list )
+        self.revisions = {}
+        self.sizes = {}
+        self.revision_count = revisions
+        self.lock = threading.Lock()
+        self.reset_counters()
+        self.root = { 'id': 'root', 'name': 'My Drive', 'mimeType': FOLDER, 'kind': 'drive#file' }
+        self.file_count = 0
+        self.total_size = 0
+        self.add_folder( 'root', folders, files, depth, revisions, size, native )
+
+    def reset_counters( self ):
+        with self.lock:
+            self.calls = collections.Counter()
+            self.statuses = collections.Counter()
+            self.bytes_sent = 0
+
+    def counters( self ):
+        with self.lock:
+            return { 'calls': dict( self.calls ), 'statuses': { str( k ): v for k, v in self.statuses.items() },
+                     'bytes_sent': self.bytes_sent }
+
+    def new_id( self, prefix ):
+        return f'{prefix}{len( self.items ) + 1:06d}'
+
+    def add_folder( self, parent, folders, files, depth, revisions, size, native ):
+        for i in range( files ):
+            self.add_file( parent, i, revisions, self.random.randint( size // 2, size * 3 // 2 ),
+                           self.random.random() < native )
+        if depth > 0:
+            for i in range( folders ):
+                folder_id = self.new_id( 'd' )
+                self.items[ folder_id ] = { 'id': folder_id, 'name': f'folder{i}', 'mimeType': FOLDER,
+                                            'kind': 'drive#file', 'parents': [ parent ], 'version': '1',
+                                            'capabilities': { 'canDownload': False, 'canReadRevisions': False },
+                                            'modifiedTime': '2019-07-01T00:00:00.000Z',
+                                            'createdTime': '2019-07-01T00:00:00.000Z' }
+                self.children[ parent ].append( folder_id )
+                self.add_folder( folder_id, folders, files, depth - 1, revisions, size, native )
+
+    def add_file( self, parent, i, revisions, size, native ):
+        file_id = self.new_id( 'f' )
+        day = 1 + i % 28
+        drive_file = {
+            'id': file_id, 'kind': 'drive#file', 'parents': [ parent ], 'version': str( revisions or 1 ),
+            'modifiedTime': f'2019-07-{day:02d}T12:00:00.000Z',
+            'createdTime': '2019-06-01T12:00:00.000Z',
+            'viewedByMeTime': '2019-08-01T12:00:00.000Z',
+            'owners': [{ 'kind': 'drive#user', 'displayName': 'Bench', 'emailAddress': self.user }],
+            'lastModifyingUser': { 'kind': 'drive#user', 'displayName': 'Bench', 'emailAddress': self.user },
+            'capabilities': { 'canDownload': True, 'canReadRevisions': revisions > 0 },
+            'shared': False, 'trashed': False, 'quotaBytesUsed': str( size ),
+        }
+        self.sizes[ file_id ] = size
+        if native:
+            drive_file.update({ 'name': f'document{i}', 'mimeType': DOCUMENT,
+                                'exportLinks': { 'application/pdf': f'HOST/export/{file_id}?exportFormat=pdf' }})
+        else:
+            drive_file.update({ 'name': f'file{i}.bin', 'originalFilename': f'file{i}.bin', 'fileExtension': 'bin',
+                                'mimeType': 'application/octet-stream', 'size': str( size ),
+                                'md5Checksum': md5( self.content( file_id )).hexdigest() })
+        revs = []
+        for r in range( 1, revisions + 1 ):
+            rev = { 'id': str( r ), 'kind': 'drive#revision', 'mimeType': drive_file['mimeType'],
+                    'modifiedTime': f'2019-07-{day:02d}T{r % 12:02d}:00:00.000Z',
+                    'lastModifyingUser': drive_file['lastModifyingUser'] }
+            if native:
+                rev['exportLinks'] = { 'application/pdf': f'HOST/revexport/{file_id}/{r}?exportFormat=pdf' }
+            else:
+                rev['size'] = str( size - ( revisions - r ))
+                rev['md5Checksum'] = md5( self.content( file_id, str( r ))).hexdigest()
+            revs.append( rev )
+        self.items[ file_id ] = drive_file
+        self.revisions[ file_id ] = revs
+        self.children[ parent ].append( file_id )
+        self.file_count += 1
+        self.total_size += size
+
+    # the content of a file or revision: its ID, followed by the shared random block,
+    # repeated up to its size.  Earlier revisions are shorter and differ; the last
+    # revision is the same as the file.
+    def content( self, file_id, revision=None ):
+        size = self.sizes[ file_id ]
+        prefix = f'{file_id}:'
+        if revision is not None and int( revision ) < self.revision_count:
+            size -= self.revision_count - int( revision )
+            prefix += f'{revision}:'
+        prefix = prefix.encode()
+        data = prefix + self.block * ( size // len( self.block ) + 1 )
+        return data[:size]
+
+    def export( self, file_id, revision=None ):
+        return b'%PDF-1.4\n' + self.content( file_id, revision )
+
+    def list_files( self, query ):
+        match = re.search( r"'([^']+)' in parents", query or '' )
+        if match:
+            parent = match.group( 1 )
+            items = [ self.items[ item_id ] for item_id in self.children.get( parent, [] ) ]
+            name = re.search( r"name\s*=\s*'([^']+)'", query )
+            if name:
+                items = [ item for item in items if item['name'] == name.group( 1 ) ]
+        else:
+            items = list( self.items.values() )
+        return items
+
+    def injected_error( self ):
+        if self.error_rate and self.errors:
+            with self.lock:
+                if self.random.random() < self.error_rate:
+                    return self.random.choice( self.errors )
+        return None
+
+# return the fields of obj selected by a Drive API field mask, eg. 'files(id,name),nextPageToken'.
+def apply_fields( obj, fields ):
+    if not fields or fields == '*':
+        return obj
+    return project( obj, parse_fields( fields ))
+
+def parse_fields( fields ):
+    mask = {}
+    stack = [ mask ]
+    name = ''
+    for ch in fields:
+        if ch == ',':
+            if name:
+                stack[-1][ name.strip() ] = None
+            name = ''
+        elif ch == '(':
+            sub = stack[-1][ name.strip() ] = {}
+            stack.append( sub )
+            name = ''
+        elif ch == ')':
+            if name:
+                stack[-1][ name.strip() ] = None
+            name = ''
+            stack.pop()
+        else:
+            name += ch
+    if name:
+        stack[-1][ name.strip() ] = None
+    return mask
+
+def project( obj, mask ):
+    if mask is None or '*' in mask:
+        return obj
+    if isinstance( obj, list ):
+        return [ project( item, mask ) for item in obj ]
+    if isinstance( obj, dict ):
+        return { key: project( value, mask[ key ] ) for key, value in obj.items() if key in mask }
+    return obj
+
+class Handler( BaseHTTPRequestHandler ):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message( self, *args ):
+        pass
+
+    @property
+    def drive( self ):
+        return self.server.drive
+
+    def host_url( self ):
+        return 'http://' + self.headers.get( 'Host', f'127.0.0.1:{self.server.server_port}' )
+
+    # replace the HOST placeholder of export links with this server's URL.
+    def with_host( self, obj ):
+        return json.loads( json.dumps( obj ).replace( 'HOST', self.host_url() ))
+
+    def send( self, status, body, content_type='application/json', headers=() ):
+        if isinstance( body, ( dict, list )):
+            body = json.dumps( body ).encode()
+        self.send_response( status )
+        self.send_header( 'Content-Type', content_type )
+        self.send_header( 'Content-Length', str( len( body )))
+        for name, value in headers:
+            self.send_header( name, value )
+        self.end_headers()
+        self.wfile.write( body )
+        with self.drive.lock:
+            self.drive.statuses[ status ] += 1
+            self.drive.bytes_sent += len( body )
+
+    def do_GET( self ):
+        method, status, body, content_type = self.route( self.path )
+        with self.drive.lock:
+            self.drive.calls[ method ] += 1
+        if status in ( 200, 206 ) and isinstance( body, bytes ) and content_type != 'application/json':
+            self.send_media( body )
+        else:
+            self.send( status, body, content_type )
+
+    # send media, honoring a Range header as Google Drive does.
+    def send_media( self, data ):
+        match = re.match( r'bytes=(\d+)-(\d*)', self.headers.get( 'Range', '' ))
+        if not match:
+            self.send( 200, data, 'application/octet-stream' )
+            return
+        start = int( match.group( 1 ))
+        end = min( int( match.group( 2 )) if match.group( 2 ) else len( data ) - 1, len( data ) - 1 )
+        self.send( 206, data[ start:end + 1 ], 'application/octet-stream',
+                   headers=[( 'Content-Range', f'bytes {start}-{end}/{len( data )}' )])
+
+    def do_POST( self ):
+        body = self.rfile.read( int( self.headers.get( 'Content-Length', 0 )))
+        if not self.path.startswith( '/batch' ):
+            self.send( 404, error( 404, 'notFound', 'Not found' ))
+            return
+        with self.drive.lock:
+            self.drive.calls['batch'] += 1
+        message = message_from_bytes( b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body,
+                                      policy=policy.HTTP )
+        boundary = 'batch_fakedrive'
+        parts = []
+        for part in message.iter_parts():
+            request_line = part.get_payload( decode=True ).decode().splitlines()[0]
+            path = urllib.parse.urlsplit( request_line.split( ' ' )[1] )
+            method, status, response, content_type = self.route( path.path + ( '?' + path.query if path.query else '' ))
+            with self.drive.lock:
+                self.drive.calls[ method ] += 1
+            if isinstance( response, ( dict, list )):
+                response = json.dumps( response )
+            elif isinstance( response, bytes ):
+                response = response.decode( 'latin1' )
+            content_id = part['Content-ID'].strip( '<>' )
+            parts.append( f'--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n'
+                          f'HTTP/1.1 {status} OK\r\nContent-Type: {content_type}\r\n\r\n{response}\r\n' )
+        parts.append( f'--{boundary}--' )
+        self.send( 200, ''.join( parts ).encode(), f'multipart/mixed; boundary={boundary}' )
+
+    # the email address of the account whose access token is in the request.
+    def account( self ):
+        token = self.headers.get( 'Authorization', '' ).partition( ' ' )[2]
+        return token[ len( 'user:' ): ] if token.startswith( 'user:' ) else self.drive.user
+
+    def route( self, path ):
+        """Return ( API method, status, body, content type ) of a request."""
+        url = urllib.parse.urlsplit( path )
+        query = dict( urllib.parse.parse_qsl( url.query ))
+        drive = self.drive
+        method, handler = self.method_of( url.path, query )
+        if method is None:
+            return 'unknown', 404, error( 404, 'notFound', f'No such method: {url.path}' ), 'application/json'
+        injected = drive.injected_error()
+        if injected:
+            status, reason = injected
+            return method, status, error( status, reason, reason ), 'application/json'
+        status, body, content_type = handler( query )
+        if status == 200 and isinstance( body, dict ):
+            body = apply_fields( self.with_host( body ), query.get( 'fields' ))
+        return method, status, body, content_type
+
+    def method_of( self, path, query ):
+        drive = self.drive
+        json_type = 'application/json'
+        if path == '/':
+            # kumodd's connectivity check
+            return 'ping', lambda q: ( 200, {}, json_type )
+        if path == '/drive/v3/about':
+            return 'about.get', lambda q: ( 200, { 'kind': 'drive#about', 'user': { 'emailAddress': self.account() }}, json_type )
+        if path == '/drive/v3/changes/startPageToken':
+            return 'changes.getStartPageToken', lambda q: ( 200, { 'startPageToken': '1' }, json_type )
+        if path == '/drive/v3/changes':
+            return 'changes.list', lambda q: ( 200, { 'changes': [], 'newStartPageToken': '1' }, json_type )
+        if path == '/drive/v3/files':
+            return 'files.list', self.files_list
+        match = re.match( r'/drive/v3/files/([^/]+)/revisions$', path )
+        if match:
+            return 'revisions.list', lambda q: self.by_id( match.group( 1 ), lambda file_id:
+                ( 200, { 'kind': 'drive#revisionList', 'revisions': drive.revisions.get( file_id, [] )}, json_type ))
+        match = re.match( r'/drive/v3/files/([^/]+)/export$', path )
+        if match:
+            return 'files.export', lambda q: self.by_id( match.group( 1 ), lambda file_id:
+                ( 200, drive.export( file_id ), 'application/pdf' ))
+        match = re.match( r'/export/([^/]+)$', path )
+        if match:
+            return 'exportLinks', lambda q: self.by_id( match.group( 1 ), lambda file_id:
+                ( 200, drive.export( file_id ), 'application/pdf' ))
+        match = re.match( r'/revexport/([^/]+)/([^/]+)$', path )
+        if match:
+            return 'revisions.exportLinks', lambda q: self.by_id( match.group( 1 ), lambda file_id:
+                ( 200, drive.export( file_id, match.group( 2 )), 'application/pdf' ))
+        match = re.match( r'/drive/v3/files/([^/]+)$', path )
+        if match:
+            if query.get( 'alt' ) == 'media':
+                return 'files.get_media', lambda q: self.by_id( match.group( 1 ), lambda file_id:
+                    ( 200, drive.content( file_id ), 'application/octet-stream' ))
+            return 'files.get', lambda q: self.by_id( match.group( 1 ), lambda file_id:
+                ( 200, drive.root if file_id == 'root' else drive.items[ file_id ], json_type ))
+        return None, None
+
+    def by_id( self, file_id, respond ):
+        if file_id != 'root' and file_id not in self.drive.items:
+            return 404, error( 404, 'notFound', f'File not found: {file_id}.' ), 'application/json'
+        return respond( file_id )
+
+    def files_list( self, query ):
+        items = self.drive.list_files( query.get( 'q' ))
+        page_size = int( query.get( 'pageSize', 100 ))
+        start = int( query.get( 'pageToken', 0 ))
+        result = { 'kind': 'drive#fileList', 'files': items[ start:start + page_size ]}
+        if start + page_size < len( items ):
+            result['nextPageToken'] = str( start + page_size )
+        return 200, result, 'application/json'
+
+def error( status, reason, message ):
+    return { 'error': { 'code': status, 'message': message, 'errors': [{ 'reason': reason, 'message': message }]}}
+
+class FakeDriveServer( ThreadingHTTPServer ):
+    """Serve a FakeDrive on a background thread."""
+    daemon_threads = True
+
+    def __init__( self, drive, host='127.0.0.1', port=0 ):
+        super().__init__(( host, port ), Handler )
+        self.drive = drive
+        self.url = f'http://{host}:{self.server_port}/'
+
+    def start( self ):
+        threading.Thread( target=self.serve_forever, daemon=True ).start()
+        return self
+
+    def stop( self ):
+        self.shutdown()
+        self.server_close()
+
+FLAGS = flags.FLAGS
+
+def define_drive_flags():
+    flags.DEFINE_integer('folders', 3, 'Number of sub-folders in each folder.', lower_bound=0)
+    flags.DEFINE_integer('files', 10, 'Number of files in each folder.', lower_bound=0)
+    flags.DEFINE_integer('depth', 2, 'Number of levels of sub-folders.', lower_bound=0)
+    flags.DEFINE_integer('revisions', 2, 'Number of revisions of each file.', lower_bound=0)
+    flags.DEFINE_integer('size', 65536, 'Average file size in bytes.', lower_bound=1)
+    flags.DEFINE_float('native', 0.1, 'Fraction of files that are native Google Docs.', lower_bound=0, upper_bound=1)
+    flags.DEFINE_float('error_rate', 0.0, 'Fraction of requests that fail with an injected error.', lower_bound=0, upper_bound=1)
+    flags.DEFINE_list('errors', list( injected_errors ), f'Injected errors, from: {", ".join( injected_errors )}.')
+    flags.DEFINE_integer('seed', 1, 'Random seed of the synthetic drive.')
+
+def drive_from_flags():
+    return FakeDrive( folders=FLAGS.folders, files=FLAGS.files, depth=FLAGS.depth, revisions=FLAGS.revisions,
+                      size=FLAGS.size, native=FLAGS.native, error_rate=FLAGS.error_rate, errors=FLAGS.errors,
+                      seed=FLAGS.seed )
+
+def main( argv ):
+    drive = drive_from_flags()
+    server = FakeDriveServer( drive, port=FLAGS.port )
+    print( f'Serving {drive.file_count} files, {drive.total_size} bytes, at {server.url}' )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    define_drive_flags()
+    flags.DEFINE_integer('port', 8080, 'Port to listen on.')
+    app.run( main )
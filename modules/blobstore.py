@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""Copyright (C) 2019  Andres Barreto and Rich Murphey
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+A content-addressed store of downloaded file data, keyed by MD5.
+
+Each distinct content is stored once, as <root>/<first two hex digits>/<md5>.
+Downloaded files are placed at their usual paths as reflinks or hard links to
+the stored copy, so identical files, revisions and files shared into several
+accounts take the space of one copy, and a file whose MD5 is already in the
+store need not be downloaded at all.
+
+A reflink (a copy-on-write clone, supported eg. by btrfs and XFS) has its own
+inode, so each path keeps its own time stamps.  Where reflinks are not
+supported, the data is copied instead.  Hard links share one inode, and so one
+set of time stamps, among all paths having the same content.
+"""
+
+import errno
+import hashlib
+import os
+import shutil
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Linux ioctl that clones a file's extents into another file.
+FICLONE = 0x40049409
+
+# errors meaning that reflinks or hard links are not possible between the two paths.
+unsupported_errors = ( errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.EPERM, errno.EMLINK )
+
+class BlobStore( object ):
+    def __init__( self, root, link_mode='reflink' ):
+        """Open or create a store.
+
+        Args:
+          root: folder holding the stored data.  Reflinks and hard links work only
+            within one file system, so it should be on the same one as the downloads.
+          link_mode: 'reflink', 'hardlink' or 'copy': how files are placed at their paths.
+        """
+        self.root = root
+        self.link_mode = link_mode
+        self.reflinks_supported = fcntl is not None
+        self.lock = threading.Lock()
+        self.linked = 0
+        self.added = 0
+        self.bytes_not_downloaded = 0
+        self.discarded = 0
+        # MD5s of the stored copies whose content was checked by this process.
+        self.verified = set()
+        os.makedirs( root, exist_ok=True )
+
+    def path( self, md5 ):
+        return os.path.join( self.root, md5[:2], md5 )
+
+    def has( self, md5, size=None ):
+        """Return True if content having md5, and size bytes if given, is stored."""
+        if not md5:
+            return False
+        try:
+            stored_size = os.path.getsize( self.path( md5 ))
+        except FileNotFoundError:
+            return False
+        return size is None or stored_size == int( size )
+
+    # return a temporary name next to path, unique to this process and thread.
+    def tmp_path( self, path ):
+        return f'{path}.tmp-{os.getpid()}-{threading.get_ident()}'
+
+    def place( self, src, dest ):
+        """Make dest a reflink, hard link or copy of src, replacing dest atomically."""
+        tmp = self.tmp_path( dest )
+        if os.path.exists( tmp ):
+            os.remove( tmp )
+        try:
+            self.place_at( src, tmp )
+        except BaseException:
+            # a partial copy must not take the place of dest.
+            if os.path.exists( tmp ):
+                os.unlink( tmp )
+            raise
+        os.replace( tmp, dest )
+
+    def place_at( self, src, tmp ):
+        if self.link_mode == 'hardlink':
+            try:
+                os.link( src, tmp )
+                return
+            except OSError as e:
+                if e.errno not in unsupported_errors:
+                    raise
+        elif self.link_mode == 'reflink' and self.reflinks_supported:
+            if self.reflink( src, tmp ):
+                return
+        shutil.copyfile( src, tmp )
+
+    def reflink( self, src, dest ):
+        with open( src, 'rb' ) as src_handle, open( dest, 'wb' ) as dest_handle:
+            try:
+                fcntl.ioctl( dest_handle.fileno(), FICLONE, src_handle.fileno() )
+                return True
+            except OSError as e:
+                if e.errno not in unsupported_errors:
+                    raise
+        # do not try again on every file.
+        self.reflinks_supported = False
+        os.remove( dest )
+        return False
+
+    def link( self, md5, dest, size=None ):
+        """Place the stored copy having MD5 at dest.
+
+        Returns False if there is none, or if it does not have size bytes, if given, or
+        the MD5.  A stored copy that does not match its MD5 is removed from the store.
+        """
+        blob = self.path( md5 )
+        try:
+            stored_size = os.path.getsize( blob )
+        except FileNotFoundError:
+            return False
+        if size is not None and stored_size != int( size ):
+            return False
+        if not self.verify( md5 ):
+            return False
+        self.place( blob, dest )
+        with self.lock:
+            self.linked += 1
+            self.bytes_not_downloaded += stored_size
+        return True
+
+    # check the content of a stored copy against its MD5, once per process, and remove it
+    # if it does not match.
+    def verify( self, md5 ):
+        with self.lock:
+            if md5 in self.verified:
+                return True
+        blob = self.path( md5 )
+        m = hashlib.md5()
+        with open( blob, 'rb' ) as handle:
+            for chunk in iter( lambda: handle.read( 1024*1024 ), b'' ):
+                m.update( chunk )
+        if m.hexdigest() != md5:
+            try:
+                os.unlink( blob )
+            except FileNotFoundError:
+                pass
+            with self.lock:
+                self.discarded += 1
+            return False
+        with self.lock:
+            self.verified.add( md5 )
+        return True
+
+    def add( self, file_path, md5 ):
+        """Add a downloaded file to the store, unless its content is already stored.
+
+        With hard links, the file is then replaced by a link to the stored copy, so that
+        identical files share one copy on disk.
+        """
+        blob = self.path( md5 )
+        if not self.has( md5, os.path.getsize( file_path )):
+            os.makedirs( os.path.dirname( blob ), exist_ok=True )
+            self.place( file_path, blob )
+            with self.lock:
+                self.added += 1
+                # its MD5 was computed as it was downloaded.
+                self.verified.add( md5 )
+        elif self.link_mode == 'hardlink' and not os.path.samefile( blob, file_path ):
+            self.place( blob, file_path )
+
+    def summary( self ):
+        summary = f'Blob store: {self.added} added, {self.linked} linked, {self.bytes_not_downloaded} bytes not downloaded'
+        if self.discarded:
+            summary += f', {self.discarded} corrupt copies discarded'
+        return summary
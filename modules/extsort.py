@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Copyright (C) 2019  Andres Barreto and Rich Murphey
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+An external merge sort of CSV rows, using bounded memory.
+
+Rows are collected in memory until max_rows are held, then sorted and spilled
+to a temporary CSV file, called a run.  The sorted rows are read back by
+merging the runs.  Rows are lists of strings, compared column by column.
+"""
+
+import csv
+import heapq
+import os
+import tempfile
+
+class ExternalSort( object ):
+    def __init__( self, tmp_dir=None, max_rows=500000, max_runs=256 ):
+        """Create an empty sort.
+
+        Args:
+          tmp_dir: folder in which to create the temporary folder for runs.
+          max_rows: number of rows held in memory before they are spilled to a run.
+          max_runs: number of runs merged at once.  If there are more, runs are first
+            merged into larger runs.
+        """
+        self.max_rows = max_rows
+        self.max_runs = max_runs
+        self.rows = []
+        self.runs = []
+        self.run_count = 0
+        self.tmp = tempfile.TemporaryDirectory( dir=tmp_dir, prefix='.sort-' )
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.close()
+
+    # None is written to CSV as an empty string, so it sorts as one.
+    def writerow( self, row ):
+        self.rows.append([ '' if value is None else str( value ) for value in row ])
+        if len( self.rows ) >= self.max_rows:
+            self.spill()
+
+    def new_run( self ):
+        self.run_count += 1
+        return os.path.join( self.tmp.name, f'run{self.run_count}.csv' )
+
+    def spill( self ):
+        self.rows.sort()
+        path = self.new_run()
+        with open( path, 'w', newline='' ) as handle:
+            csv.writer( handle ).writerows( self.rows )
+        self.runs.append( path )
+        self.rows = []
+
+    def merge( self, runs ):
+        handles = [ open( path, newline='' ) for path in runs ]
+        try:
+            yield from heapq.merge( *[ csv.reader( handle ) for handle in handles ] )
+        finally:
+            for handle in handles:
+                handle.close()
+
+    def sorted( self ):
+        """Yield the rows in sorted order."""
+        if not self.runs:
+            self.rows.sort()
+            yield from self.rows
+            return
+        if self.rows:
+            self.spill()
+        while len( self.runs ) > self.max_runs:
+            runs, self.runs = self.runs[:self.max_runs], self.runs[self.max_runs:]
+            path = self.new_run()
+            with open( path, 'w', newline='' ) as handle:
+                csv.writer( handle ).writerows( self.merge( runs ))
+            for run in runs:
+                os.remove( run )
+            self.runs.append( path )
+        yield from self.merge( self.runs )
+
+    def close( self ):
+        self.tmp.cleanup()
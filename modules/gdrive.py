@@ -33,30 +33,48 @@ filename should vary by user name accordingly.
 
 from absl import app, flags
 from apiclient import errors
-from collections import Iterable, OrderedDict
-from datetime import datetime
+from collections import OrderedDict, deque
+from collections.abc import Iterable
+from copy import deepcopy
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime, timezone
 from dateutil import parser
 from dumper import dump
-from apiclient.http import MediaIoBaseDownload
-from googleapiclient.discovery import build
+from apiclient.http import HttpRequest
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from hashlib import md5
 from jsonpath_ng import jsonpath, parse
 from oauth2client.client import AccessTokenRefreshError, flow_from_clientsecrets
 from oauth2client.file import Storage
 from oauth2client.tools import run_flow, argparser
+from modules.blobstore import BlobStore
+from modules.extsort import ExternalSort
+from modules.hashcache import HashCache
+from modules.metastore import SqliteMetadataStore
+from modules.pipeline import Pipeline, Stage
+from modules.plan import Plan, PlanWriter, Progress, policies
+from modules.ratelimit import RateLimiter, RateLimitedHttp, shared_rate_limiter
+from modules.stats import run_stats
+from modules.transport import AsyncTransport
 import csv
 import difflib
 import httplib2
 import io
 import json
 import logging
+import multiprocessing
 import os
 import platform
+import random
 import re
 import socket
 import socks
 import sys
+import threading
 import time
+import urllib.parse
 import yaml
 
 if platform.system() == 'Windows':
@@ -77,6 +95,35 @@ flags.DEFINE_string('query', None, 'metadata query (filter)', short_name='q')
 flags.DEFINE_string('scope', 'https://www.googleapis.com/auth/drive.readonly', 'Google Drive scope')
 flags.DEFINE_string('corpora', 'user', 'Google Drive corpora')
 flags.DEFINE_string('spaces', 'drive', "A comma-separated list of spaces to query within the corpus. Supported values are 'drive', 'appDataFolder' and 'photos'.")
+flags.DEFINE_integer('l2t_sort_rows', 500000, 'Number of log2timeline rows sorted in memory, with -l2t.  More rows are sorted in temporary files next to the CSV file.', lower_bound=1)
+flags.DEFINE_integer('download_chunk_size', 16*1024*1024, 'Maximum number of bytes requested at a time when downloading a file.  The size of each request adapts to the speed of the connection, up to this limit.  Each concurrent download holds one request in memory.', lower_bound=4096)
+flags.DEFINE_integer('hash_chunk_size', 1024*1024, 'Number of bytes read at a time when computing the MD5 of a file on disk.', lower_bound=4096)
+flags.DEFINE_string('fields', 'auto', "Metadata to request from Google Drive: 'auto' requests the fields in the column set (-col) and those kumodd needs; 'full' requests all metadata, eg. for preservation; or a comma-separated list of Google Drive file fields.")
+flags.DEFINE_enum('walk', 'folders', ['folders', 'flat'], "How to list files: 'folders' makes one query per folder; 'flat' lists all files in one query and rebuilds the folder tree in memory.")
+flags.DEFINE_integer('walk_jobs', 1, 'Number of folders to list concurrently, with -walk folders.', lower_bound=1)
+flags.DEFINE_boolean('ordered', True, 'With -walk_jobs, output items in the same order as a sequential walk. Otherwise, output them as soon as their folder is listed.')
+flags.DEFINE_boolean('sync', False, 'With -download, after the first run, visit only the files that changed since the previous run, using the Google Drive changes feed.')
+flags.DEFINE_integer('batch_size', 100, 'Number of requests to send in each Google Drive API batch request.', lower_bound=1, upper_bound=100)
+flags.DEFINE_boolean('rehash', False, 'Re-read every file on disk to compute its MD5, rather than using the MD5 cached from a previous run.')
+flags.DEFINE_integer('jobs', 1, 'Number of files to download or verify concurrently. Each download worker uses its own HTTP connection; verify workers are separate processes.', lower_bound=1, short_name='j')
+flags.DEFINE_integer('enrich_jobs', 1, 'Number of threads retrieving the revisions of listed files, in batches, and hashing their local copies, before they are downloaded.', lower_bound=1)
+flags.DEFINE_integer('hash_jobs', 1, 'Number of threads hashing downloaded files, saving their metadata and comparing it to the saved metadata.', lower_bound=1)
+flags.DEFINE_integer('queue_size', 64, 'Number of files held between each pair of stages (listing, enrich, download, verify and output) of a collection.  When a stage falls behind, the stages before it wait.', lower_bound=1)
+flags.DEFINE_integer('revision_jobs', 1, "Number of a file's revisions to download concurrently, each on its own HTTP connection.", lower_bound=1)
+flags.DEFINE_string('blob_store', None, 'Folder of a store holding one copy of each distinct file content, keyed by MD5.  Downloaded files are placed at their paths as links to the stored copy, and files already in the store are not downloaded again.  Put it on the same file system as the destination.')
+flags.DEFINE_enum('blob_link', 'reflink', ['reflink', 'hardlink', 'copy'], "With -blob_store, how files are placed at their paths: 'reflink' clones the stored copy where the file system supports it, else copies it; 'hardlink' saves space on any file system, but files having the same content share one set of time stamps; 'copy' saves only the download.")
+flags.DEFINE_string('api_url', None, "URL of a server implementing the Google Drive v3 API, to use in place of Google's, eg. the fake Drive server in bench/fakedrive.py.")
+flags.DEFINE_enum('transport', 'httplib2', ['httplib2', 'aiohttp'], "How to send Google Drive API requests: 'httplib2' gives each worker its own connection; 'aiohttp' sends the requests of all workers from one asyncio event loop, over a shared pool of keep-alive connections, while each worker thread waits for its responses.  aiohttp is optional: pip install aiohttp.")
+flags.DEFINE_integer('connections', 100, 'With -transport aiohttp, the maximum number of connections open at once.', lower_bound=1)
+flags.DEFINE_float('api_rate', 100, 'Maximum number of Google Drive API requests per second, for metadata and for downloads each.  When Google Drive reports a rate limit, the rate and the number of requests in flight are halved, then recover gradually.', lower_bound=0.1)
+flags.DEFINE_integer('api_concurrency', 32, 'Maximum number of Google Drive API requests in flight, for metadata and for downloads each.', lower_bound=1)
+flags.DEFINE_enum('schedule', 'small_first', policies, "With -execute, the order in which to download the planned files: 'small_first', 'large_first', 'interleaved' (alternately the largest and the smallest remaining), or 'listed' (the order in which they were listed).")
+flags.DEFINE_integer('progress', 10, 'With -execute, report the files and bytes done, the bytes remaining and the ETA every this many seconds.  0 reports only at the end.', lower_bound=0)
+flags.DEFINE_list('accounts', None, 'Collect several accounts in parallel processes: a comma-separated list of user credential files, like -user_cred, or @FILE for a file listing one per line.  Each account is saved in its own folders and files, as usual.  The credentials must have been authorized already.')
+flags.DEFINE_integer('account_jobs', 4, 'With -accounts, the number of accounts to collect at a time.  All of them share one -api_rate and -api_concurrency.', lower_bound=1)
+flags.DEFINE_string('stats', None, 'Write counters and timings of the run to this JSON file: the time spent in each phase, API requests by method and HTTP status, bytes received and retries.')
+flags.DEFINE_string('prometheus', None, "Write the run's counters and timings to this file in the Prometheus text format, eg. in the node exporter's textfile collector folder.")
+flags.DEFINE_integer('retries', 5, 'Number of times to retry a download request, or other request, that fails with a transient error, waiting exponentially longer between attempts.', lower_bound=0)
 
 def dirname(s):
     index = s.rfind('/')
@@ -89,7 +136,7 @@ def basename(s):
 
 def ensure_dir(directory):
     if not os.path.exists(directory):
-        os.makedirs(directory)
+        os.makedirs(directory, exist_ok=True)
 
 # Convert Y-m-d H:M:S.SSSZ to seconds since the epoch, as a float, with milli-secondsh resolution.
 # return zero if attr is missing.
@@ -143,16 +190,78 @@ def represent_dict_order(dumper, data):
 OrderedDumper.add_representer(OrderedDict, represent_dict_order)
 json_decoder = json.JSONDecoder(object_pairs_hook=OrderedDict)
 
-def dump_yaml( obj, stream ):
-    yaml.dump( obj, stream=stream, Dumper=OrderedDumper, width=None, allow_unicode=True, default_flow_style=False)
-
-def yaml_string( obj ):
+# The libyaml C emitter produces the same YAML as the pure Python emitter, except in how
+# each quotes and folds strings that need escapes or contain characters outside the
+# Basic Multilingual Plane.  Objects whose repr() shows any such string are dumped by the
+# Python emitter, so the YAML, and the MD5 of it, is identical either way.  Without
+# allow_unicode, any non-ASCII character needs an escape.
+if getattr( yaml, '__with_libyaml__', False ):
+    class COrderedDumper(yaml.CSafeDumper):
+        pass
+    COrderedDumper.add_representer(OrderedDict, represent_dict_order)
+    CDumper = yaml.CDumper
+    YamlLoader = yaml.CSafeLoader
+else:
+    COrderedDumper = None
+    CDumper = None
+    YamlLoader = yaml.SafeLoader
+needs_python_emitter = re.compile(r'\\|[\U00010000-\U0010ffff]')
+needs_python_emitter_ascii = re.compile(r'\\|[^\x00-\x7f]')
+
+@run_stats.timed( 'yaml' )
+def dump_yaml( obj, stream, obj_repr=None ):
+    Dumper = OrderedDumper
+    if COrderedDumper and not needs_python_emitter.search( obj_repr or repr( obj )):
+        Dumper = COrderedDumper
+    yaml.dump( obj, stream=stream, Dumper=Dumper, width=None, allow_unicode=True, default_flow_style=False)
+
+def yaml_string( obj, obj_repr=None ):
     stringio = io.StringIO()
-    dump_yaml( obj, stringio )
+    dump_yaml( obj, stringio, obj_repr )
     s = stringio.getvalue()
     stringio.close()
     return s
 
+# save metadata as yaml.dump() does by default, using the C emitter where it gives the same output.
+@run_stats.timed( 'yaml' )
+def save_yaml( obj, stream ):
+    Dumper = yaml.Dumper
+    if CDumper and not needs_python_emitter_ascii.search( repr( obj )):
+        Dumper = CDumper
+    yaml.dump( obj, stream, Dumper=Dumper )
+
+def load_yaml( stream ):
+    return yaml.load( stream, Loader=YamlLoader )
+
+class CanonicalYamlCache( object ):
+    """The redacted YAML of recently seen metadata, keyed by the MD5 of its repr().
+
+    The metadata of a file is serialized several times: to compute its yamlMetadataMD5,
+    the yamlMetadataMD5 of the saved copy, and again to show differences.  repr() is much
+    faster than YAML, so it serves as the fingerprint of the content.
+    """
+    def __init__( self, max_entries=1024 ):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def yaml_of( self, obj ):
+        obj_repr = repr( obj )
+        key = md5( obj_repr.encode('utf8', 'surrogatepass') ).digest()
+        with self.lock:
+            s = self.entries.get( key )
+            if s is not None:
+                self.entries.move_to_end( key )
+                return s
+        s = yaml_string( obj, obj_repr )
+        with self.lock:
+            self.entries[key] = s
+            if len( self.entries ) > self.max_entries:
+                self.entries.popitem( last=False )
+        return s
+
+canonical_yaml = CanonicalYamlCache()
+
 def remove_keys_that_contain( dict_in, list_of_substrings ):
     dict_copy = dict(dict_in)
     for substring in list_of_substrings:
@@ -186,11 +295,42 @@ def redacted_yaml( dict_in ):
         d = remove_keys( d, [ 'size', 'md5Checksum' ] )
     if not FLAGS.revisions:
         d = remove_keys( d, [ 'revisions' ] )
-    return yaml_string( d )
+    return canonical_yaml.yaml_of( d )
 
 def md5hex( content ):
     return md5( content ).hexdigest()
 
+# open a file for reading without updating its last access time, which kumodd compares
+# to lastViewedByMeTime.
+# open a file for reading, with O_NOATIME where the system allows it, so that reading
+# does not update the file's access time.  Otherwise the file is opened as usual, and
+# its timestamps are left alone, since restoring the access time would change its ctime.
+def open_noatime( file_path ):
+    try:
+        fd = os.open( file_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0) | getattr(os, 'O_NOATIME', 0) )
+    except PermissionError:
+        # O_NOATIME requires owning the file
+        fd = os.open( file_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0) )
+    return open( fd, 'rb', buffering=0 )
+
+# MD5 of a file on disk.  The file is read in chunks into one reused buffer, so memory
+# use is constant regardless of file size.
+@run_stats.timed( 'hashing' )
+def md5_of_file( file_path, chunk_size=None ):
+    m = md5()
+    buf = bytearray( chunk_size or FLAGS.hash_chunk_size )
+    view = memoryview( buf )
+    with open_noatime( file_path ) as f:
+        for n in iter( lambda: f.readinto( buf ), 0 ):
+            m.update( view[:n] )
+    return m.hexdigest()
+
+# MD5 of a file on disk, using the persistent hash cache if there is one.
+def local_md5( hash_cache, file_path ):
+    if hash_cache:
+        return hash_cache.md5( file_path, md5_of_file )
+    return md5_of_file( file_path )
+
 # get the MD5 digest of the yaml of the metadata dict, excluding the *yaml*, *Url*, and *status* keys
 def MD5_of_yaml_of(dict_in):
     return md5hex(redacted_yaml( dict_in ).encode('utf8'))
@@ -216,26 +356,179 @@ def dget( d, key_list ):
 
 # get_dict_value( {'a': {'b': 1, 'c': [2,3,4] }}, 'a.c[2]' ) -> 4
 def jsonpath_value( obj, path ):
-    if '.' in path :
+    return column_extractor( path )( obj )
+
+# get_dict_values( {'a': {'b': 1, 'c': [2,3,4] }}, ['a.c[2]', 'a.b'] ) -> [4, 1]
+def jsonpath_list( obj, object_path_list ):
+    return [ '' if elem is None else elem for elem in [ extract( obj ) for extract in compile_columns( object_path_list ) ]]
+
+# Column values are read by extractors compiled once per column set, because parsing a
+# JSONPath costs far more than evaluating it.  A name without a dot is a dict lookup, a
+# dotted path of plain keys is a chain of lookups, and only other paths, eg.
+# 'owners[*].emailAddress', are evaluated by jsonpath_ng, using the parsed expression.
+dotted_keys = re.compile( r'\w+(\.\w+)+$' )
+compiled_extractors = {}
+compiled_column_sets = {}
+
+def column_extractor( path ):
+    extract = compiled_extractors.get( path )
+    if extract is None:
+        if '.' not in path:
+            extract = lambda obj: obj.get( path )
+        else:
+            extract = jsonpath_extractor( path )
+            if dotted_keys.match( path ):
+                extract = dotted_extractor( path.split( '.' ), extract )
+        compiled_extractors[ path ] = extract
+    return extract
+
+def jsonpath_extractor( path ):
+    expr = parse( path )
+    def extract( obj ):
         try:
-            elem = parse(path).find( obj )[0].value
+            return expr.find( obj )[0].value
         except IndexError as e:
             print(f'{e}: {path}')
             dump(obj)
-            elem = None
-    else:
-        elem = obj.get(path)
-    return elem
+            return None
+    return extract
+
+# look up each key in turn.  If one is missing, fall back to jsonpath_ng, which reports it.
+def dotted_extractor( keys, fallback ):
+    def extract( obj ):
+        value = obj
+        for key in keys:
+            if not ( isinstance( value, dict ) and key in value ):
+                return fallback( obj )
+            value = value[ key ]
+        return value
+    return extract
+
+def compile_columns( metadata_names ):
+    """Return the extractors of a column set, compiling them on first use."""
+    names = tuple( metadata_names )
+    extractors = compiled_column_sets.get( names )
+    if extractors is None:
+        extractors = compiled_column_sets[ names ] = [ column_extractor( name ) for name in names ]
+    return extractors
+
+# render a row of column values for the console.
+def format_row( output_format, data ):
+    return output_format.format( *map( str, data )).rstrip()
 
-# get_dict_values( {'a': {'b': 1, 'c': [2,3,4] }}, ['a.c[2]', 'a.b'] ) -> [4, 1]
-def jsonpath_list( obj, object_path_list ):
-    result = []
-    for path in object_path_list:
-        elem = jsonpath_value( obj, path )
-        if elem is None:
-            elem = ''
-        result.append( elem )
-    return result
+#----------------------------------------------------------------
+# Google Drive API field masks.  By default, kumodd requests only the fields that the
+# selected column set and kumodd itself need, rather than all metadata ('*').
+
+# top level fields of a Google Drive v3 File
+drive_file_fields = {
+    'appProperties', 'capabilities', 'contentHints', 'contentRestrictions', 'copyRequiresWriterPermission',
+    'createdTime', 'description', 'driveId', 'explicitlyTrashed', 'exportLinks', 'fileExtension',
+    'folderColorRgb', 'fullFileExtension', 'hasAugmentedPermissions', 'hasThumbnail', 'headRevisionId',
+    'iconLink', 'id', 'imageMediaMetadata', 'isAppAuthorized', 'kind', 'labelInfo', 'lastModifyingUser',
+    'linkShareMetadata', 'md5Checksum', 'mimeType', 'modifiedByMe', 'modifiedByMeTime', 'modifiedTime',
+    'name', 'originalFilename', 'ownedByMe', 'owners', 'parents', 'permissionIds', 'permissions',
+    'properties', 'quotaBytesUsed', 'resourceKey', 'sha1Checksum', 'sha256Checksum', 'shared',
+    'sharedWithMeTime', 'sharingUser', 'shortcutDetails', 'size', 'spaces', 'starred', 'teamDriveId',
+    'thumbnailLink', 'thumbnailVersion', 'trashed', 'trashedTime', 'trashingUser', 'version',
+    'videoMediaMetadata', 'viewedByMe', 'viewedByMeTime', 'viewersCanCopyContent', 'webContentLink',
+    'webViewLink', 'writersCanShare',
+}
+
+# file fields used by kumodd to name, download, verify and timeline files
+required_file_fields = [
+    'id', 'name', 'mimeType', 'parents', 'originalFilename', 'fileExtension', 'version',
+    'size', 'md5Checksum', 'createdTime', 'modifiedTime', 'modifiedByMeTime', 'viewedByMeTime',
+    'owners', 'trashed', 'capabilities', 'exportLinks',
+]
+
+# revision fields used by kumodd
+required_revision_fields = 'id,mimeType,modifiedTime,lastModifyingUser,originalFilename,md5Checksum,size,exportLinks'
+
+def file_fields( metadata_names ):
+    """Return the fields mask for file metadata selected by -fields.
+
+    Args:
+      metadata_names: names of the columns in the selected column set.
+    Returns:
+      '*' for all metadata, or a comma-separated list of fields.
+    """
+    if FLAGS.fields == 'full':
+        return '*'
+    if FLAGS.fields != 'auto':
+        return FLAGS.fields
+    fields = list( required_file_fields )
+    for name in metadata_names:
+        field = re.split( r'[.\[]', name )[0]
+        if field in drive_file_fields and field not in fields:
+            fields.append( field )
+    return ','.join( fields )
+
+def revision_fields():
+    return '*' if FLAGS.fields == 'full' else required_revision_fields
+
+# fields mask for a request returning a list of items, eg. 'nextPageToken,files(id,name)'.
+def list_fields( collection, fields, extra='nextPageToken' ):
+    if fields == '*':
+        return '*'
+    return f'{extra},{collection}({fields})'
+
+# parse a fields mask, eg. 'id,owners(emailAddress)', into a dict that maps each field
+# to the mask of its subfields, or to None for all of them.
+def parse_fields( fields ):
+    mask = {}
+    masks = [ mask ]
+    name = ''
+    for c in fields + ',':
+        if c not in ',()':
+            name += c
+            continue
+        name = name.strip()
+        if c == '(':
+            masks[-1][name] = {}
+            masks.append( masks[-1][name] )
+        elif name:
+            masks[-1][name] = None
+        if c == ')' and len( masks ) > 1:
+            masks.pop()
+        name = ''
+    return mask
+
+# return the value limited to the fields in mask.
+def project_fields( value, mask ):
+    if mask is None:
+        return value
+    if isinstance( value, list ):
+        return [ project_fields( v, mask ) for v in value ]
+    if isinstance( value, dict ):
+        return { k: project_fields( v, mask[k] ) for k, v in value.items() if k in mask }
+    return value
+
+# Return the metadata limited to the file fields of the mask, and its revisions to the
+# revision fields, keeping the fields kumodd adds.  Metadata saved with all fields can
+# then be compared with metadata retrieved with fewer, while a requested field that is
+# no longer retrieved still differs.
+def project_metadata( metadata, fields ):
+    if fields == '*':
+        return metadata
+    mask = parse_fields( fields )
+    revision_mask = parse_fields( required_revision_fields )
+    projected = {}
+    for k, v in metadata.items():
+        if k == 'revisions':
+            projected[k] = project_fields( v, revision_mask )
+        elif k in mask:
+            projected[k] = project_fields( v, mask[k] )
+        elif k not in drive_file_fields:
+            projected[k] = v
+    return projected
+
+# load saved metadata, for comparison with drive_file, or None if there is none.
+def load_saved_metadata( ctx, drive_file ):
+    saved = ctx.metadata_store.load( ctx.user, metadata_key( drive_file ))
+    if saved is not None:
+        saved = project_metadata( saved, ctx.file_fields )
+    return saved
 
 #----------------------------------------------------------------
 
@@ -268,9 +561,11 @@ def supplement_drive_file_metadata(ctx, drive_file, path):
     # drive_file['label_key'] = ''.join(sorted([(k[0] if v else ' ') for k, v in drive_file['labels'].items()])).upper()
 
 class FileAttr( object ):
-    def __init__( self, drive_file, username ):
-        self.local_file = local_data_dir( drive_file, username ) + '/' + file_name(drive_file)
-        self.metadata_file = local_metadata_dir( drive_file, username ) + '/' + file_name(drive_file) + '.yml'
+    def __init__( self, ctx, drive_file ):
+        self.hash_cache = ctx.hash_cache
+        self.local_file = local_data_dir( drive_file, ctx.user ) + '/' + file_name(drive_file)
+        self.metadata_file = ctx.metadata_store.location( ctx.user, metadata_key( drive_file ))
+        self.saved_metadata = None
         self.yamlMetadataMD5 = None
         self.update_local( drive_file )
 
@@ -280,7 +575,7 @@ class FileAttr( object ):
             self.local_mod_time = os.path.getmtime( self.local_file )
             self.local_acc_time = os.path.getatime( self.local_file )
             self.localSize	= os.path.getsize(self.local_file)
-            self.md5Local	= md5hex(open(self.local_file,'rb').read())
+            self.md5Local	= local_md5( self.hash_cache, self.local_file )
         else:
             self.yamlMetadataMD5 = None
             self.local_mod_time	= None
@@ -290,10 +585,11 @@ class FileAttr( object ):
         self.valid = self.local_file_is_valid( drive_file )
 
 
-    def update_local_metadata_MD5( self ):
-        self.metadata_file_exists = os.path.exists( self.metadata_file )
+    def update_local_metadata_MD5( self, ctx, drive_file ):
+        self.saved_metadata = load_saved_metadata( ctx, drive_file )
+        self.metadata_file_exists = self.saved_metadata is not None
         if self.metadata_file_exists:
-            self.yamlMetadataMD5 = MD5_of_yaml_of(yaml.safe_load(open(self.metadata_file,'rb').read()))
+            self.yamlMetadataMD5 = MD5_of_yaml_of( self.saved_metadata )
         else:
             self.yamlMetadataMD5 = None
 
@@ -351,12 +647,14 @@ class FileAttr( object ):
         else:
             drive_file['status'] = 'missing'
 
-    def compare_YAML_metadata_MD5( self, drive_file):
+    def compare_YAML_metadata_MD5( self, ctx, drive_file):
         update_yamlMetadataMD5( drive_file )
 
-        self.update_local_metadata_MD5()
+        self.update_local_metadata_MD5( ctx, drive_file )
         if self.metadata_file_exists:
-            if self.yamlMetadataMD5 and self.yamlMetadataMD5 == drive_file.get('yamlMetadataMD5'):
+            # both are limited to the requested fields, so that a field saved, but no
+            # longer present, is a mismatch.
+            if self.yamlMetadataMD5 and self.yamlMetadataMD5 == MD5_of_yaml_of( project_metadata( drive_file, ctx.file_fields )):
                 drive_file['yamlMD5Match'] = 'match'
             else:
                 drive_file['yamlMD5Match'] = 'MISMATCH'
@@ -365,19 +663,25 @@ def verify_revisions( ctx, drive_file):
     if drive_file.get('revisions'):
         for rev in drive_file.get('revisions'):
             file_path = local_data_dir( drive_file, ctx.user ) + '/' + file_name(drive_file, rev )
-            md5ofRev = md5hex(open(file_path,'rb').read())
-            if md5ofRev != rev['md5Checksum']:
-                print(f"invalid revision: {file_path} {md5ofRev} should be {rev['md5Checksum']}")
+            if not os.path.exists( file_path ):
+                # only exported revisions are saved to disk.
+                if rev.get('exportLinks'):
+                    print(f"missing revision: {file_path}")
+                continue
+            md5ofRev = local_md5( ctx.hash_cache, file_path )
+            if md5ofRev != rev.get('md5Checksum'):
+                print(f"invalid revision: {file_path} {md5ofRev} should be {rev.get('md5Checksum')}")
 
 # record MD5 of drive_file object
 def update_yamlMetadataMD5(drive_file):
     drive_file['yamlMetadataMD5'] = MD5_of_yaml_of(drive_file)
 
-def print_obj_diffs( drive_file, filename ):
-    print(22*'_', filename )
+@run_stats.timed( 'diff' )
+def print_obj_diffs( drive_file, file_attr ):
+    print(22*'_', file_attr.metadata_file )
     diff = difflib.ndiff(
         redacted_yaml(drive_file).splitlines(keepends=True),
-        redacted_yaml(yaml.safe_load(open(filename,'rb').read())).splitlines(keepends=True))
+        redacted_yaml( file_attr.saved_metadata ).splitlines(keepends=True))
     print( ''.join( list( diff )), end="")
     print(79*'_')
 
@@ -428,42 +732,92 @@ def output_lt2_csv(ctx, df, writer):
             for rev in revision_list:
                 l2t_rec( ctx, writer, df, rev.get('modifiedTime'), 'M', 'Last Modified', 'Last Modified', dget(rev, 'lastModifyingUser.emailAddress'), rev.get('id'))
 
-def print_file_metadata(ctx, drive_file, path, writer, metadata_names, output_format=None):
-    supplement_drive_file_metadata(ctx, drive_file, path)
-    file_attr = FileAttr( drive_file, ctx.user )
-    file_attr.compare_metadata_to_local_file( drive_file )
-    file_attr.compare_YAML_metadata_MD5( drive_file )
+l2t_header = ['date', 'time', 'timezone', 'MACB',
+              'source', 'sourcetype', 'type', 'user',
+              'host', 'short', 'desc', 'version',
+              'filename', 'inode', 'notes', 'format',
+              'extra']
 
-    if drive_file['mimeType'].startswith( 'application/vnd.google-apps' ):
-        # google drive API does not provide size or md5, so use local metadata for them.
-        drive_file['md5Checksum'] = file_attr.md5Local
-        drive_file['size'] = file_attr.localSize
-        
+# convert a -since or -until time to the format of Google Drive timestamps in UTC, such
+# as '2014-08-21T04:15:00', so that timestamps can be compared to it as strings.
+def utc_time_flag( value ):
+    if not value:
+        return None
+    t = parser.parse( value )
+    if t.tzinfo:
+        t = t.astimezone( timezone.utc )
+    return t.strftime( '%Y-%m-%dT%H:%M:%S' )
+
+class TimeWindow( object ):
+    """Passes log2timeline rows to writer, if they are at or after since, and before until."""
+    def __init__( self, writer, since=None, until=None ):
+        self.writer = writer
+        self.since = since
+        self.until = until
+
+    def writerow( self, row ):
+        timestamp = row[0] + 'T' + row[1]
+        if self.since and timestamp < self.since:
+            return
+        if self.until and timestamp >= self.until:
+            return
+        self.writer.writerow( row )
+
+# write the user's timeline, sorted by time, from the metadata store.
+def write_timeline( ctx, csv_path ):
+    with open(csv_path, 'w') as csv_handle, ExternalSort( dirname( csv_path ) or '.', FLAGS.l2t_sort_rows ) as sorter:
+        writer = csv.writer(csv_handle, delimiter=',')
+        writer.writerow( l2t_header )
+        timeline = TimeWindow( sorter, utc_time_flag( FLAGS.since ), utc_time_flag( FLAGS.until ))
+        def handle_item( ctx, drive_file, path ):
+            output_lt2_csv(ctx, drive_file, timeline)
+        walk_local_metadata( ctx, handle_item )
+        writer.writerows( sorter.sorted() )
+
+def write_timeline_of_user( user, csv_path ):
+    # in a worker process, which opens its own metadata store.
+    ctx = Ctx( user=user )
+    ctx.metadata_store = new_metadata_store()
+    try:
+        write_timeline( ctx, csv_path )
+    finally:
+        ctx.metadata_store.close()
+    return user
+
+@run_stats.timed( 'output' )
+def output_file_metadata( drive_file, file_attr, writer, metadata_names, output_format=None ):
     data = jsonpath_list( drive_file, metadata_names )
     if writer:
         writer.writerow( data )
     if output_format:
-        print( output_format.format( *[str(i) for i in data] ).rstrip())
-
+        print( format_row( output_format, data ))
     if ( FLAGS.diffs and
         ( drive_file.get('yamlMD5Match') == 'MISMATCH' and file_attr.metadata_file_exists )):
-        print_obj_diffs( drive_file, file_attr.metadata_file )
-    
-def download_file_and_metadata(ctx, drive_file, path, writer, metadata_names, output_format=None):
-    supplement_drive_file_metadata(ctx, drive_file, path)
-    file_attr = FileAttr( drive_file, ctx.user )
+        print_obj_diffs( drive_file, file_attr )
 
-    if not dget( drive_file, 'capabilities.canDownload'):
-        return
+# add kumodd's fields to the metadata of a file, and return the state of its local copy.
+def enrich_file( ctx, drive_file, path ):
+    supplement_drive_file_metadata(ctx, drive_file, path)
+    return FileAttr( ctx, drive_file )
 
-    if not file_attr.valid:
-        ensure_dir(FLAGS.destination + '/' + ctx.user + '/' + path)
-        if not download_file( ctx, drive_file ):
-            logging.critical( f"failed to download: {local_data_dir( drive_file, ctx.user ) + '/' + file_name(drive_file)}")
+# download the file if the local copy is not valid.  Return True if a download was attempted.
+def fetch_file( ctx, drive_file, file_attr ):
+    if file_attr.valid:
+        return False
+    ensure_dir(FLAGS.destination + '/' + ctx.user + '/' + drive_file['path'])
+    if not download_file( ctx, drive_file ):
+        logging.critical( f"failed to download: {local_data_dir( drive_file, ctx.user ) + '/' + file_name(drive_file)}")
+        run_stats.count( 'download_failures' )
+    return True
+
+# compare a file and its metadata to the local copies, after fetch_file(), and save the
+# metadata if the file was fetched.
+def check_file( ctx, drive_file, file_attr, fetched ):
+    if fetched:
         file_attr.update_local( drive_file )
         file_attr.compare_metadata_to_local_file( drive_file )
         update_yamlMetadataMD5( drive_file )
-        save_metadata( drive_file, ctx.user )
+        save_metadata( ctx, drive_file )
 
     else:
         if drive_file['mimeType'].startswith( 'application/vnd.google-apps' ):
@@ -472,22 +826,247 @@ def download_file_and_metadata(ctx, drive_file, path, writer, metadata_names, ou
             drive_file['size'] = file_attr.localSize
 
     file_attr.compare_metadata_to_local_file( drive_file )
-    file_attr.compare_YAML_metadata_MD5( drive_file )
+    file_attr.compare_YAML_metadata_MD5( ctx, drive_file )
 
-    data = jsonpath_list( drive_file, metadata_names )
+# compare a listed file and its metadata to the local copies.
+def check_listed_file( ctx, drive_file, file_attr ):
+    file_attr.compare_metadata_to_local_file( drive_file )
+    file_attr.compare_YAML_metadata_MD5( ctx, drive_file )
 
-    if writer:
-        writer.writerow( data )
-    if output_format:
-        print( output_format.format( *[str(i) for i in data] ).rstrip())
-    if (FLAGS.diffs and
-        drive_file.get('yamlMD5Match') == 'MISMATCH' ):
-        print_obj_diffs( drive_file, file_attr.metadata_file )
+    if drive_file['mimeType'].startswith( 'application/vnd.google-apps' ):
+        # google drive API does not provide size or md5, so use local metadata for them.
+        drive_file['md5Checksum'] = file_attr.md5Local
+        drive_file['size'] = file_attr.localSize
+
+class WorkerCtxs( object ):
+    """Give each worker thread its own clone of a Ctx, created on first use."""
+    def __init__( self, ctx ):
+        self.ctx = ctx
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.ctxs = []
+
+    def get( self ):
+        ctx = getattr( self.local, 'ctx', None )
+        if ctx is None:
+            ctx = self.ctx.clone()
+            with self.lock:
+                self.ctxs.append( ctx )
+            self.local.ctx = ctx
+        return ctx
+
+    def all( self ):
+        with self.lock:
+            return list( self.ctxs )
+
+    # close the ctxs, once their threads are done with them.
+    def close( self ):
+        for ctx in self.all():
+            ctx.close()
+
+class FileItem( object ):
+    """A file passing through a CollectPipeline."""
+    __slots__ = ( 'drive_file', 'path', 'file_attr', 'fetched', 'done' )
+
+    def __init__( self, drive_file, path, done=None ):
+        self.drive_file = drive_file
+        self.path = path
+        self.file_attr = None
+        self.fetched = False
+        self.done = done
+
+    def __repr__( self ):
+        return self.path + '/' + self.drive_file.get( 'name', self.drive_file.get( 'id', '' ))
+
+class CollectPipeline( object ):
+    """List, download, verify and output files in a pipeline of stages.
+
+    The walk of the drive puts each file into the pipeline, which passes it
+    through these stages, each on its own threads:
+
+      enrich: retrieve the revisions of up to -batch_size files in a batch request,
+        add kumodd's fields to the metadata, and hash the local copy, on -enrich_jobs threads.
+      fetch: download the file if the local copy is not valid, on -jobs threads.
+      verify: hash the downloaded file, save its metadata, and compare it to the saved
+        metadata, on -hash_jobs threads.
+      report: write the CSV row and console output, and print metadata differences,
+        on one thread.
+
+    Without download, files are listed: there is no fetch stage, and the verify
+    stage only compares them.  The threads of the enrich and fetch stages each
+    have their own Ctx, since httplib2 is not thread-safe; the verify stage only
+    uses the hash cache and metadata store, which are shared.  If ordered, files
+    are output in the order they were listed, so the CSV and console output are
+    the same as a sequential run.
+    """
+    def __init__( self, ctx, writer, metadata_names, output_format=None, download=True, revisions=True, ordered=True ):
+        self.ctx = ctx
+        self.writer = writer
+        self.metadata_names = metadata_names
+        self.output_format = output_format
+        self.download = download
+        self.revisions = revisions and FLAGS.revisions
+        self.worker_ctxs = WorkerCtxs( ctx )
+        stages = [ Stage( 'enrich', self.enrich, FLAGS.enrich_jobs, FLAGS.batch_size ) ]
+        if download:
+            stages.append( Stage( 'fetch', self.fetch, FLAGS.jobs ))
+        stages.append( Stage( 'verify', self.verify, FLAGS.hash_jobs ))
+        self.pipeline = Pipeline( stages, self.report, FLAGS.queue_size, ordered, self.finish )
+
+    def __enter__( self ):
+        self.pipeline.__enter__()
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        try:
+            self.pipeline.__exit__( exc_type, exc_value, traceback )
+        finally:
+            self.ctx.downloaded += sum( c.downloaded for c in self.worker_ctxs.all() )
+            self.worker_ctxs.close()
+
+    # call done(), if given, once the file has been output.
+    def handle_item( self, ctx, drive_file, path, done=None ):
+        self.pipeline.put( FileItem( drive_file, path, done ))
+
+    def enrich( self, items ):
+        ctx = self.worker_ctxs.get()
+        if self.revisions:
+            download_revisions_metadata_batch( ctx, [ item.drive_file for item in items ])
+        for item in items:
+            item.file_attr = enrich_file( ctx, item.drive_file, item.path )
+        # files that cannot be downloaded are finished only once the batch succeeded,
+        # since the pipeline calls enrich again on each item of a batch that failed.
+        enriched = []
+        for item in items:
+            if self.download and not dget( item.drive_file, 'capabilities.canDownload'):
+                self.finish( item )
+                item = None
+            enriched.append( item )
+        return enriched
+
+    def fetch( self, item ):
+        item.fetched = fetch_file( self.worker_ctxs.get(), item.drive_file, item.file_attr )
+        return item
+
+    def verify( self, item ):
+        if self.download:
+            check_file( self.ctx, item.drive_file, item.file_attr, item.fetched )
+        else:
+            check_listed_file( self.ctx, item.drive_file, item.file_attr )
+        return item
+
+    def report( self, item ):
+        output_file_metadata( item.drive_file, item.file_attr, self.writer, self.metadata_names, self.output_format )
+        self.finish( item )
 
-def save_metadata( drive_file, username ):
-    metadata_path = local_metadata_dir( drive_file, username ) + '/' + file_name(drive_file) + '.yml'
-    ensure_dir(dirname(metadata_path))
-    yaml.dump(drive_file, open(metadata_path, 'w+'), Dumper=yaml.Dumper)
+    def finish( self, item ):
+        if item.done:
+            item.done()
+
+def save_metadata( ctx, drive_file ):
+    ctx.metadata_store.save( ctx.user, metadata_key( drive_file ), drive_file )
+
+# the name of an item in the metadata store: its path relative to the user's folder.
+def metadata_key( drive_file ):
+    return drive_file['path'] + '/' + file_name(drive_file)
+
+class YamlMetadataStore( object ):
+    """Saves the metadata of each item in its own YAML file, under the metadata destination.
+
+    The file of an item is at <metadata_destination>/<user>/<key>.yml, where the key is given
+    by metadata_key().  SqliteMetadataStore has the same interface.
+    """
+    def __init__( self, root=None, max_parsed=1024 ):
+        self.root = root or FLAGS.metadata_destination
+        # recently parsed files, keyed by path, with the stat signature they were parsed at.
+        self.parsed = OrderedDict()
+        self.max_parsed = max_parsed
+        self.lock = threading.Lock()
+
+    def location( self, user, key ):
+        return '/'.join([ self.root, user, key ]) + '.yml'
+
+    def save( self, user, key, drive_file ):
+        metadata_path = self.location( user, key )
+        ensure_dir(dirname(metadata_path))
+        with open(metadata_path, 'w+') as handle:
+            save_yaml(drive_file, handle)
+        with self.lock:
+            self.parsed.pop( os.path.normpath( metadata_path ), None )
+
+    def load( self, user, key ):
+        metadata_path = self.location( user, key )
+        if not os.path.exists( metadata_path ):
+            return None
+        return self.parse( metadata_path )
+
+    # parse a metadata file, unless it was recently parsed and its inode, size and
+    # modification time have not changed since.  The result must not be modified.
+    def parse( self, metadata_path ):
+        metadata_path = os.path.normpath( metadata_path )
+        st = os.stat( metadata_path )
+        signature = ( st.st_ino, st.st_size, st.st_mtime_ns )
+        with self.lock:
+            entry = self.parsed.get( metadata_path )
+            if entry and entry[0] == signature:
+                self.parsed.move_to_end( metadata_path )
+                return entry[1]
+        with open(metadata_path,'rb') as handle:
+            drive_file = load_yaml( handle.read() )
+        with self.lock:
+            self.parsed[metadata_path] = ( signature, drive_file )
+            if len( self.parsed ) > self.max_parsed:
+                self.parsed.popitem( last=False )
+        return drive_file
+
+    # names of the user folders
+    def users( self ):
+        return sorted( dirent.name for dirent in os.scandir( self.root )
+                       if dirent.is_dir() and not dirent.name.startswith('.') )
+
+    def keys( self, user ):
+        yield from self.keys_under( self.root + '/' + user, '.' )
+
+    def keys_under( self, path, key_path ):
+        for dirent in os.scandir( path ):
+            if dirent.is_dir():
+                yield from self.keys_under( path + '/' + dirent.name, key_path + '/' + dirent.name )
+            elif dirent.is_file() and dirent.name.endswith('.yml'):
+                yield key_path + '/' + dirent.name[:-len('.yml')]
+
+    def items( self, user ):
+        for key in self.keys( user ):
+            metadata_path = self.location( user, key )
+            try:
+                drive_file = self.parse( metadata_path )
+            except Exception as e:
+                msg = f"cannot read metadata {metadata_path}, cautght: {e}"
+                print( msg )
+                logging.critical( msg, exc_info=True)
+                continue
+            yield metadata_path, drive_file
+
+    # files are complete when saved
+    def commit( self ):
+        pass
+
+    def close( self ):
+        pass
+
+def new_metadata_store( commit_interval=1000 ):
+    if FLAGS.metadata_store == 'sqlite':
+        return SqliteMetadataStore( FLAGS.metadata_destination + '/.metadata.db', commit_interval=commit_interval )
+    return YamlMetadataStore()
+
+# write each item in the SQLite metadata store to its own YAML file.
+def export_yaml( ctx ):
+    yaml_store = YamlMetadataStore()
+    count = 0
+    for user in ctx.metadata_store.users():
+        for location, drive_file in ctx.metadata_store.items( user ):
+            yaml_store.save( user, metadata_key( drive_file ), drive_file )
+            count += 1
+    print( f'{count} metadata files exported to {FLAGS.metadata_destination}' )
 
 def is_file(item):
     return item['mimeType'] != 'application/vnd.google-apps.folder'
@@ -495,59 +1074,270 @@ def is_file(item):
 def is_folder(item):
     return item['mimeType'] == 'application/vnd.google-apps.folder'
 
-def download_listed_files(ctx, config, metadata_names=None, output_format=None):
-    """Print information about the specified revision.
+# return the index of a column in a CSV header, by its title or its name, or None
+def csv_column( header, config, name ):
+    for title in ( column_title( config, name ), name ):
+        if title in header:
+            return header.index( title )
+    return None
+
+def read_listed_files( config ):
+    """Return the files listed in the CSV files given by -usecsv.
+
+    Returns:
+      an OrderedDict that maps each file ID to the list of its paths, in the
+      order first listed, without duplicates.
+    """
+    listed = OrderedDict()
+    for csv_file in FLAGS.usecsv:
+        with open(csv_file, 'rt') as csv_handle:
+            reader = csv.reader(csv_handle)
+            header = next(reader, None) or []
+            index_of_id = csv_column( header, config, 'id' )
+            index_of_fullpath = csv_column( header, config, 'fullpath' )
+            index_of_path = csv_column( header, config, 'path' )
+            if index_of_id is None or ( index_of_fullpath is None and index_of_path is None ):
+                logging.critical( f"{csv_file} has no file ID column, or no path or full path column." )
+                continue
+            for row in reader:
+                if index_of_fullpath is not None:
+                    path = dirname(row[index_of_fullpath]) or '.'
+                else:
+                    path = row[index_of_path]
+                paths = listed.setdefault( row[index_of_id], [] )
+                if path not in paths:
+                    paths.append( path )
+    return listed
+
+def get_files_batch( ctx, file_ids ):
+    """Retrieve the metadata of files, using batch requests.
+
+    Yields:
+      ( file_id, drive_file ) for each file that was retrieved, in the given order.
+      Transient errors are retried.  Files that cannot be retrieved, because of another
+      error or once the retries are exhausted, are reported once, counted in the run stats
+      as files_not_retrieved, and skipped.
+    """
+    file_ids = list( file_ids )
+    for start in range( 0, len(file_ids), FLAGS.batch_size ):
+        chunk = file_ids[start:start + FLAGS.batch_size]
+        responses = execute_batch(
+            ctx, chunk, lambda file_id: ctx.files.get( fileId=file_id, fields=ctx.file_fields, supportsAllDrives=True ),
+            'listing', 'getting listed files' )
+        for file_id in chunk:
+            drive_file, e = responses[file_id]
+            if e:
+                print( f"cannot get file {file_id}: {e}" )
+                logging.critical( f"Request Failed for file ID: {file_id}: {e}" )
+                run_stats.count( 'files_not_retrieved' )
+                continue
+            yield file_id, drive_file
+
+def download_listed_files(ctx, config, handle_item):
+    """Download the files listed in the CSV files given by -usecsv.
+
+    Each file ID is requested once, in batches, and each file is passed to
+    handle_item once for each of its listed paths.
 
     Args:
         ctx: class Ctx
-        file_id: ID of the file to print revision for.
-        revision_id: ID of the revision to print.
+        config: configuration, used to find the columns by their titles.
+        handle_item: called for each file and path.
+    """
+    listed = read_listed_files( config )
+    for file_id, drive_file in get_files_batch( ctx, listed.keys() ):
+        for i, path in enumerate( listed[file_id] ):
+            handle_item( ctx, drive_file if i == 0 else deepcopy( drive_file ), path )
+
+def execute_batch( ctx, keys, new_request, phase, description ):
+    """Send a request for each key in one batch request, and return { key: ( response, exception ) }.
+
+    Parts that fail with a transient error are sent again in another batch, after a
+    backoff, up to -retries times.  If the batch request fails as a whole, the parts
+    are sent one at a time.
+
+    Args:
+      keys: up to -batch_size keys.
+      new_request: returns a new request for a key.
+      phase: the phase in which the requests are timed.
+      description: what the requests are doing, for the log.
     """
-    local_base_path = FLAGS.destination + '/' + ctx.user
-    with open(FLAGS.usecsv[0], 'rt') as csv_handle:
-        reader = csv.reader(csv_handle)
-        header = next(reader, None)
-        index_of_path = header.index( dget(config, 'column_titles.path'))
-        index_of_id = header.index( dget(config, 'column_titles.id'))
-        for row in reader:
-            path = dirname(row[index_of_path])
+    results = {}
+    pending = list( keys )
+    attempt = 0
+    while pending:
+        responses = {}
+        def callback( request_id, response, exception ):
+            responses[request_id] = ( response, exception )
+        batch = ctx.service.new_batch_http_request( callback=callback )
+        for i, key in enumerate( pending ):
+            batch.add( new_request( key ), request_id=str(i) )
+        try:
+            with run_stats.phase( phase ):
+                batch.execute()
+        except Exception as e:
+            logging.critical( f"Batch request failed while {description}: {e}. Retrying one at a time.", exc_info=True)
+        retry = []
+        for i, key in enumerate( pending ):
+            if str(i) in responses:
+                results[key] = responses[str(i)]
+                if results[key][1] is not None and is_transient( results[key][1] ):
+                    retry.append( key )
+                continue
             try:
-                drive_file = ctx.files.get(fileId=row[index_of_id]).execute()
+                with run_stats.phase( phase ):
+                    results[key] = ( with_backoff( lambda: new_request( key ).execute(), description ), None )
             except Exception as e:
-                print( f'cautght: {e}' )
-                logging.critical( f"Request Failed for: {row}", exc_info=True)
-            if FLAGS.revisions:
-                download_revisions_metadata(ctx, drive_file)
-            download_file_and_metadata( ctx, drive_file, path, None, metadata_names, output_format)
+                results[key] = ( None, e )
+        if retry and backoff( results[retry[0]][1], attempt, f'{description}, for {len( retry )} parts of a batch' ):
+            attempt += 1
+            pending = retry
+        else:
+            pending = []
+    return results
 
-def download_revisions_metadata( ctx, drive_file ):
+def download_revisions_metadata( ctx, drive_file, revisions=None, pageToken=None ):
     """Retrieve a list of revisions.
 
     Args:
     ctx: Ctx context obj
-    file_id: ID of the file to retrieve revisions for.
-    Returns:
-    List of revisions.
+    drive_file: Drive File instance.  The revisions are saved in drive_file['revisions'].
+    revisions: revisions already retrieved, if continuing from pageToken.
+    pageToken: the page of revisions to start from.
     """
     if not dget( drive_file, 'capabilities.canReadRevisions'):
         return
-    revisions = []
-    pageToken = None
+    revisions = revisions or []
     while True: # repeat for each page
         try:
-            result = ctx.revisions.list( fileId=drive_file['id'], fields='*',
-                                        pageSize=1000, pageToken=pageToken ).execute()
+            with run_stats.phase( 'revisions' ):
+                result = with_backoff( lambda: ctx.revisions.list( fileId=drive_file['id'], fields=list_fields( 'revisions', revision_fields() ),
+                                                                   pageSize=1000, pageToken=pageToken ).execute(),
+                                       f"listing the revisions of {drive_file['name']}" )
             if result.get('revisions') and len(result.get('revisions')) > 0:
                 revisions.extend(result.get('revisions'))
             if not result.get('nextPageToken'):
                 break
             pageToken=result.get('nextPageToken')
         except Exception as e:
-            logging.critical( f"Error: cannot download revisions for {drive_file['name']}: {e.content}")
+            logging.critical( f"Error: cannot download revisions for {drive_file['name']}: {getattr(e, 'content', e)}")
             break
     if len(revisions) > 0:
         drive_file['revisions'] = revisions
 
+def download_revisions_metadata_batch( ctx, drive_files ):
+    """Retrieve the revisions of several files, using batch requests.
+
+    The first page of revisions of up to -batch_size files is requested in each
+    batch.  Further pages are requested separately, only for files that have them.
+    Transient errors are retried; the revisions of a file are dropped only on other
+    errors, or when the retries are exhausted.
+    """
+    drive_files = [ f for f in drive_files if dget( f, 'capabilities.canReadRevisions') ]
+    for start in range( 0, len(drive_files), FLAGS.batch_size ):
+        chunk = drive_files[start:start + FLAGS.batch_size]
+        responses = execute_batch(
+            ctx, range( len( chunk )),
+            lambda i: ctx.revisions.list( fileId=chunk[i]['id'], fields=list_fields( 'revisions', revision_fields() ), pageSize=1000 ),
+            'revisions', 'listing revisions' )
+        for i, drive_file in enumerate( chunk ):
+            result, e = responses[i]
+            if e:
+                logging.critical( f"Error: cannot download revisions for {drive_file['name']}: {getattr(e, 'content', e)}")
+                continue
+            if result.get('nextPageToken'):
+                download_revisions_metadata( ctx, drive_file, result.get('revisions'), result.get('nextPageToken') )
+            elif result.get('revisions'):
+                drive_file['revisions'] = result.get('revisions')
+
+# the number of bytes to download for a file: its size, or for a Google Doc, which has
+# none, the storage quota it uses.
+def planned_size( drive_file ):
+    return int( drive_file.get('size') or drive_file.get('quotaBytesUsed') or 0 )
+
+def write_plan( ctx, folder, path, plan_path ):
+    """List the files to download into a plan, without downloading them.
+
+    The file metadata, including the revisions, is saved in the plan, so that
+    executing the plan sends no listing requests.  Files already valid on disk
+    are included, so that their metadata is output and saved when the plan is
+    executed, but they are not counted in the bytes to download.
+    """
+    # request quotaBytesUsed for the size of Google Docs, but do not save it, unless
+    # it was requested anyway.
+    quota_requested = ctx.file_fields == '*' or 'quotaBytesUsed' in ctx.file_fields.split(',')
+    if not quota_requested:
+        ctx.file_fields += ',quotaBytesUsed'
+    with PlanWriter( plan_path, ctx.user ) as plan:
+        def handle_item( ctx, drive_file, path ):
+            if not dget( drive_file, 'capabilities.canDownload'):
+                return
+            size = planned_size( drive_file )
+            if not quota_requested:
+                drive_file.pop( 'quotaBytesUsed', None )
+            supplement_drive_file_metadata( ctx, drive_file, path )
+            plan.add( drive_file, path, size, not FileAttr( ctx, drive_file ).valid )
+
+        with RevisionBatcher( ctx, handle_item ) as batcher:
+            walk_drive( ctx, folder, batcher.handle_item, path )
+    print( plan.summary() )
+
+def execute_plan( ctx, plan_path, writer, metadata_names, output_format=None ):
+    """Download the files in a plan, in the order given by -schedule.
+
+    The files are output as soon as they are done, rather than in the order of the
+    schedule, so that a large file does not hold up the others.
+    """
+    try:
+        plan = Plan( plan_path )
+    except ValueError as e:
+        logging.critical( e )
+        print( f"Error: {e}" )
+        return
+    if plan.user != ctx.user:
+        msg = f"{plan_path} is a plan for {plan.user}, not {ctx.user}"
+        logging.critical( msg )
+        print( f"Error: {msg}" )
+        return
+    with Progress( plan.files, plan.bytes, FLAGS.progress ) as progress:
+        # the plan holds the revisions already.
+        with CollectPipeline( ctx, writer, metadata_names, output_format, revisions=False, ordered=False ) as pipeline:
+            for drive_file, path, size in plan.scheduled( FLAGS.schedule ):
+                pipeline.handle_item( ctx, drive_file, path, lambda size=size: progress.done( size ))
+
+class RevisionBatcher( object ):
+    """Pass items on to handle_item after retrieving their revisions in batches.
+
+    Items are held until -batch_size have accumulated, or the batcher is closed.
+    The order of the items is unchanged.  If -norevisions, items are passed on
+    immediately.
+    """
+    def __init__( self, ctx, handle_item ):
+        self.ctx = ctx
+        self.next_handle_item = handle_item
+        self.items = []
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        if exc_type is None:
+            self.flush()
+
+    def handle_item( self, ctx, drive_file, path ):
+        if not FLAGS.revisions:
+            self.next_handle_item( ctx, drive_file, path )
+            return
+        self.items.append(( drive_file, path ))
+        if len( self.items ) >= FLAGS.batch_size:
+            self.flush()
+
+    def flush( self ):
+        items, self.items = self.items, []
+        download_revisions_metadata_batch( self.ctx, [ drive_file for drive_file, path in items ])
+        for drive_file, path in items:
+            self.next_handle_item( self.ctx, drive_file, path )
+
 def is_native_google_apps(drive_file):
     return drive_file['mimeType'].startswith( 'application/vnd.google-apps' )
 
@@ -593,11 +1383,57 @@ def file_name( drive_file, revision=None ):
         name += '.' + drive_file['fileExtension']
     return name
 
-def local_metadata_dir( drive_file, username ):
-    return '/'.join([ FLAGS.metadata_destination, username, drive_file['path'] ])
-
 from pprint import pprint
 
+# HTTP status codes, and 403 reasons, of errors that may succeed if retried later.
+transient_status = ( 429, 500, 502, 503, 504 )
+transient_reasons = ( 'rateLimitExceeded', 'userRateLimitExceeded', 'backendError' )
+
+# return the reasons given by Google Drive for an HttpError.
+def error_reasons( e ):
+    try:
+        errs = dget( json.loads( e.content ), 'error.errors' ) or []
+    except ( TypeError, ValueError ):
+        return []
+    return [ dget( err, 'reason' ) for err in errs ]
+
+def is_transient( e ):
+    if isinstance( e, errors.HttpError ):
+        if e.resp.status in transient_status:
+            return True
+        return any( reason in transient_reasons for reason in error_reasons( e ))
+    return isinstance( e, ( httplib2.HttpLib2Error, OSError ))
+
+def with_backoff( fn, description, retries=None, max_delay=64 ):
+    """Call fn(), retrying transient errors with exponential backoff.
+
+    The delay doubles after each failed attempt, up to max_delay seconds, and is
+    randomized so that concurrent workers do not retry in step.  Other errors, and
+    the last transient error after the retries are exhausted, are raised.
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            if not backoff( e, attempt, description, retries, max_delay ):
+                raise
+            attempt += 1
+
+def backoff( e, attempt, description, retries=None, max_delay=64 ):
+    """Wait before retrying after error e, on the given attempt, counting from 0.
+
+    Returns False, without waiting, if e is not transient, or the retries are exhausted.
+    """
+    retries = FLAGS.retries if retries is None else retries
+    if attempt >= retries or not is_transient( e ):
+        return False
+    delay = min( 2 ** attempt, max_delay ) * random.uniform( 0.5, 1.0 )
+    logging.warning( f"{e} while {description}. Retrying in {delay:.1f} seconds...")
+    run_stats.count( 'retries' )
+    time.sleep( delay )
+    return True
+
 def download_rev_and_do_md5(ctx, drive_file, rev, file_path):
     if not rev:
         return False
@@ -605,46 +1441,296 @@ def download_rev_and_do_md5(ctx, drive_file, rev, file_path):
         return False
     download_url = rev.get('exportLinks').get( get_export_mime_type(drive_file))
     if not download_url:
-        if Flags.log == 'DEBUG':
+        if FLAGS.log == 'DEBUG':
             print(get_export_mime_type(drive_file))
             dump_yaml( rev, sys.stdout )
         return False
-    while True:
+    if ctx.hash_cache:
+        ctx.hash_cache.forget( file_path )
+    if link_from_blob_store( ctx, rev.get('md5Checksum'), file_path, rev.get('size') ):
+        set_file_times( file_path, drive_file, rev )
+        return True
+    request = HttpRequest( ctx.http, lambda resp, content: content, download_url )
+    # exports are generated on request, and have no size or MD5, so they are not resumed.
+    partial = PartialDownload( file_path, rev, resumable=False )
+    try:
+        size, md5_of_data = stream_download( request, partial, None )
+    except Exception as e:
+        logging.critical( f"cannot download {file_path}: {e}", exc_info=True)
+        partial.discard()
+        run_stats.count( 'download_failures' )
+        return False
+    rev['md5Checksum'] = md5_of_data
+    add_to_blob_store( ctx, file_path, md5_of_data )
+    set_file_times( file_path, drive_file, rev )
+    return True
+
+# place the file from the blob store, rather than downloading it, if its MD5 is known
+# and its content, of size bytes if known, is stored.
+def link_from_blob_store( ctx, md5_of_data, file_path, size=None ):
+    if not ( ctx.blob_store and ctx.blob_store.has( md5_of_data, size )):
+        return False
+    try:
+        return ctx.blob_store.link( md5_of_data, file_path, size )
+    except OSError as e:
+        logging.critical( f"cannot link {file_path} from the blob store: {e}")
+        return False
+
+def add_to_blob_store( ctx, file_path, md5_of_data ):
+    if ctx.blob_store:
+        try:
+            ctx.blob_store.add( file_path, md5_of_data )
+        except OSError as e:
+            logging.critical( f"cannot add {file_path} to the blob store: {e}")
+
+def download_revisions( ctx, drive_file ):
+    """Download the revisions of a file, up to -revision_jobs at a time."""
+    revisions = drive_file.get('revisions')
+    paths = [ local_data_dir( drive_file, ctx.user ) + '/' + file_name( drive_file, rev ) for rev in revisions ]
+    if FLAGS.revision_jobs > 1 and len( revisions ) > 1:
+        executor, worker_ctxs = revision_workers( ctx )
+        list( executor.map( lambda rev, path: download_revision( worker_ctxs.get(), drive_file, rev, path ),
+                            revisions, paths ))
+    else:
+        for rev, path in zip( revisions, paths ):
+            download_revision( ctx, drive_file, rev, path )
+
+def download_revision( ctx, drive_file, rev, file_path ):
+    with path_locks.locked( file_path ):
+        return download_rev_and_do_md5( ctx, drive_file, rev, file_path )
+
+class PathLocks( object ):
+    """A lock for each local path being written.
+
+    Files of the same name in sibling folders are saved to the same path, so that
+    concurrent workers may download two of them at once.  Each waits for the other,
+    rather than both writing the same .part file.
+    """
+    def __init__( self ):
+        self.lock = threading.Lock()
+        self.locks = {} # path: [ lock, number of threads using it ]
+
+    @contextmanager
+    def locked( self, path ):
+        with self.lock:
+            entry = self.locks.setdefault( path, [ threading.Lock(), 0 ] )
+            entry[1] += 1
         try:
-            resp, content = ctx.http.request(download_url)
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.locks[ path ]
+
+path_locks = PathLocks()
+
+# return the ctx's pool of revision download threads, creating it on first use.  A
+# download worker's ctx has its own pool, so its revisions are not queued behind
+# those of other files.
+def revision_workers( ctx ):
+    if ctx.revision_executor is None:
+        ctx.revision_ctxs = WorkerCtxs( ctx )
+        ctx.revision_executor = ThreadPoolExecutor( max_workers=FLAGS.revision_jobs )
+    return ctx.revision_executor, ctx.revision_ctxs
+
+class DownloadMismatch( Exception ):
+    pass
+
+class PartialDownload( object ):
+    """A download in progress, written to <file>.part, and renamed to <file> when complete.
+
+    After each chunk, the data is flushed to disk, and a journal, <file>.part.yml,
+    records the file's identity, the offset confirmed on disk, and the MD5 of the data up
+    to that offset.  If a download is interrupted, a retry or a later run resumes at the
+    confirmed offset, provided the file has not changed in Google Drive.  The MD5 of the
+    existing data is recomputed from the .part file, and checked against the journal.
+    """
+    def __init__( self, path, drive_file, resumable ):
+        self.path = path
+        self.part_path = path + '.part'
+        self.journal_path = path + '.part.yml'
+        self.resumable = resumable
+        self.identity = { name: drive_file.get( name ) for name in ( 'id', 'size', 'md5Checksum', 'modifiedTime' ) }
+
+    # return the confirmed offset and MD5 of the data before it, or ( 0, None ) if the
+    # download cannot be resumed.
+    def resume_point( self ):
+        if not ( self.resumable and os.path.exists( self.journal_path ) and os.path.exists( self.part_path )):
+            return 0, None
+        try:
+            with open( self.journal_path ) as handle:
+                journal = yaml.safe_load( handle )
+            offset = int( journal['offset'] )
+            if any( journal.get( name ) != value for name, value in self.identity.items() ):
+                return 0, None
+            if os.path.getsize( self.part_path ) < offset:
+                return 0, None
         except Exception as e:
-            logging.critical( f"Exception {e} while reading {file_path}. Retrying...", exc_info=True)
-            continue
-        if resp.status == 200:
-            rev['md5Checksum'] = md5hex( content )
-            try:
-                with open( file_path, 'wb+' ) as handle:
-                    handle.write( content )
-                    return True
-            except Exception as e:
-                logging.critical( f"Cannot open {file_path} for writing: {e}", exc_info=True)
-                return False
+            logging.critical( f"cannot read {self.journal_path}: {e}", exc_info=True)
+            return 0, None
+        m = md5()
+        with open_noatime( self.part_path ) as f:
+            remaining = offset
+            while remaining > 0:
+                data = f.read( min( remaining, FLAGS.hash_chunk_size ))
+                if not data:
+                    return 0, None
+                m.update( data )
+                remaining -= len( data )
+        if m.hexdigest() != journal.get( 'md5' ):
+            logging.critical( f"discarding {self.part_path}, which does not match its journal." )
+            return 0, None
+        return offset, m
+
+    # open the .part file, and return it and the MD5 of its contents, positioned to append.
+    def open( self ):
+        offset, m = self.resume_point()
+        if offset:
+            f = open( self.part_path, 'r+b' )
+            f.truncate( offset )
+            f.seek( offset )
+            return f, m
+        self.remove_journal()
+        return open( self.part_path, 'wb+' ), md5()
+
+    # record that the data written so far is on disk.
+    def confirm( self, f, m ):
+        if not self.resumable:
+            return
+        f.flush()
+        os.fsync( f.fileno() )
+        journal = dict( self.identity, offset=f.tell(), md5=m.hexdigest() )
+        with open( self.journal_path + '.tmp', 'w' ) as handle:
+            dump_yaml( journal, handle )
+        os.replace( self.journal_path + '.tmp', self.journal_path )
+
+    # rename the .part file into place if its size and MD5 are as expected, otherwise
+    # discard it and raise DownloadMismatch.
+    def finish( self, size, md5_of_data ):
+        expected_size = self.identity['size']
+        expected_md5 = self.identity['md5Checksum']
+        if ( expected_size is not None and int( expected_size ) != size ) or ( expected_md5 and expected_md5 != md5_of_data ):
+            self.discard()
+            raise DownloadMismatch( f"downloaded {size} bytes with MD5 {md5_of_data}, expected {expected_size} bytes with MD5 {expected_md5}" )
+        os.replace( self.part_path, self.path )
+        self.remove_journal()
+
+    def discard( self ):
+        if os.path.exists( self.part_path ):
+            os.remove( self.part_path )
+        self.remove_journal()
+
+    def remove_journal( self ):
+        if os.path.exists( self.journal_path ):
+            os.remove( self.journal_path )
+
+class DownloadSink( object ):
+    """Hashes and writes each chunk of a download as it is received."""
+    def __init__( self, f, m ):
+        self.f = f
+        self.m = m
+
+    def write( self, data ):
+        self.m.update( data )
+        return self.f.write( data )
+
+min_chunk_size = 256*1024
+# aim for each chunk request to take this many seconds.
+chunk_seconds = 2.0
+
+# return the size of the next chunk, given the time taken by the last, so that slow
+# connections use small chunks and fast ones amortize the latency of each request over
+# large ones.  The size changes by at most a factor of 4 each time, and is rounded to a
+# multiple of min_chunk_size.
+def next_chunk_size( chunk_size, received, seconds, max_chunk_size ):
+    if received < chunk_size or seconds <= 0:
+        return chunk_size
+    factor = min( max( chunk_seconds / seconds, 0.25 ), 4 )
+    low = min( min_chunk_size, max_chunk_size )
+    size = int( chunk_size * factor ) // low * low
+    return min( max( size, low ), max_chunk_size )
+
+# the size of the first chunk: the whole file if that is allowed, otherwise a quarter of
+# the maximum.  The size of an export is not known in advance.
+def first_chunk_size( size, max_chunk_size ):
+    if size is None:
+        return max_chunk_size
+    if 0 < size <= max_chunk_size:
+        return size
+    return max( min( min_chunk_size, max_chunk_size ), max_chunk_size // 4 )
 
 def download_file_and_do_md5(ctx, drive_file, rev, path, acknowledgeAbuse=False):
     if drive_file['mimeType'].startswith( 'application/vnd.google-apps' ):
         request = ctx.files.export_media(fileId=drive_file['id'],
                                          mimeType=get_export_mime_type(drive_file))
+        # exports are generated on request, and have no size or MD5, so they are not resumed.
+        partial = PartialDownload( path, drive_file, resumable=False )
+        size = None
     else:
         request = ctx.files.get_media(fileId=drive_file['id'],
                                       acknowledgeAbuse=acknowledgeAbuse)
+        partial = PartialDownload( path, drive_file, resumable=True )
         size = int(drive_file['size'])
-    m = md5()
-    with open(path, 'wb+') as f, io.BytesIO() as fh:
-        chunksize=16*1024*1024
-        downloader = MediaIoBaseDownload(fh, request, chunksize=chunksize)
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk( num_retries = 2 )
-            with fh.getbuffer()[:fh.tell()] as buf:
-                m.update( buf )
-                f.write( buf )
-            fh.seek(0)
-        return [ f.tell(), m.hexdigest() ]
+    return stream_download( request, partial, size )
+
+# the request headers that apply to the API's JSON responses, rather than to media.
+json_headers = ( 'accept', 'accept-encoding', 'user-agent' )
+
+# request up to chunk_size bytes of the media of request, starting at offset, and write
+# them to sink.  Returns the number of bytes received, and the size of the whole
+# media, or None if the response does not give it.  Errors are raised, to be retried by the caller.
+def get_media_chunk( request, sink, offset, chunk_size ):
+    headers = { name: value for name, value in request.headers.items() if name.lower() not in json_headers }
+    headers['range'] = f'bytes={offset}-{offset + chunk_size - 1}'
+    resp, content = request.http.request( request.uri, 'GET', headers=headers )
+    total = resp.get( 'content-range', '' ).rsplit( '/', 1 )[-1]
+    total = int( total ) if total.isdigit() else None
+    if resp.status == 416 and total == 0:
+        # the range of an empty file cannot be satisfied.
+        return 0, 0
+    if resp.status not in ( 200, 206 ):
+        raise errors.HttpError( resp, content, uri=request.uri )
+    if resp.status == 200:
+        if offset > 0:
+            raise DownloadMismatch( f'the server sent the whole file, rather than the range starting at {offset}' )
+        total = len( content )
+    if 'content-location' in resp:
+        request.uri = resp['content-location']
+    sink.write( content )
+    return len( content ), total
+
+@run_stats.timed( 'download' )
+def stream_download( request, partial, size ):
+    """Stream the response to request into partial, a chunk at a time.
+
+    A chunk that fails with a transient error is requested again with backoff, up to
+    -retries times, so that a retry resumes where the download stopped.
+
+    Returns:
+      [ length, MD5 ] of the downloaded data.
+    """
+    f, m = partial.open()
+    with f:
+        sink = DownloadSink( f, m )
+        remaining = size - f.tell() if size is not None else None
+        chunk_size = first_chunk_size( remaining, FLAGS.download_chunk_size )
+        # a resumed download starts at the confirmed offset.
+        done = size is not None and f.tell() > 0 and f.tell() >= size
+        while not done:
+            start_time = time.perf_counter()
+            received, total = with_backoff( lambda: get_media_chunk( request, sink, f.tell(), chunk_size ),
+                                            f'downloading {partial.path}' )
+            # without the size, the end is the first chunk that is short.
+            done = received < chunk_size if total is None else received == 0 or f.tell() >= total
+            if not done:
+                partial.confirm( f, m )
+                chunk_size = next_chunk_size( chunk_size, received, time.perf_counter() - start_time,
+                                              FLAGS.download_chunk_size )
+        length = f.tell()
+    partial.finish( length, m.hexdigest() )
+    return [ length, m.hexdigest() ]
 
 def download_file( ctx, drive_file, revision=None ):
     """Download a file's content.
@@ -659,40 +1745,48 @@ def download_file( ctx, drive_file, revision=None ):
     """
 
     file_path = local_data_dir( drive_file, ctx.user ) + '/' + file_name(drive_file, revision)
-
     if FLAGS.revisions and not revision and drive_file.get('revisions'):
-        for rev in drive_file.get('revisions'):
-            download_rev_and_do_md5(
-                ctx, drive_file, rev, 
-                local_data_dir( drive_file, ctx.user ) + '/' + file_name(drive_file, rev) )
+        download_revisions( ctx, drive_file )
+
+    with path_locks.locked( file_path ):
+        return download_to_path( ctx, drive_file, revision, file_path )
+
+def download_to_path( ctx, drive_file, revision, file_path ):
+    if ctx.hash_cache:
+        ctx.hash_cache.forget( file_path )
+
+    if link_from_blob_store( ctx, ( revision or drive_file ).get('md5Checksum'), file_path, ( revision or drive_file ).get('size') ):
+        set_file_times( file_path, drive_file, revision )
+        return True
 
     acknowledgeAbuse = False
+    mismatches = 0
     while True:
         try:
             size, md5_of_data = download_file_and_do_md5(
-                ctx, drive_file, rev, file_path, acknowledgeAbuse=acknowledgeAbuse )
-        except errors.HttpError as e:
-            if e.resp.status == 403:
-                errs = dget(json.loads(e.content), 'error.errors')
-                if errs is None:
-                    print( f"Exception {e} while downloading {file_path}. Retrying...")
-                    continue
-                elif 'fileNotExportable' in [dget(err, 'reason') for err in errs]:
-                    logging.critical( f"File not exportable: {file_path}")
-                    return
-                elif 'cannotDownloadAbusiveFile' in [dget(err, 'reason') for err in errs]:
-                    logging.critical( f"File flagged as malware or spam: {file_path}")
-                    acknowledgeAbuse = True
-                    continue
-                else:
-                    logging.critical( f"cannot download {file_path}: " + ' '.join([i['message'] for i in errs]))
-                    return
-            else:
-                logging.critical( f"Exception {e} while downloading {file_path}. Retrying...", exc_info=True)
-                continue
-        except Exception as e:
-            logging.critical( f"Exception {e} while downloading {file_path}. Retrying...", exc_info=True)
+                ctx, drive_file, revision, file_path, acknowledgeAbuse=acknowledgeAbuse )
+        except DownloadMismatch as e:
+            # the partial file has been discarded, so a retry starts from the beginning.
+            mismatches += 1
+            if mismatches > 1:
+                logging.critical( f"cannot download {file_path}: {e}")
+                return False
+            logging.critical( f"{e} while downloading {file_path}. Retrying...")
+            run_stats.count( 'retries' )
             continue
+        except Exception as e:
+            reasons = error_reasons( e ) if isinstance( e, errors.HttpError ) else []
+            if 'fileNotExportable' in reasons:
+                logging.critical( f"File not exportable: {file_path}")
+                return False
+            if 'cannotDownloadAbusiveFile' in reasons and not acknowledgeAbuse:
+                logging.critical( f"File flagged as malware or spam: {file_path}")
+                acknowledgeAbuse = True
+                continue
+            # stream_download has retried transient errors, so this one is not, or
+            # persists.
+            logging.critical( f"cannot download {file_path}: {e}", exc_info=not isinstance( e, errors.HttpError ))
+            return False
         ctx.downloaded += 1
         if revision:
             revision['size'] = size
@@ -702,34 +1796,39 @@ def download_file( ctx, drive_file, revision=None ):
                 drive_file['size'] = size
             if drive_file.get('md5Checksum') is None:
                 drive_file['md5Checksum'] = md5_of_data
+        add_to_blob_store( ctx, file_path, md5_of_data )
+        set_file_times( file_path, drive_file, revision )
+        return True
+
+def set_file_times( file_path, drive_file, revision=None ):
+    """Set the file's modify time to that of the revision, if any, else that of the drive_file."""
+    try:
+        # time stamps set on exported files
+        if revision:
+            modify_time = sec_since_epoch( revision.get( 'modifiedTime' ))
+        else:
+            modify_time = sec_since_epoch( drive_file.get( 'modifiedTime' ))
+        access_time = sec_since_epoch( drive_file.get( 'viewedByMeTime' ))
+        create_time = sec_since_epoch( drive_file.get( 'createdTime' ))
+        os.utime(file_path, (access_time, modify_time))
+    except Exception as e:
+        logging.critical( f"While setting file times, got exception: {e}", exc_info=True)
+
+    if platform.system() == 'Windows':
         try:
-            # time stamps set on exported files
-            if revision:
-                modify_time = sec_since_epoch( revision.get( 'modifiedTime' ))
-            else:
-                modify_time = sec_since_epoch( drive_file.get( 'modifiedTime' ))
-            access_time = sec_since_epoch( drive_file.get( 'viewedByMeTime' ))
-            create_time = sec_since_epoch( drive_file.get( 'createdTime' ))
-            os.utime(file_path, (access_time, modify_time))
+            # Use Win 32 API to set timestamp. Note this is unreliable,
+            # so we only use thi s to set the create timne.
+            handle = win32file.CreateFile(
+                file_path, win32con.GENERIC_WRITE,
+                win32con.FILE_SHARE_READ | win32con.FILE_SHARE_WRITE | win32con.FILE_SHARE_DELETE,
+                None, win32con.OPEN_EXISTING,
+                win32con.FILE_ATTRIBUTE_NORMAL, None)
+            win32file.SetFileTime(handle, pywintypes.Time(create_time), None, None, UTCTimes=True)
+            handle.close()
         except Exception as e:
             logging.critical( f"While setting file times, got exception: {e}", exc_info=True)
-
-        if platform.system() == 'Windows':
-            try:
-                # Use Win 32 API to set timestamp. Note this is unreliable,
-                # so we only use thi s to set the create timne.
-                handle = win32file.CreateFile(
-                    file_path, win32con.GENERIC_WRITE,
-                    win32con.FILE_SHARE_READ | win32con.FILE_SHARE_WRITE | win32con.FILE_SHARE_DELETE,
-                    None, win32con.OPEN_EXISTING,
-                    win32con.FILE_ATTRIBUTE_NORMAL, None)
-                win32file.SetFileTime(handle, pywintypes.Time(create_time), None, None, UTCTimes=True)
-                handle.close()
-            except Exception as e:
-                logging.critical( f"While setting file times, got exception: {e}", exc_info=True)
-            finally:
-                handle.close()
-        return True
+        finally:
+            handle.close()
 
 query_by_filter = {
     'doc':   "mimeType = 'application/msword' or  mimeType = 'application/vnd.openxmlformats-officedocument.wordprocessingml' or mimeType = 'application/vnd.ms-word' or mimeType = 'application/vnd.google-apps.document'",
@@ -750,22 +1849,27 @@ def get_query_from_filters():
     else:
         return None
 
-def walk_folders( ctx, folder, handle_item, path=None ):
-    if path is None:
-        path = '.'
-    query = f"'{folder['id']}' in parents"
-    file_query = None
+# path of the items within a subfolder of folder, given the path of folder's items.  As
+# in earlier releases, a subfolder's items are saved under the name of the folder
+# containing it, so that collected trees keep their layout.
+def folder_path( path, folder ):
+    return path + '/' + folder['name'].replace( '/', '_' )
+
+# return a files.list query that selects folders, and files that match the -download or
+# -list filter and the -query option.
+def folder_or_file_query():
     filters = get_query_from_filters()
-    if filters or FLAGS.query:
-        limiters = []
-        filters		and limiters.append( filters )
-        FLAGS.query	and limiters.append( FLAGS.query )
-        file_query = "( " + " ) and ( ".join(limiters) + " )"
-        query += f" and (( mimeType = 'application/vnd.google-apps.folder' ) or {file_query} )"
-        
+    if not ( filters or FLAGS.query ):
+        return None
+    limiters = []
+    filters		and limiters.append( filters )
+    FLAGS.query	and limiters.append( FLAGS.query )
+    file_query = "( " + " ) and ( ".join(limiters) + " )"
+    return f"( mimeType = 'application/vnd.google-apps.folder' ) or {file_query}"
+
+def list_param( ctx, query ):
     param = {
-        'fields': '*',
-        'q': query,
+        'fields': list_fields( 'files', ctx.file_fields ),
         'orderBy': 'name',
         'includeItemsFromAllDrives': True,
         'supportsAllDrives': True,
@@ -775,68 +1879,652 @@ def walk_folders( ctx, folder, handle_item, path=None ):
         'spaces': FLAGS.spaces,
         'pageSize': 1000,
     }
+    if query:
+        param['q'] = query
+    return param
+
+# yield each page of the items in a folder, as a list of files and a list of folders,
+# each sorted by name.
+def folder_pages( ctx, folder ):
+    query = f"'{folder['id']}' in parents"
+    item_query = folder_or_file_query()
+    if item_query:
+        query += f" and ( {item_query} )"
+    param = list_param( ctx, query )
     while True: # repeat for each page
         try:
-            file_list = ctx.files.list(**param).execute()
+            with run_stats.phase( 'listing' ):
+                file_list = ctx.files.list(**param).execute()
         except errors.HttpError as e:
             msg = f"Cannot list contents of folder {folder['name']}: {dget(json.loads(e.content), 'error.message')}"
             logging.critical( msg )
             break
-        filename = folder['name'].replace( '/', '_' )
-        for item in sorted(filter(is_file, file_list['files']), key=lambda i:i['name']):
+        yield ( sorted(filter(is_file, file_list['files']), key=lambda i:i['name']),
+                sorted(filter(is_folder, file_list['files']), key=lambda i:i['name']) )
+        if file_list.get('nextPageToken'):
+            param['pageToken'] = file_list.get('nextPageToken')
+        else:
+            break
+
+def walk_folders( ctx, folder, handle_item, path=None ):
+    if path is None:
+        path = '.'
+    for files, folders in folder_pages( ctx, folder ):
+        for item in files:
             handle_item( ctx, item, path )
-        for item in sorted(filter(is_folder, file_list['files']), key=lambda i:i['name']):
-            walk_folders( ctx, item, handle_item, path + '/' + filename )
+        for item in folders:
+            walk_folders( ctx, item, handle_item, folder_path( path, folder ))
+
+def walk_folders_concurrently( ctx, folder, handle_item, path=None, jobs=4, ordered=True, window=None ):
+    """Like walk_folders, but list up to jobs folders at a time on worker threads.
+
+    handle_item is called on the calling thread.  If ordered, items are handled in
+    the same order as walk_folders, and the folders next in that order are listed
+    first, else items are handled in the order their folders are listed.
+
+    At most window folders, 4 * jobs by default, are listed ahead of the items
+    being handled, so that when handle_item waits, eg. on a full pipeline, the
+    listing waits too, rather than holding the whole tree in memory.
+    """
+    if path is None:
+        path = '.'
+    window = window or 4 * jobs
+    worker_ctxs = WorkerCtxs( ctx )
+    # return the pages of a folder, each a list of files and a list of subfolders.
+    def list_folder( folder ):
+        return list( folder_pages( worker_ctxs.get(), folder ))
+
+    try:
+        with ThreadPoolExecutor( max_workers=jobs ) as executor:
+            if ordered:
+                # the folders and pages of files to visit, the next last, each as
+                # [ folder, path, future of its pages ] or [ None, path, files ].
+                stack = [[ folder, path, None ]]
+                listing = 0 # folders listed or being listed, and not yet visited
+                while stack:
+                    # list the next window folders, as far as the window allows, and
+                    # always the next one, so that the walk does not wait on itself.
+                    seen = 0
+                    for entry in reversed( stack ):
+                        if seen == window:
+                            break
+                        if entry[0] is None:
+                            continue
+                        seen += 1
+                        if entry[2] is None and ( listing < window or entry is stack[-1] ):
+                            entry[2] = executor.submit( list_folder, entry[0] )
+                            listing += 1
+                    item, item_path, result = stack.pop()
+                    if item is None:
+                        for file in result:
+                            handle_item( ctx, file, item_path )
+                        continue
+                    pages = result.result()
+                    listing -= 1
+                    for files, folders in reversed( pages ):
+                        stack.extend( [ subfolder, folder_path( item_path, item ), None ] for subfolder in reversed( folders ))
+                        stack.append( [ None, item_path, files ] )
+            else:
+                waiting = [( folder, path )] # folders not yet listed, the next last
+                pending = {}
+                while waiting or pending:
+                    while waiting and len( pending ) < window:
+                        item, item_path = waiting.pop()
+                        pending[ executor.submit( list_folder, item ) ] = ( item, item_path )
+                    done, not_done = wait( pending, return_when=FIRST_COMPLETED )
+                    for future in done:
+                        listed, item_path = pending.pop( future )
+                        for files, folders in future.result():
+                            for item in files:
+                                handle_item( ctx, item, item_path )
+                            waiting.extend(( subfolder, folder_path( item_path, listed )) for subfolder in reversed( folders ))
+    finally:
+        worker_ctxs.close()
+
+def walk_flat( ctx, folder, handle_item, path=None ):
+    """Like walk_folders, but list the whole corpus in one paged query.
+
+    The folder tree is rebuilt in memory from each item's parents, and then items
+    are visited in the same order, with the same paths, as walk_folders.  This
+    makes a few requests per thousand items, rather than at least one per
+    folder, at the cost of holding the metadata of the whole corpus in memory.
+    """
+    if path is None:
+        path = '.'
+    param = list_param( ctx, folder_or_file_query() )
+    del param['orderBy']
+    children = {}
+    while True: # repeat for each page
+        try:
+            with run_stats.phase( 'listing' ):
+                file_list = ctx.files.list(**param).execute()
+        except errors.HttpError as e:
+            logging.critical( f"Cannot list files: {dget(json.loads(e.content), 'error.message')}" )
+            return
+        for item in file_list['files']:
+            for i, parent in enumerate( item.get('parents', [])):
+                # an item in several folders is handled once per folder, each with its own path.
+                children.setdefault( parent, [] ).append( item if i == 0 else deepcopy( item ))
         if file_list.get('nextPageToken'):
             param['pageToken'] = file_list.get('nextPageToken')
         else:
             break
 
-def walk_local_metadata( ctx, handle_item, path ):
-    for dirent in os.scandir( path ):
-        if dirent.is_dir():
-            walk_local_metadata( ctx, handle_item, path + '/' + dirent.name )
-        elif dirent.is_file():
+    visited = set()
+    def visit( folder, path ):
+        visited.add( folder['id'] )
+        items = children.get( folder['id'], [] )
+        for item in sorted(filter(is_file, items), key=lambda i:i['name']):
+            handle_item( ctx, item, path )
+        for item in sorted(filter(is_folder, items), key=lambda i:i['name']):
+            if item['id'] not in visited:
+                visit( item, folder_path( path, folder ))
+    visit( folder, path )
+
+# walk the folder using the method selected by -walk
+def walk_drive( ctx, folder, handle_item, path=None ):
+    if FLAGS.walk == 'flat':
+        walk_flat( ctx, folder, handle_item, path )
+    elif FLAGS.walk_jobs > 1:
+        walk_folders_concurrently( ctx, folder, handle_item, path, FLAGS.walk_jobs, FLAGS.ordered )
+    else:
+        walk_folders( ctx, folder, handle_item, path )
+
+def sync_state_file( ctx ):
+    return FLAGS.metadata_destination + '/.sync/' + ctx.user + '.yml'
+
+class FolderPaths( object ):
+    """Find the local path of a drive item from its parents, as walk_folders would.
+
+    Folder names and parents are requested once per folder and cached.  Items
+    outside the top folder have no path.
+    """
+    def __init__( self, ctx, top_folder, top_path ):
+        self.ctx = ctx
+        self.top_folder = top_folder
+        self.paths = { top_folder['id']: top_path }
+        self.folders = { top_folder['id']: top_folder }
+        self.outside = set()
+
+    # return the path of the items in the folder, or None if it is outside the top folder.
+    def path_of( self, folder_id ):
+        chain = []
+        while folder_id not in self.paths:
+            if folder_id in self.outside:
+                break
             try:
-                drive_file = redacted_dict(yaml.safe_load(open(path + '/' + dirent.name,'rb').read()))
+                folder = with_backoff( self.ctx.files.get( fileId=folder_id, fields='id,name,parents', supportsAllDrives=True ).execute,
+                                       f'getting folder {folder_id}' )
+            except errors.HttpError as e:
+                logging.critical( f"Cannot get folder {folder_id}: {dget(json.loads(e.content), 'error.message')}" )
+                break
+            chain.append( folder )
+            if not folder.get('parents'):
+                break
+            folder_id = folder['parents'][0]
+        path = self.paths.get( folder_id )
+        parent = self.folders.get( folder_id )
+        for folder in reversed( chain ):
+            if path is None:
+                self.outside.add( folder['id'] )
+            else:
+                path = folder_path( path, parent )
+                self.paths[ folder['id'] ] = path
+                self.folders[ folder['id'] ] = folder
+            parent = folder
+        return path
+
+    # return the folder, whose path was found by path_of().
+    def folder( self, folder_id ):
+        return self.folders[ folder_id ]
+
+    # forget cached paths, eg. because a folder was renamed or moved.
+    def reset( self ):
+        top_id = self.top_folder['id']
+        self.paths = { top_id: self.paths[top_id] }
+        self.folders = { top_id: self.top_folder }
+        self.outside = set()
+
+def sync_filter_matches( drive_file ):
+    if is_folder( drive_file ) or get_query_from_filters() is None:
+        return True
+    return file_type_from_mime( drive_file['mimeType'] ) == ( FLAGS.download or FLAGS.list )
+
+def sync_folders( ctx, folder, handle_item, path ):
+    """Like walk_folders, but visit only items that changed since the previous sync.
+
+    The first run walks all folders.  It saves the changes feed start page token,
+    obtained before the walk, in the metadata destination.  Later runs read the
+    changes feed from that token, and visit each added, modified or trashed item.
+    Removed items are reported, but local copies are kept.  If a folder changed,
+    for instance renamed or moved, its contents are walked again.
+
+    Returns the new state, which save_sync_state() saves once the visited items have
+    been downloaded, so that the next run does not skip items that were not.
+    """
+    state_file = sync_state_file( ctx )
+    state = { 'folderId': folder['id'], 'filter': FLAGS.download or FLAGS.list }
+    saved_state = yaml.safe_load( open( state_file, 'r' )) if os.path.exists( state_file ) else None
+    new_token = with_backoff( ctx.service.changes().getStartPageToken( supportsAllDrives=True ).execute,
+                              'getting the changes start page token' )['startPageToken']
+
+    if saved_state is None or any( saved_state.get(k) != v for k, v in state.items() ):
+        walk_drive( ctx, folder, handle_item, path )
+    else:
+        seen = set()
+        def handle_once( ctx, drive_file, path ):
+            if ( drive_file['id'], path ) not in seen:
+                seen.add(( drive_file['id'], path ))
                 handle_item( ctx, drive_file, path )
+
+        folder_paths = FolderPaths( ctx, folder, path )
+        param = {
+            'fields': list_fields( 'changes', f'changeType,fileId,removed,file({ctx.file_fields})'
+                                   if ctx.file_fields != '*' else '*', 'nextPageToken,newStartPageToken' ),
+            'pageToken': saved_state['startPageToken'],
+            'includeRemoved': True,
+            'includeItemsFromAllDrives': True,
+            'supportsAllDrives': True,
+            'spaces': FLAGS.spaces,
+            'pageSize': 1000,
+        }
+        while True: # repeat for each page
+            with run_stats.phase( 'listing' ):
+                result = with_backoff( ctx.service.changes().list( **param ).execute, 'listing changes' )
+            for change in result.get('changes', []):
+                if change.get('changeType', 'file') != 'file':
+                    continue
+                drive_file = change.get('file')
+                if change.get('removed') or drive_file is None:
+                    print( f"removed: {change.get('fileId')}" )
+                    continue
+                if not sync_filter_matches( drive_file ):
+                    continue
+                if is_folder( drive_file ):
+                    folder_paths.reset()
+                for parent in drive_file.get('parents', []):
+                    parent_path = folder_paths.path_of( parent )
+                    if parent_path is None:
+                        continue
+                    if is_folder( drive_file ):
+                        walk_folders( ctx, drive_file, handle_once, folder_path( parent_path, folder_paths.folder( parent )))
+                    else:
+                        handle_once( ctx, deepcopy( drive_file ), parent_path )
+            if result.get('nextPageToken'):
+                param['pageToken'] = result.get('nextPageToken')
+            else:
+                new_token = result.get('newStartPageToken', new_token)
+                break
+
+    state['startPageToken'] = new_token
+    return state
+
+def save_sync_state( ctx, state ):
+    state_file = sync_state_file( ctx )
+    ensure_dir( dirname( state_file ))
+    with open( state_file, 'w' ) as handle:
+        dump_yaml( state, handle )
+
+def verify_item( ctx, drive_file, writer, metadata_names, output_format=None ):
+    file_attr = FileAttr( ctx, drive_file )
+    file_attr.compare_metadata_to_local_file( drive_file )
+    file_attr.compare_YAML_metadata_MD5( ctx, drive_file )
+    if FLAGS.revisions:
+        verify_revisions( ctx, drive_file)
+    if drive_file['status'] == 'INVALID':
+        print(22*'_', ' drive_file ', drive_file['fullpath'])
+        dump(drive_file, output=sys.stdout)
+        print(11*'_', ' file attr ', drive_file['fullpath'])
+        dump(file_attr, output=sys.stdout)
+    with run_stats.phase( 'output' ):
+        data = jsonpath_list( drive_file, metadata_names )
+        if writer:
+            writer.writerow( data )
+        if output_format:
+            print( format_row( output_format, data ))
+    if (FLAGS.diffs and
+        drive_file.get('yamlMD5Match') == 'MISMATCH' ):
+        print_obj_diffs( drive_file, file_attr )
+    return file_attr
+
+# collects the CSV rows written by a verify worker
+class RowList( object ):
+    def __init__( self ):
+        self.rows = []
+
+    def writerow( self, row ):
+        self.rows.append( row )
+
+# the Ctx, column names and output format of a verify worker process
+verify_worker = None
+
+def init_verify_worker( user, metadata_names, output_format ):
+    global verify_worker
+    ctx = Ctx( user=user )
+    # each process opens its own databases.  New hash cache entries are saved by the parent.
+    ctx.hash_cache = HashCache( FLAGS.metadata_destination + '/.hashcache.db', rehash=FLAGS.rehash, defer_writes=True )
+    ctx.metadata_store = new_metadata_store()
+    verify_worker = ( ctx, metadata_names, output_format )
+    # the parent's stats were copied by fork.
+    run_stats.reset()
+
+def verify_keys( keys ):
+    """Verify the items having the given keys, in a worker process.
+
+    Returns:
+      the CSV rows and console output of each item, the new hash cache entries with the
+      hit and miss counts, the worker's throughput: ( pid, items, bytes, seconds ), and the
+      run stats of the chunk.
+    """
+    ctx, metadata_names, output_format = verify_worker
+    start_time = time.perf_counter()
+    results = []
+    size = 0
+    for key in keys:
+        writer = RowList()
+        output = io.StringIO()
+        with redirect_stdout( output ):
+            location = ctx.metadata_store.location( ctx.user, key )
+            try:
+                drive_file = redacted_dict( ctx.metadata_store.load( ctx.user, key ))
+                file_attr = verify_item( ctx, drive_file, writer, metadata_names, output_format )
+                size += file_attr.localSize or 0
             except Exception as e:
-                msg = f"cannot read metadata {path + '/' + dirent.name}, cautght: {e}"
+                msg = f"cannot read metadata {location}, cautght: {e}"
                 print( msg )
                 logging.critical( msg, exc_info=True)
+        results.append(( writer.rows, output.getvalue() ))
+    return ( results, ctx.hash_cache.take_deferred(), ( os.getpid(), len( keys ), size, time.perf_counter() - start_time ),
+             run_stats.take() )
+
+def chunks( iterable, size ):
+    chunk = []
+    for item in iterable:
+        chunk.append( item )
+        if len( chunk ) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def verify_concurrently( ctx, jobs, writer, metadata_names, output_format=None, chunk_size=32 ):
+    """Verify the user's items on a pool of worker processes.
+
+    Hashing and YAML serialization are CPU bound, so threads would not run them in
+    parallel.  Items are sent to the workers in chunks, in the order of the metadata
+    store, and the results are output in the same order, so the CSV and console output
+    are the same as a sequential run.  Per-worker throughput is logged, at DEBUG level, at the end.
+    """
+    stats = {}
+    pending = deque()
+    max_pending = 4 * jobs
+
+    def output( future ):
+        results, ( entries, hits, misses ), ( pid, items, size, seconds ), taken = future.result()
+        for rows, text in results:
+            for row in rows:
+                writer.writerow( row )
+            sys.stdout.write( text )
+        ctx.hash_cache.add( entries, hits, misses )
+        run_stats.add( taken )
+        total = stats.setdefault( pid, [ 0, 0, 0.0 ] )
+        total[0] += items
+        total[1] += size
+        total[2] += seconds
+
+    ctx.metadata_store.commit()
+    with ProcessPoolExecutor( max_workers=jobs, mp_context=multiprocessing.get_context('fork'),
+                              initializer=init_verify_worker,
+                              initargs=( ctx.user, metadata_names, output_format )) as executor:
+        for keys in chunks( ctx.metadata_store.keys( ctx.user ), chunk_size ):
+            pending.append( executor.submit( verify_keys, keys ))
+            while pending and ( pending[0].done() or len( pending ) > max_pending ):
+                output( pending.popleft() )
+        while pending:
+            output( pending.popleft() )
+
+    for pid, ( items, size, seconds ) in sorted( stats.items() ):
+        logging.debug( f'verify worker {pid}: {items} files, {size/1e6:.1f} MB in {seconds:.1f}s, {items/max( seconds, 1e-6 ):.1f} files/s' )
+
+def walk_local_metadata( ctx, handle_item ):
+    for location, drive_file in ctx.metadata_store.items( ctx.user ):
+        try:
+            drive_file = redacted_dict( drive_file )
+            handle_item( ctx, drive_file, drive_file['path'] )
+        except Exception as e:
+            msg = f"cannot read metadata {location}, cautght: {e}"
+            print( msg )
+            logging.critical( msg, exc_info=True)
+
+# column titles are under gdrive.column_titles, or column_titles in the bundled configuration.
+def column_title( config, name ):
+    titles = dget(config, 'gdrive.column_titles') or dget(config, 'column_titles') or {}
+    return titles.get( name ) or name
 
 def get_titles( config, metadata_names ):
-    return [ dget(config, f'gdrive.column_titles.{name}') or name for name in metadata_names ]
+    return [ column_title( config, name ) for name in metadata_names ]
 
 def get_gdrive_folder( ctx, path_in=None ):
     if path_in is None:
-        return ctx.files.get( fileId='root' ).execute(), '.'
+        return with_backoff( ctx.files.get( fileId='root', fields='id,name,mimeType' ).execute,
+                             'getting the root folder' ), '.'
     file_id = 'root'
     path = 'My Drive'
     for folder_name in path_in.split('/'):
         path += '/' + folder_name
-        result = ctx.files.list( q=f"'{file_id}' in parents and name='{folder_name}'" ).execute()
+        result = with_backoff( ctx.files.list( q=f"'{file_id}' in parents and name='{folder_name}'",
+                                               fields='files(id,name,mimeType)' ).execute,
+                               f'getting the folder {path}' )
         if result.get('files') is None or len(result.get('files')) == 0:
             print( f"Error: {path} does not exist in Google Drive." )
             sys.exit(1)
         drive_file = result['files'][0]
+        file_id = drive_file['id']
     print(f'root={path}')
     return drive_file, path
 
+# the Drive v3 discovery document, with its URLs pointing to -api_url.
+api_url_document = None
+
+# return the URL of the proxy in the configuration, for aiohttp, or None if there is none.
+def proxy_url( proxy ):
+    if not dget( proxy, 'host' ):
+        return None
+    auth = ''
+    if proxy.get('user'):
+        auth = urllib.parse.quote( proxy['user'], safe='' )
+        if proxy.get('pass'):
+            auth += ':' + urllib.parse.quote( proxy['pass'], safe='' )
+        auth += '@'
+    port = f":{proxy['port']}" if proxy.get('port') else ''
+    return f"http://{auth}{proxy['host']}{port}"
+
+def drive_service( http ):
+    global api_url_document
+    if not FLAGS.api_url:
+        return build("drive", "v3", http=http)
+    if api_url_document is None:
+        doc = json.loads( get_static_doc( 'drive', 'v3' ))
+        root = FLAGS.api_url.rstrip('/') + '/'
+        doc['rootUrl'] = root
+        doc['baseUrl'] = root + doc['servicePath']
+        doc.pop( 'mtlsRootUrl', None )
+        api_url_document = json.dumps( doc )
+    return build_from_document( api_url_document, http=http )
+
 class Ctx( object ):
-    def __init__( self, http, service ):
+    def __init__( self, http=None, service=None, credentials=None, new_http=None, user=None ):
         self.http = http
         self.service = service
+        self.credentials = credentials
+        self.new_http = new_http
+        self.user = user
+        self.downloaded = 0
+        self.hash_cache = None
+        self.metadata_store = None
+        self.file_fields = '*'
+        self.revision_executor = None
+        self.revision_ctxs = None
+        self.limiter = None
+        self.blob_store = None
         if self.service:
-            try:
-                about = self.service.about().get(fields='user').execute()
-                self.user = about['user']['emailAddress']
-                self.files = self.service.files()
-                self.revisions = self.service.revisions()
-            except errors.HttpError as e:
-                print( f'Request for google about() failed: {e}' )
-                self.user = '(nouser)'
-            self.downloaded = 0
+            self.files = self.service.files()
+            self.revisions = self.service.revisions()
+            if self.user is None:
+                # the user names the account's folders and files, so without it, the
+                # account cannot be collected, and user is left None.
+                try:
+                    about = with_backoff( lambda: self.service.about().get(fields='user').execute(),
+                                          'getting the account\'s user' )
+                    self.user = about['user']['emailAddress']
+                except Exception as e:
+                    print( f'Request for google about() failed: {e}' )
+
+    # shut down the ctx's revision download threads, and close their connections and
+    # its own.
+    def close( self ):
+        if self.revision_executor is not None:
+            self.revision_executor.shutdown()
+            self.revision_ctxs.close()
+            self.revision_executor = self.revision_ctxs = None
+        if self.http is not None:
+            self.http.close()
+
+    # return a Ctx for the same user having its own authorized HTTP connection, for use
+    # by a worker thread.
+    def clone( self ):
+        http = self.credentials.authorize( self.new_http() )
+        clone = Ctx( http, drive_service( http ), self.credentials, self.new_http, self.user )
+        clone.hash_cache = self.hash_cache
+        clone.metadata_store = self.metadata_store
+        clone.file_fields = self.file_fields
+        clone.limiter = self.limiter
+        clone.blob_store = self.blob_store
+        return clone
+
+# return a Ctx for the account whose credentials are saved in user_cred.  If the
+# credentials do not exist or are invalid, run the flow, which opens a web browser or
+# prints a URL for approval of access, and save them; or if not interactive, return None.
+def new_ctx( user_cred, flow, new_http, limiter, http=None, interactive=True ):
+    if not interactive and not os.path.exists( user_cred ):
+        return None
+    open(user_cred, "a+").close()     # ensure user_cred file exists
+    storage = Storage(user_cred)
+    try:
+        credentials = storage.get()
+    except:
+        credentials = None
+
+    http = http or new_http()
+    if credentials is None or credentials.invalid:
+        if not interactive:
+            return None
+        oflags = argparser.parse_args([])
+        oflags.noauth_local_webserver = not FLAGS.browser
+        credentials = run_flow(flow, storage, oflags, http)
+    http = credentials.authorize(http)
+    ctx = Ctx( http, drive_service( http ), credentials, new_http )
+    ctx.limiter = limiter
+    return ctx
+
+# return the user credential files given by -accounts, where @FILE names a file that
+# lists one per line.
+def account_credentials( accounts ):
+    user_creds = []
+    for account in accounts:
+        if account.startswith( '@' ):
+            with open( account[1:] ) as handle:
+                user_creds.extend( line.strip() for line in handle
+                                   if line.strip() and not line.strip().startswith( '#' ))
+        else:
+            user_creds.append( account )
+    return list( OrderedDict.fromkeys( user_creds ))
+
+# the configuration of an account worker process
+account_worker = None
+
+def init_account_worker( config, metadata_names, output_format, new_http, limiter ):
+    global account_worker
+    account_worker = ( config, metadata_names, output_format, new_http, limiter )
+    # the parent writes the stats of all accounts.
+    FLAGS.stats = FLAGS.prometheus = None
+
+def collect_account( user_cred ):
+    """Collect one account, in a worker process.
+
+    The console output of the account is saved next to its CSV file, as
+    <csv_prefix><user>.log.
+
+    Returns:
+      a dict describing the account's result, and the account's run stats.
+    """
+    config, metadata_names, output_format, new_http, limiter = account_worker
+    run_stats.reset()
+    start_time = time.perf_counter()
+    result = { 'credentials': user_cred, 'user': None, 'files_downloaded': 0, 'error': None }
+    try:
+        ctx = new_ctx( user_cred, None, new_http, limiter, interactive=False )
+        if ctx is None:
+            result['error'] = f"no valid credentials in {user_cred}.  Run kumodd -user_cred {user_cred} -list all once to authorize access."
+        elif ctx.user is None:
+            result['error'] = f"cannot get the user of the account in {user_cred}."
+        else:
+            result['user'] = ctx.user
+            result['log'] = dget(config, 'gdrive.csv_prefix') + ctx.user + '.log'
+            ensure_dir( dirname( result['log'] ) or '.' )
+            with open( result['log'], 'w' ) as handle, redirect_stdout( handle ):
+                run( ctx, config, metadata_names, output_format, commit_interval=1 )
+            result['files_downloaded'] = ctx.downloaded
+            result['hash_cache_hits'] = ctx.hash_cache.hits
+            result['hash_cache_misses'] = ctx.hash_cache.misses
+    except Exception as e:
+        logging.critical( f"cannot collect the account of {user_cred}: {e}", exc_info=True )
+        result['error'] = str( e )
+    result['seconds'] = round( time.perf_counter() - start_time, 3 )
+    return result, run_stats.take()
+
+def collect_accounts( config, metadata_names, output_format, new_http, limiter, limiter_manager ):
+    """Collect the accounts given by -accounts, up to -account_jobs at a time.
+
+    Each account is collected in its own process, into the usual per-user files and
+    folders.  All processes share one rate limiter, and one summary is printed, and
+    saved by -stats, at the end.
+    """
+    user_creds = account_credentials( FLAGS.accounts )
+    results = []
+    start_time = datetime.now()
+    try:
+        with ProcessPoolExecutor( max_workers=min( FLAGS.account_jobs, len( user_creds )),
+                                  mp_context=multiprocessing.get_context('fork'),
+                                  initializer=init_account_worker,
+                                  initargs=( config, metadata_names, output_format, new_http, limiter )) as executor:
+            futures = [ executor.submit( collect_account, user_cred ) for user_cred in user_creds ]
+            for future in as_completed( futures ):
+                result, taken = future.result()
+                run_stats.add( taken )
+                results.append( result )
+                if result['error']:
+                    print( f"{result['user'] or result['credentials']}: failed: {result['error']}" )
+                else:
+                    print( f"{result['user']}: {result['files_downloaded']} files downloaded in {result['seconds']:.1f}s, "
+                           f"output in {result['log']}" )
+        end_time = datetime.now()
+        failed = sum( 1 for result in results if result['error'] )
+        print( f'\n{len( results ) - failed} accounts collected, {failed} failed, '
+               f'{sum( result["files_downloaded"] for result in results )} files downloaded' )
+        print(f'Duration: {end_time - start_time}')
+        print( limiter.summary() )
+        ctx = Ctx()
+        ctx.downloaded = sum( result['files_downloaded'] for result in results )
+        ctx.limiter = limiter
+        write_run_stats( ctx, start_time, end_time,
+                         hash_cache_hits=sum( result.get( 'hash_cache_hits', 0 ) for result in results ),
+                         hash_cache_misses=sum( result.get( 'hash_cache_misses', 0 ) for result in results ),
+                         accounts_collected=len( results ) - failed, accounts_failed=failed,
+                         accounts=sorted( results, key=lambda result: result['credentials'] ))
+    finally:
+        limiter_manager.shutdown()
+    return 1 if failed else 0
 
 def main(argv):
     # Let the flags module process the command-line arguments
@@ -848,8 +2536,8 @@ def main(argv):
         sys.exit(1)
 
     if not os.path.exists(FLAGS.config):
-        if FLAGS.config.find('/'):
-            ensure_dir(dirname(FLAGS.config[:FLAGS.config.rfind('/')]))
+        if dirname(FLAGS.config):
+            ensure_dir(dirname(FLAGS.config))
         # catch issues in the bundled config early by decoding and encoding
         yaml.dump(yaml.safe_load('''
 gdrive:
@@ -983,14 +2671,40 @@ column_titles:
     if colunm_set is None:
         logging.critical( f"column set {FLAGS.col} not found." )
         return -1
+    if FLAGS.sync and not FLAGS.download:
+        logging.critical( "-sync requires -download." )
+        return -1
+    if FLAGS.sync and FLAGS.query:
+        logging.critical( "-sync cannot be combined with -query, because the query cannot be applied to the changes feed." )
+        return -1
     metadata_names = [col[0] for col in colunm_set]
     colunm_widths = [col[1] for col in colunm_set]
     output_format = ' '.join([f'{{{i}:{width}.{width}}}' for i, width in enumerate(colunm_widths[:len(colunm_widths)-1])])
     # don't truncate the trailing column
     output_format += f' {{{len(colunm_widths) - 1}}}'
+    compile_columns( metadata_names )
 
-    if FLAGS.verify:
-        ctx = Ctx( None )
+    for name in ( 'since', 'until' ):
+        try:
+            utc_time_flag( FLAGS[name].value )
+        except ( ValueError, OverflowError ) as e:
+            logging.critical( f"invalid -{name} time {FLAGS[name].value}: {e}" )
+            return -1
+    if FLAGS.export_yaml and FLAGS.metadata_store != 'sqlite':
+        logging.critical( "-export_yaml requires -metadata_store sqlite." )
+        return -1
+    if FLAGS.accounts and not ( FLAGS.list or FLAGS.download ) or FLAGS.accounts and ( FLAGS.plan or FLAGS.l2t or FLAGS.export_yaml ):
+        logging.critical( "-accounts works with -list and -download, without -plan, -l2t or -export_yaml." )
+        return -1
+    if FLAGS.accounts and 'fork' not in multiprocessing.get_all_start_methods():
+        logging.critical( "-accounts requires a platform that supports fork()." )
+        return -1
+    if FLAGS.verify and FLAGS.jobs > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        logging.critical( "-verify -jobs requires a platform that supports fork()." )
+        return -1
+    transport = None
+    if FLAGS.verify or FLAGS.export_yaml:
+        ctx = Ctx()
     else:
         api_cred = dget(config, 'gdrive.api_cred')
         # Set up a Flow object that opens a web browser or prints a URL for
@@ -1012,51 +2726,95 @@ column_titles:
         # Create an httplib2.Http object to handle our HTTP requests and authorize it
         # with our good Credentials.
 
+        # all connections share one limiter, so that together they stay within the quota.
+        # The accounts of -accounts are collected in separate processes, so their limiter
+        # is served by a process of its own.
+        if FLAGS.accounts:
+            limiter_manager, limiter = shared_rate_limiter( FLAGS.api_rate, FLAGS.api_concurrency )
+        else:
+            limiter_manager, limiter = None, RateLimiter( FLAGS.api_rate, FLAGS.api_concurrency )
+        proxy = dget(config, 'proxy')
         if dget(config, 'proxy.host'):
             try:
                 proxy_uri = 'http://' + dget(config, 'proxy.host')
                 if dget(config, 'proxy.port'):
-                    proxy_uri += ':' + dget(config, 'proxy.port')
-                resp, content = http.request(proxy_uri, "GET")
+                    proxy_uri += ':' + str(dget(config, 'proxy.port'))
+                resp, content = httplib2.Http().request(proxy_uri, "GET")
             except Exception as e:
                 print(f"\nCannot connect to proxy at: {proxy_uri}.  Please check your network.\n\n")
                 return
-            http2 = httplib2.Http(
-                proxy_info = httplib2.ProxyInfo(
-                    httplib2.socks.PROXY_TYPE_HTTP,
-                    proxy_host = proxy.get('host'),
-                    proxy_port = int(proxy.get('port')) if proxy.get('port') else None,
-                    proxy_user = proxy.get('user'),
-                    proxy_pass = proxy.get('pass') ))
+            def new_http():
+                return RateLimitedHttp(
+                    limiter, transport,
+                    proxy_info = httplib2.ProxyInfo(
+                        httplib2.socks.PROXY_TYPE_HTTP,
+                        proxy_host = proxy.get('host'),
+                        proxy_port = int(proxy.get('port')) if proxy.get('port') else None,
+                        proxy_user = proxy.get('user'),
+                        proxy_pass = proxy.get('pass') ))
         else:
-            http2 = httplib2.Http()
+            def new_http():
+                return RateLimitedHttp( limiter, transport )
+        # with -transport aiohttp, all connections send their requests over one pool of
+        # connections, rather than each over its own.
+        transport = None
+        if FLAGS.transport == 'aiohttp':
+            try:
+                transport = AsyncTransport( FLAGS.connections, proxy=proxy_url( proxy ))
+            except ImportError as e:
+                logging.critical( e )
+                print( f"Error: {e}" )
+                return -1
+        http2 = new_http()
 
         try:
-            resp, content = http2.request("http://google.com", "GET")
+            resp, content = http2.request(FLAGS.api_url or "http://google.com", "GET")
         except Exception as e:
             print(f"""\nCannot connect to google.com.  Please check your network.
 
     Error: {e}\n""" )
             return
 
-        # If the Google Drive credentials don't exist or are invalid run the client
-        # flow, and store the credentials.
+        if FLAGS.accounts:
+            if transport:
+                # each account's process starts its own loop.
+                transport.close()
+            # and opens its own connections, so none are inherited across fork.
+            http2.close()
+            return collect_accounts( config, metadata_names, output_format, new_http, limiter, limiter_manager )
+
         user_cred = FLAGS.user_cred or dget(config, 'gdrive.user_cred')
-        open(user_cred, "a+").close()     # ensure user_cred file exists
-        storage = Storage(user_cred)
-        try:
-            credentials = storage.get()
-        except:
-            credentials = None
-
-        if credentials is None or credentials.invalid:
-            oflags = argparser.parse_args([])
-            oflags.noauth_local_webserver = not FLAGS.browser
-            credentials = run_flow(FLOW, storage, oflags, http2)
-        http2 = credentials.authorize(http2)
-        service = build("drive", "v3", http=http2)
-        ctx = Ctx( http2, service )
+        ctx = new_ctx( user_cred, FLOW, new_http, limiter, http2 )
+        if ctx.user is None:
+            print( f"Error: cannot get the user of the account in {user_cred}." )
+            if transport:
+                transport.close()
+            return 1
+
+    try:
+        return run( ctx, config, metadata_names, output_format )
+    finally:
+        if transport:
+            transport.close()
+
+def run( ctx, config, metadata_names, output_format, commit_interval=1000 ):
+    """Collect, list or verify the files of ctx.user, as selected by the flags.
+
+    Args:
+      commit_interval: number of database updates between commits.  Processes that share
+        the databases commit each update, so that none holds the write lock for long.
 
+    Returns:
+      the exit status: 0, or 1 if files listed by -usecsv could not be retrieved.
+    """
+    ctx.file_fields = file_fields( metadata_names )
+    ensure_dir(FLAGS.metadata_destination)
+    ctx.hash_cache = HashCache( FLAGS.metadata_destination + '/.hashcache.db', rehash=FLAGS.rehash, commit_interval=commit_interval )
+    ctx.metadata_store = new_metadata_store( commit_interval )
+    if FLAGS.blob_store:
+        ctx.blob_store = BlobStore( FLAGS.blob_store, FLAGS.blob_link )
+
+    status = 0
     try:
         start_time = datetime.now()
         if FLAGS.list:
@@ -1070,86 +2828,138 @@ column_titles:
                 writer.writerow( get_titles( config, metadata_names ) )
                 gdrive_folder, path = get_gdrive_folder( ctx, FLAGS.folder )
 
-                def handle_item( ctx, drive_file, path ):
-                    if FLAGS.revisions:
-                        download_revisions_metadata(ctx, drive_file )
-                    print_file_metadata( ctx, drive_file, path, writer, metadata_names, output_format)
+                with CollectPipeline( ctx, writer, metadata_names, output_format, download=False ) as pipeline:
+                    walk_drive( ctx, gdrive_folder, pipeline.handle_item, path )
 
-                walk_folders( ctx, gdrive_folder, handle_item, path )
+        elif FLAGS.download and FLAGS.plan:
+            gdrive_folder, path = get_gdrive_folder( ctx, FLAGS.folder )
+            write_plan( ctx, gdrive_folder, path, FLAGS.plan )
 
         elif FLAGS.download:
             ensure_dir(FLAGS.destination + '/' + ctx.user)
-            print( output_format.format( *[ dget(config, 'gdrive.column_titles').get(name) or name for name in metadata_names ]).rstrip())
+            print( output_format.format( *get_titles( config, metadata_names )).rstrip())
             gdrive_folder, path = get_gdrive_folder( ctx, FLAGS.folder )
             with open(dget(config, 'gdrive.csv_prefix') + ctx.user + '.csv', 'w') as csv_handle:
                 writer = csv.writer(csv_handle, delimiter=',')
                 writer.writerow( get_titles( config, metadata_names ) )
 
-                def handle_item( ctx, drive_file, path ):
-                    if FLAGS.revisions:
-                        download_revisions_metadata(ctx, drive_file )
-                    download_file_and_metadata( ctx, drive_file, path, writer, metadata_names, output_format)
-
-                walk_folders( ctx, gdrive_folder, handle_item, path )
+                failures = run_stats.counters['download_failures']
+                with CollectPipeline( ctx, writer, metadata_names, output_format ) as pipeline:
+                    if FLAGS.sync:
+                        sync_state = sync_folders( ctx, gdrive_folder, pipeline.handle_item, path )
+                    else:
+                        walk_drive( ctx, gdrive_folder, pipeline.handle_item, path )
+                if FLAGS.sync:
+                    failures = run_stats.counters['download_failures'] - failures
+                    if failures:
+                        print( f"{failures} downloads failed, so the changes feed position was not saved.  The next -sync run visits these changes again." )
+                    else:
+                        save_sync_state( ctx, sync_state )
             print(f"\n{ctx.downloaded} files downloaded from {ctx.user}")
 
         elif FLAGS.usecsv:
             ensure_dir(FLAGS.destination + '/' + ctx.user)
             header = output_format.format( *get_titles( config, metadata_names )).rstrip()
             print( header )
-            download_listed_files( ctx, config, metadata_names, output_format)
+            not_retrieved = run_stats.counters['files_not_retrieved']
+            with CollectPipeline( ctx, None, metadata_names, output_format ) as pipeline:
+                download_listed_files( ctx, config, pipeline.handle_item )
+            not_retrieved = run_stats.counters['files_not_retrieved'] - not_retrieved
+            print(f"\n{ctx.downloaded} files downloaded from {ctx.user}")
+            if not_retrieved:
+                print(f"{not_retrieved} listed files could not be retrieved")
+                status = 1
+
+        elif FLAGS.execute:
+            ensure_dir(FLAGS.destination + '/' + ctx.user)
+            print( output_format.format( *get_titles( config, metadata_names )).rstrip())
+            with open(dget(config, 'gdrive.csv_prefix') + ctx.user + '.csv', 'w') as csv_handle:
+                writer = csv.writer(csv_handle, delimiter=',')
+                writer.writerow( get_titles( config, metadata_names ) )
+                execute_plan( ctx, FLAGS.execute, writer, metadata_names, output_format )
             print(f"\n{ctx.downloaded} files downloaded from {ctx.user}")
 
         elif FLAGS.verify:
             header = output_format.format( *get_titles( config, metadata_names )).rstrip()
             print( header )
-            for dirent in os.scandir( FLAGS.metadata_destination ):
-                ctx.user = dirent.name
+            for ctx.user in ctx.metadata_store.users():
                 with open(dget(config, 'gdrive.csv_prefix') + ctx.user + '.csv', 'w') as csv_handle:
                     writer = csv.writer(csv_handle, delimiter=',')
                     writer.writerow( get_titles( config, metadata_names ) )
 
-                    def handle_item( ctx, drive_file, path ):
-                        file_attr = FileAttr( drive_file, ctx.user )
-                        file_attr.compare_metadata_to_local_file( drive_file )
-                        file_attr.compare_YAML_metadata_MD5( drive_file )
-                        if FLAGS.revisions:
-                            verify_revisions( ctx, drive_file)
-                        if drive_file['status'] == 'INVALID':
-                            print(22*'_', ' drive_file ', dirent.name)
-                            dump(drive_file)
-                            print(11*'_', ' file attr ', dirent.name)
-                            dump(file_attr)
-                        data = jsonpath_list( drive_file, metadata_names )
-                        if writer:
-                            writer.writerow( data )
-                        if output_format:
-                            print( output_format.format( *[str(i) for i in data] ).rstrip())
-                        if (FLAGS.diffs and
-                            drive_file.get('yamlMD5Match') == 'MISMATCH' ):
-                            print_obj_diffs( drive_file, file_attr.metadata_file )
-
-                    walk_local_metadata( ctx, handle_item, FLAGS.metadata_destination + '/' + ctx.user )
+                    if FLAGS.jobs > 1:
+                        sys.stdout.flush()
+                        verify_concurrently( ctx, FLAGS.jobs, writer, metadata_names, output_format )
+                    else:
+                        def handle_item( ctx, drive_file, path ):
+                            verify_item( ctx, drive_file, writer, metadata_names, output_format )
+
+                        walk_local_metadata( ctx, handle_item )
 
         if FLAGS.l2t:
-            for dirent in os.scandir( FLAGS.metadata_destination ):
-                if dirent.is_dir():
-                    ctx.user = dirent.name
-                    with open(dget(config, 'gdrive.csv_prefix') + 'l2t.' + ctx.user + '.csv', 'w') as csv_handle:
-                        writer = csv.writer(csv_handle, delimiter=',')
-                        writer.writerow( ['date', 'time', 'timezone', 'MACB',
-                                        'source', 'sourcetype', 'type', 'user',
-                                          'host', 'short', 'desc', 'version',
-                                          'filename', 'inode', 'notes', 'format',
-                                          'extra'] )
-                        def handle_item( ctx, drive_file, path ):
-                            output_lt2_csv(ctx, drive_file, writer)
-                        walk_local_metadata( ctx, handle_item, FLAGS.metadata_destination + '/' + ctx.user )
+            users = ctx.metadata_store.users()
+            csv_paths = [ dget(config, 'gdrive.csv_prefix') + 'l2t.' + user + '.csv' for user in users ]
+            if FLAGS.jobs > 1 and len( users ) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+                # write each user's timeline in its own process, which opens its own
+                # metadata store, and needs no connection, so none is inherited across fork.
+                ctx.metadata_store.commit()
+                if ctx.http is not None:
+                    ctx.http.close()
+                with ProcessPoolExecutor( max_workers=min( FLAGS.jobs, len( users )),
+                                          mp_context=multiprocessing.get_context('fork')) as executor:
+                    for user in executor.map( write_timeline_of_user, users, csv_paths ):
+                        pass
+            else:
+                for ctx.user, csv_path in zip( users, csv_paths ):
+                    write_timeline( ctx, csv_path )
+
+        if FLAGS.export_yaml:
+            export_yaml( ctx )
 
         end_time = datetime.now()
         print(f'Duration: {end_time - start_time}')
+        print(ctx.hash_cache.summary())
+        if ctx.limiter:
+            print(ctx.limiter.summary())
+        if ctx.blob_store:
+            print(ctx.blob_store.summary())
+        write_run_stats( ctx, start_time, end_time )
     except AccessTokenRefreshError:
         print ("The credentials have been revoked or expired, please re-run the application to re-authorize")
+    finally:
+        ctx.hash_cache.close()
+        ctx.metadata_store.close()
+        ctx.close()
+    return status
+
+def write_run_stats( ctx, start_time, end_time, **more ):
+    """Write the run's stats to the -stats JSON file and the -prometheus textfile, if given.
+
+    more holds further values to write.  Only numbers are written to the textfile.
+    """
+    if not ( FLAGS.stats or FLAGS.prometheus ):
+        return
+    extra = dict( start_time=start_time.isoformat(),
+                  duration_seconds=round( ( end_time - start_time ).total_seconds(), 3 ),
+                  files_downloaded=ctx.downloaded )
+    if ctx.hash_cache:
+        extra['hash_cache_hits'] = ctx.hash_cache.hits
+        extra['hash_cache_misses'] = ctx.hash_cache.misses
+    extra.update( more )
+    if ctx.limiter:
+        limiter_counters = ctx.limiter.counters()
+        extra['api_throttled'] = sum( c['throttled'] for c in limiter_counters.values() )
+        extra['api_wait_seconds'] = round( sum( c['wait_seconds'] for c in limiter_counters.values() ), 3 )
+    if ctx.blob_store:
+        extra['blob_store_linked'] = ctx.blob_store.linked
+        extra['blob_store_bytes_not_downloaded'] = ctx.blob_store.bytes_not_downloaded
+    if FLAGS.stats:
+        ensure_dir( dirname( FLAGS.stats ) or '.' )
+        run_stats.write_json( FLAGS.stats, user=ctx.user, **extra,
+                              rate_limiter=ctx.limiter.counters() if ctx.limiter else None )
+    if FLAGS.prometheus:
+        ensure_dir( dirname( FLAGS.prometheus ) or '.' )
+        run_stats.write_prometheus( FLAGS.prometheus, labels={ 'user': ctx.user } if ctx.user else None, **extra )
 
 if __name__ == '__main__':
     app.run(main)
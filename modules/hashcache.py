@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""Copyright (C) 2019  Andres Barreto and Rich Murphey
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+A persistent cache of the MD5 of files on disk.
+
+Each entry is keyed by the file's path, inode, size and modification time in
+nanoseconds.  If none of these have changed since the file was last hashed, the
+cached MD5 is returned and the file is not re-read.
+"""
+
+import os
+import sqlite3
+import threading
+import weakref
+
+class HashCache( object ):
+    def __init__( self, db_path, rehash=False, commit_interval=1000, defer_writes=False ):
+        """Open or create the cache.
+
+        Args:
+          db_path: location of the SQLite database.
+          rehash: if True, ignore cached values and re-read every file. The cache is still updated.
+          commit_interval: number of updates between commits.
+          defer_writes: if True, new entries are kept in memory until taken by take_deferred(),
+            so that a worker process does not hold the database's write lock.
+        """
+        self.db_path = db_path
+        self.rehash = rehash
+        self.commit_interval = commit_interval
+        self.defer_writes = defer_writes
+        self.deferred = []
+        self.hits = 0
+        self.misses = 0
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+        self.inherited = []
+        self.connection = self.connect()
+        caches.add( self )
+
+    def connect( self ):
+        db = sqlite3.connect( self.db_path, timeout=60, check_same_thread=False )
+        db.execute( 'PRAGMA journal_mode=WAL' )
+        db.execute( '''CREATE TABLE IF NOT EXISTS md5 (
+                         path TEXT PRIMARY KEY,
+                         inode INTEGER,
+                         size INTEGER,
+                         mtime_ns INTEGER,
+                         md5 TEXT )''' )
+        db.commit()
+        return db
+
+    # the connection of this process, opened on first use after a fork.
+    @property
+    def db( self ):
+        if self.connection is None:
+            self.connection = self.connect()
+        return self.connection
+
+    # in a forked process.  An SQLite connection must not be used across fork, so the
+    # inherited connection is kept, unused and open, and the process opens its own.
+    def after_fork( self ):
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        if self.connection is not None:
+            self.inherited.append( self.connection )
+        self.connection = None
+
+    def md5( self, file_path, hash_file ):
+        """Return the MD5 of a file, calling hash_file(file_path) only if it is not cached."""
+        key = os.path.realpath( file_path )
+        st = os.stat( file_path )
+        if not self.rehash:
+            with self.lock:
+                row = self.db.execute( 'SELECT md5 FROM md5 WHERE path=? AND inode=? AND size=? AND mtime_ns=?',
+                                       ( key, st.st_ino, st.st_size, st.st_mtime_ns )).fetchone()
+            if row:
+                with self.lock:
+                    self.hits += 1
+                return row[0]
+        md5 = hash_file( file_path )
+        with self.lock:
+            self.misses += 1
+            entry = ( key, st.st_ino, st.st_size, st.st_mtime_ns, md5 )
+            if self.defer_writes:
+                self.deferred.append( entry )
+            else:
+                self.db.execute( 'INSERT OR REPLACE INTO md5 VALUES (?,?,?,?,?)', entry )
+                self.changed()
+        return md5
+
+    def take_deferred( self ):
+        """Return and clear the entries not yet written, with the hit and miss counts since the last call."""
+        with self.lock:
+            deferred, hits, misses = self.deferred, self.hits, self.misses
+            self.deferred, self.hits, self.misses = [], 0, 0
+        return deferred, hits, misses
+
+    def add( self, entries, hits=0, misses=0 ):
+        """Write entries taken from another cache by take_deferred(), and count its hits and misses."""
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+            for entry in entries:
+                self.db.execute( 'INSERT OR REPLACE INTO md5 VALUES (?,?,?,?,?)', entry )
+                self.changed()
+
+    def forget( self, file_path ):
+        """Remove a file from the cache, eg. because kumodd has just rewritten it."""
+        with self.lock:
+            self.db.execute( 'DELETE FROM md5 WHERE path=?', ( os.path.realpath( file_path ), ))
+            self.changed()
+
+    # commit after every commit_interval updates.  The caller holds the lock.
+    def changed( self ):
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_interval:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def summary( self ):
+        return f'Hash cache: {self.hits} hits, {self.misses} misses'
+
+    def close( self ):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.commit()
+                self.connection.close()
+                self.connection = None
+
+# the caches of this process, reset by one hook after fork.
+caches = weakref.WeakSet()
+
+def reset_caches_after_fork():
+    for cache in list( caches ):
+        cache.after_fork()
+
+if hasattr( os, 'register_at_fork' ):
+    os.register_at_fork( after_in_child=reset_caches_after_fork )
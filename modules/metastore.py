@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""Copyright (C) 2019  Andres Barreto and Rich Murphey
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+A metadata store that keeps the metadata of every item in one SQLite database,
+rather than in one YAML file per item.
+
+Items are identified by user and key, where the key is the item's relative
+path, as in the YAML layout.  Each item's metadata is stored as JSON, along
+with its yamlMetadataMD5 and a row for each of its revisions, so that reports
+can select items by ID, time or MD5 using indexed queries.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import weakref
+
+class SqliteMetadataStore( object ):
+    def __init__( self, db_path, commit_interval=1000 ):
+        self.db_path = db_path
+        self.commit_interval = commit_interval
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+        self.inherited = []
+        self.connection = self.connect()
+        stores.add( self )
+
+    def connect( self ):
+        db = sqlite3.connect( self.db_path, timeout=60, check_same_thread=False )
+        db.execute( 'PRAGMA journal_mode=WAL' )
+        db.executescript( '''
+            CREATE TABLE IF NOT EXISTS files (
+                user TEXT,
+                key TEXT,
+                id TEXT,
+                mimeType TEXT,
+                modifiedTime TEXT,
+                md5Checksum TEXT,
+                yamlMetadataMD5 TEXT,
+                metadata TEXT,
+                PRIMARY KEY ( user, key ));
+            CREATE INDEX IF NOT EXISTS files_id ON files ( user, id );
+            CREATE INDEX IF NOT EXISTS files_modifiedTime ON files ( user, modifiedTime );
+            CREATE INDEX IF NOT EXISTS files_md5Checksum ON files ( md5Checksum );
+            CREATE TABLE IF NOT EXISTS revisions (
+                user TEXT,
+                key TEXT,
+                id TEXT,
+                modifiedTime TEXT,
+                md5Checksum TEXT,
+                PRIMARY KEY ( user, key, id ));
+            CREATE INDEX IF NOT EXISTS revisions_md5Checksum ON revisions ( md5Checksum );
+            ''' )
+        db.commit()
+        return db
+
+    # the connection of this process, opened on first use after a fork.
+    @property
+    def db( self ):
+        if self.connection is None:
+            self.connection = self.connect()
+        return self.connection
+
+    # in a forked process.  An SQLite connection must not be used across fork, so the
+    # inherited connection is kept, unused and open, and the process opens its own.
+    def after_fork( self ):
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        if self.connection is not None:
+            self.inherited.append( self.connection )
+        self.connection = None
+
+    # a name for the item in messages, in place of a YAML file name.
+    def location( self, user, key ):
+        return f'{self.db_path}:{user}/{key}'
+
+    def save( self, user, key, drive_file ):
+        with self.lock:
+            self.db.execute( 'INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?)',
+                             ( user, key, drive_file.get('id'), drive_file.get('mimeType'),
+                               drive_file.get('modifiedTime'), drive_file.get('md5Checksum'),
+                               drive_file.get('yamlMetadataMD5'), json.dumps( drive_file )))
+            self.db.execute( 'DELETE FROM revisions WHERE user=? AND key=?', ( user, key ))
+            self.db.executemany( 'INSERT OR REPLACE INTO revisions VALUES (?,?,?,?,?)',
+                                 [( user, key, rev.get('id'), rev.get('modifiedTime'), rev.get('md5Checksum'))
+                                  for rev in drive_file.get('revisions') or [] ])
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_interval:
+                self.db.commit()
+                self.uncommitted = 0
+
+    # return the saved metadata, or None if there is none.
+    def load( self, user, key ):
+        with self.lock:
+            row = self.db.execute( 'SELECT metadata FROM files WHERE user=? AND key=?', ( user, key )).fetchone()
+        return json.loads( row[0] ) if row else None
+
+    def users( self ):
+        with self.lock:
+            return [ row[0] for row in self.db.execute( 'SELECT DISTINCT user FROM files ORDER BY user' ) ]
+
+    def keys( self, user, page_size=1000 ):
+        """Yield the key of each of the user's items, ordered by key."""
+        last_key = ''
+        while True:
+            with self.lock:
+                rows = self.db.execute( 'SELECT key FROM files WHERE user=? AND key>? ORDER BY key LIMIT ?',
+                                        ( user, last_key, page_size )).fetchall()
+            for row in rows:
+                yield row[0]
+            if len( rows ) < page_size:
+                break
+            last_key = rows[-1][0]
+
+    def items( self, user, page_size=1000 ):
+        """Yield ( location, metadata ) of each of the user's items, ordered by key.
+
+        Rows are read a page at a time, so memory use does not grow with the number of items.
+        """
+        last_key = ''
+        while True:
+            with self.lock:
+                rows = self.db.execute( 'SELECT key, metadata FROM files WHERE user=? AND key>? ORDER BY key LIMIT ?',
+                                        ( user, last_key, page_size )).fetchall()
+            for key, metadata in rows:
+                yield self.location( user, key ), json.loads( metadata )
+            if len( rows ) < page_size:
+                break
+            last_key = rows[-1][0]
+
+    # make saved items visible to other connections, eg. in worker processes.
+    def commit( self ):
+        with self.lock:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def close( self ):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.commit()
+                self.connection.close()
+                self.connection = None
+
+# the stores of this process, reset by one hook after fork.
+stores = weakref.WeakSet()
+
+def reset_stores_after_fork():
+    for store in list( stores ):
+        store.after_fork()
+
+if hasattr( os, 'register_at_fork' ):
+    os.register_at_fork( after_in_child=reset_stores_after_fork )
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""Copyright (C) 2019  Andres Barreto and Rich Murphey
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+A pipeline of stages, each running on its own threads, connected by bounded queues.
+
+Items put into the pipeline pass through each stage in turn, then are output
+one at a time on an output thread.  Since each stage has its own threads, a
+stage waiting on the network, such as downloading, overlaps with one using the
+CPU or the disk, such as hashing, and each stage's number of threads can be set
+to match its load.
+
+The number of items in the pipeline is bounded.  When a stage falls behind,
+the queue before it fills, the stages before it wait, and finally put() waits,
+so that memory use does not grow with the number of items.
+
+If a stage, or the output, raises an exception on an item, the error is logged,
+counted in run_stats as 'pipeline_errors', and that item is dropped, while the
+other items go on.  If a batch stage raises an exception, it is called again on
+each item of the batch on its own, so that only the items that fail are dropped.
+"""
+
+import heapq
+import logging
+import queue
+import threading
+import time
+
+from modules.stats import run_stats
+
+# marks the end of a queue's items, for one thread.
+END = object()
+
+class Stage( object ):
+    def __init__( self, name, fn, jobs=1, batch_size=None, batch_wait=1.0 ):
+        """A stage of a pipeline.
+
+        Args:
+          name: name of the stage.  The time its threads are busy is recorded in
+            run_stats as the phase 'stage:<name>'.
+          fn: called on one of the stage's threads with an item, and returns the item
+            to pass on, or None to drop it.  If batch_size is given, it is called
+            with a list of up to batch_size items, and returns a list of the same length.
+          jobs: number of threads.
+          batch_size: maximum number of items in a batch, or None to pass items one at a time.
+          batch_wait: seconds to wait for a batch to fill, after its first item.
+        """
+        self.name = name
+        self.fn = fn
+        self.jobs = jobs
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+
+class Pipeline( object ):
+    def __init__( self, stages, output, queue_size=64, ordered=True, dropped=None ):
+        """Create a pipeline.  Its threads are started by entering it as a context manager.
+
+        Args:
+          stages: the Stages, in the order items pass through them.
+          output: called with each item that was not dropped, on the output thread.
+          queue_size: number of items held in each queue between stages.
+          ordered: if True, items are output in the order they were put, else as soon as
+            they pass the last stage.
+          dropped: if given, called with each item dropped because a stage or the
+            output raised an exception on it.
+        """
+        self.stages = stages
+        self.output = output
+        self.ordered = ordered
+        self.dropped = dropped
+        self.queues = [ queue.Queue( queue_size ) for stage in stages ] + [ queue.Queue() ]
+        # the items held by the stages' threads, and waiting to be output in order, are
+        # counted too, so that the output queue and the items out of order are bounded.
+        self.slots = threading.Semaphore(
+            queue_size * ( len( stages ) + 1 ) + sum( stage.jobs * ( stage.batch_size or 1 ) for stage in stages ))
+        self.lock = threading.Lock()
+        self.next_seq = 0
+        self.threads = []
+        self.output_thread = None
+
+    def __enter__( self ):
+        for stage, source, sink in zip( self.stages, self.queues, self.queues[1:] ):
+            threads = [ threading.Thread( target=self.work, args=( stage, source, sink ),
+                                          name=f'kumodd-{stage.name}-{i}', daemon=True )
+                        for i in range( stage.jobs ) ]
+            for thread in threads:
+                thread.start()
+            self.threads.append( threads )
+        self.output_thread = threading.Thread( target=self.run_output, name='kumodd-output', daemon=True )
+        self.output_thread.start()
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.close()
+
+    def put( self, item ):
+        """Put an item into the first stage, waiting while the pipeline is full."""
+        self.slots.acquire()
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+        self.queues[0].put(( seq, item ))
+
+    def close( self ):
+        """Wait for the items in the pipeline to be output, and stop its threads."""
+        for threads, source in zip( self.threads, self.queues ):
+            for thread in threads:
+                source.put( END )
+            for thread in threads:
+                thread.join()
+        self.queues[-1].put( END )
+        self.output_thread.join()
+
+    # report an exception raised by a stage or the output on an item, which is dropped.
+    def fail( self, name, item, e ):
+        logging.critical( f'{name} failed for {item}: {e}', exc_info=True )
+        run_stats.count( 'pipeline_errors' )
+        if self.dropped is not None:
+            try:
+                self.dropped( item )
+            except Exception:
+                logging.critical( f'cannot drop {item}', exc_info=True )
+
+    def work( self, stage, source, sink ):
+        while True:
+            batch, end = self.take( stage, source )
+            if batch:
+                for entry in self.run_stage( stage, batch ):
+                    sink.put( entry )
+            if end:
+                return
+
+    # take a batch of entries from source.  Return them, and whether the end was reached.
+    def take( self, stage, source ):
+        entry = source.get()
+        if entry is END:
+            return [], True
+        batch = [ entry ]
+        deadline = time.monotonic() + stage.batch_wait
+        while len( batch ) < ( stage.batch_size or 1 ):
+            try:
+                entry = source.get( timeout=max( 0, deadline - time.monotonic() ))
+            except queue.Empty:
+                break
+            if entry is END:
+                return batch, True
+            batch.append( entry )
+        return batch, False
+
+    # run the stage on the live items of a batch.  Return the batch, with the items
+    # the stage returned.
+    def run_stage( self, stage, batch ):
+        live = [ i for i, ( seq, item ) in enumerate( batch ) if item is not None ]
+        if not live:
+            return batch
+        with run_stats.phase( f'stage:{stage.name}' ):
+            if stage.batch_size:
+                results = self.call_batch( stage, [ batch[i][1] for i in live ])
+            else:
+                results = [ self.call( stage, batch[0][1] )]
+        batch = list( batch )
+        for i, result in zip( live, results ):
+            batch[i] = ( batch[i][0], result )
+        return batch
+
+    # call a stage on an item.  Return the item it returns, or None if it raised an exception.
+    def call( self, stage, item ):
+        try:
+            return stage.fn( item )
+        except Exception as e:
+            self.fail( stage.name, item, e )
+            return None
+
+    # call a batch stage on a list of items.  If it raises an exception, call it on
+    # each item on its own.
+    def call_batch( self, stage, items ):
+        try:
+            return stage.fn( items )
+        except Exception as e:
+            if len( items ) == 1:
+                self.fail( stage.name, items[0], e )
+                return [ None ]
+        results = []
+        for item in items:
+            try:
+                results.extend( stage.fn( [ item ] ))
+            except Exception as e:
+                self.fail( stage.name, item, e )
+                results.append( None )
+        return results
+
+    def run_output( self ):
+        waiting = [] # heap of entries that passed the last stage before an earlier one
+        next_seq = 0
+        while True:
+            entry = self.queues[-1].get()
+            if entry is END:
+                return
+            if not self.ordered:
+                self.emit( entry )
+                continue
+            heapq.heappush( waiting, entry )
+            while waiting and waiting[0][0] == next_seq:
+                self.emit( heapq.heappop( waiting ))
+                next_seq += 1
+
+    def emit( self, entry ):
+        seq, item = entry
+        try:
+            if item is not None:
+                self.output( item )
+        except Exception as e:
+            self.fail( 'output', item, e )
+        finally:
+            self.slots.release()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""Copyright (C) 2019  Andres Barreto and Rich Murphey
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+A download plan: the files of a drive listed before any are downloaded.
+
+A plan is a JSON lines file.  The first line holds the user and the time the
+plan was made; each following line holds one file: its path, its metadata,
+its size, and whether it needed downloading when the plan was made.
+
+A plan is executed in the order given by a schedule policy.  Only the size and
+file offset of each item are held in memory; each item is read from the plan
+file when its turn comes, so that a plan of millions of files can be sorted.
+"""
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+import json
+import sys
+import threading
+import time
+
+from modules.stats import run_stats
+
+policies = [ 'small_first', 'large_first', 'interleaved', 'listed' ]
+
+# an item of a plan: its offset in the plan file, and the bytes to download.
+PlanEntry = namedtuple( 'PlanEntry', 'offset size' )
+
+class PlanWriter( object ):
+    def __init__( self, path, user ):
+        self.handle = open( path, 'w' )
+        self.lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+        self.download_files = 0
+        self.download_bytes = 0
+        self.write_line({ 'kumodd_plan': 1, 'user': user, 'created': datetime.now().isoformat() })
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.close()
+
+    def write_line( self, obj ):
+        self.handle.write( json.dumps( obj, separators=( ',', ':' )) + '\n' )
+
+    def add( self, drive_file, path, size, download ):
+        """Add a file, having size bytes, that is to be placed in path.
+
+        Args:
+          download: False if the file on disk was already valid when the plan was made.
+        """
+        with self.lock:
+            self.write_line({ 'path': path, 'size': size, 'download': download, 'file': drive_file })
+            self.files += 1
+            self.bytes += size
+            if download:
+                self.download_files += 1
+                self.download_bytes += size
+
+    def close( self ):
+        self.handle.close()
+
+    def summary( self ):
+        return ( f'Plan: {self.files} files, {format_bytes( self.bytes )}; '
+                 f'{self.download_files} files, {format_bytes( self.download_bytes )} to download' )
+
+class Plan( object ):
+    def __init__( self, path ):
+        """Read the index of a plan.
+
+        Raises:
+          ValueError: if the file is not a plan.
+        """
+        self.path = path
+        self.entries = []
+        with open( path, 'rb' ) as handle:
+            try:
+                header = json.loads( handle.readline() )
+            except ValueError:
+                header = None
+            if not isinstance( header, dict ) or 'kumodd_plan' not in header:
+                raise ValueError( f'{path} is not a kumodd plan' )
+            self.user = header.get( 'user' )
+            self.created = header.get( 'created' )
+            while True:
+                offset = handle.tell()
+                line = handle.readline()
+                if not line:
+                    break
+                item = json.loads( line )
+                self.entries.append( PlanEntry( offset, item['size'] if item['download'] else 0 ))
+        self.files = len( self.entries )
+        self.bytes = sum( entry.size for entry in self.entries )
+
+    def scheduled( self, policy ):
+        """Yield ( drive_file, path, size ) of each item, in the order given by policy.
+
+        size is the number of bytes to download: zero if the file was valid on disk
+        when the plan was made.
+        """
+        with open( self.path, 'rb' ) as handle:
+            for entry in schedule( self.entries, policy ):
+                handle.seek( entry.offset )
+                item = json.loads( handle.readline() )
+                yield item['file'], item['path'], entry.size
+
+def schedule( entries, policy ):
+    """Return the plan entries in the order given by policy.
+
+    'small_first' downloads the smallest files first, so that many files are
+    done early; 'large_first' starts the largest files first, so that the last
+    files to finish are small ones; 'interleaved' alternates between the
+    largest and the smallest remaining files, so that some workers download
+    large files while the others keep finishing small ones; 'listed' keeps the
+    order in which the files were listed.
+    """
+    if policy == 'listed':
+        return list( entries )
+    by_size = sorted( entries, key=lambda entry: ( entry.size, entry.offset ))
+    if policy == 'small_first':
+        return by_size
+    if policy == 'large_first':
+        return sorted( entries, key=lambda entry: ( -entry.size, entry.offset ))
+    if policy == 'interleaved':
+        ordered = []
+        small, large = 0, len( by_size ) - 1
+        while small <= large:
+            ordered.append( by_size[ large ])
+            large -= 1
+            if small <= large:
+                ordered.append( by_size[ small ])
+                small += 1
+        return ordered
+    raise ValueError( f'unknown schedule policy: {policy}' )
+
+class Progress( object ):
+    """Report the files and bytes done, the bytes remaining and the ETA of a plan.
+
+    A report is written to stderr every interval seconds, by a background thread,
+    so that it is not held up by a long download, and once more at the end.
+    The bytes done count the files completed, or if more, the bytes received so
+    far, which includes the files in progress.
+    """
+    def __init__( self, files, size, interval=10, stream=None ):
+        self.files = files
+        self.size = size
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.lock = threading.Lock()
+        self.files_done = 0
+        self.bytes_done = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __enter__( self ):
+        self.start_time = time.monotonic()
+        self.start_received = self.received()
+        if self.interval > 0:
+            self.thread = threading.Thread( target=self.run, daemon=True )
+            self.thread.start()
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.report()
+
+    def received( self ):
+        return run_stats.counters['bytes_received']
+
+    def done( self, size ):
+        """Count one file, having size bytes to download, as done."""
+        with self.lock:
+            self.files_done += 1
+            self.bytes_done += size
+
+    def run( self ):
+        while not self.stopped.wait( self.interval ):
+            self.report()
+
+    def report( self ):
+        print( self.line(), file=self.stream, flush=True )
+
+    def line( self ):
+        with self.lock:
+            files_done, bytes_done = self.files_done, self.bytes_done
+        seconds = time.monotonic() - self.start_time
+        if files_done < self.files:
+            bytes_done = max( bytes_done, min( self.size, self.received() - self.start_received ))
+        remaining = max( 0, self.size - bytes_done )
+        rate = bytes_done / seconds if seconds > 0 else 0
+        if remaining == 0:
+            eta = '0:00:00'
+        elif rate > 0:
+            eta = str( timedelta( seconds=int( remaining / rate )))
+        else:
+            eta = 'unknown'
+        return ( f'Progress: {files_done} of {self.files} files, {format_bytes( bytes_done )} of '
+                 f'{format_bytes( self.size )}, {format_bytes( remaining )} remaining, '
+                 f'{format_bytes( rate )}/s, ETA {eta}' )
+
+def format_bytes( size ):
+    for unit in ( 'bytes', 'KB', 'MB', 'GB' ):
+        if size < 1000:
+            return f'{size:.0f} {unit}' if unit == 'bytes' else f'{size:.1f} {unit}'
+        size /= 1000
+    return f'{size:.1f} TB'
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""Copyright (C) 2019  Andres Barreto and Rich Murphey
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+A rate limiter shared by all Google Drive API requests.
+
+Requests are divided into quota classes: metadata requests, such as files.list
+and revisions.list, and downloads, such as get_media and exports.  Each class
+has a token bucket that limits the rate of requests, and a limit on the number
+of requests in flight.  Both adapt to Google Drive's responses: when it reports
+a rate limit (429, or 403 rateLimitExceeded), the rate and concurrency are
+halved; after each other response, they increase, up to the configured maximum.
+Up to the rate and concurrency at which the limit was reported, they increase
+by a tenth every round of requests, so that a short burst of errors does not
+slow the rest of the run; above them, by about one request per second every
+second, so that the limit is approached slowly.
+
+Processes collecting several accounts at once share one limiter, held by a
+server process, through proxies.
+"""
+
+from modules.stats import api_method, run_stats
+from multiprocessing.managers import BaseManager
+import httplib2
+import multiprocessing
+import os
+import threading
+import time
+import urllib.parse
+import weakref
+
+# minimum time between decreases, so that one burst of rate limit errors halves the
+# rate once, rather than once per request in flight.
+decrease_interval = 1.0
+
+class QuotaClass( object ):
+    def __init__( self, name, max_rate, max_concurrency ):
+        self.name = name
+        self.max_rate = max_rate
+        self.max_concurrency = max_concurrency
+        self.min_rate = min( 1.0, max_rate )
+        self.rate = max_rate
+        self.limit = float( max_concurrency )
+        self.tokens = max_rate
+        self.last_refill = time.monotonic()
+        self.last_decrease = 0.0
+        # the rate and concurrency at the last decrease
+        self.throttled_rate = 0.0
+        self.throttled_limit = 0.0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+        self.cond = threading.Condition()
+
+    def acquire( self, tokens=1 ):
+        """Wait for a slot within the concurrency limit, then for the bucket to hold tokens."""
+        start = time.monotonic()
+        with self.cond:
+            while self.in_flight >= int( self.limit ):
+                self.cond.wait()
+            self.in_flight += 1
+            self.peak_in_flight = max( self.peak_in_flight, self.in_flight )
+            self.requests += tokens
+            now = time.monotonic()
+            self.tokens = min( self.rate, self.tokens + ( now - self.last_refill ) * self.rate )
+            self.last_refill = now
+            # reserve the tokens now, and wait outside the lock for the deficit to refill.
+            self.tokens -= tokens
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep( delay )
+        with self.cond:
+            self.wait_seconds += time.monotonic() - start
+
+    # throttled is None if the request failed without a response, which changes neither
+    # the rate nor the concurrency.
+    def release( self, throttled ):
+        with self.cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.throttled += 1
+                if now - self.last_decrease >= decrease_interval:
+                    self.last_decrease = now
+                    self.throttled_rate = self.rate
+                    self.throttled_limit = self.limit
+                    self.rate = max( self.min_rate, self.rate / 2 )
+                    self.limit = max( 1.0, self.limit / 2 )
+                    self.tokens = min( self.tokens, 0 )
+            elif throttled is False:
+                # below the rate and limit that were throttled, increase them by a tenth for
+                # each round of requests at the current rate and limit; above them,
+                # additively, by one request per second, and one request in flight.
+                self.rate = min( self.max_rate, self.rate + ( 0.1 if self.rate < self.throttled_rate else 1 / self.rate ))
+                self.limit = min( float( self.max_concurrency ),
+                                  self.limit + ( 0.1 if self.limit < self.throttled_limit else 1 / self.limit ))
+            self.cond.notify_all()
+
+    def counters( self ):
+        with self.cond:
+            return { 'requests': self.requests,
+                     'throttled': self.throttled,
+                     'wait_seconds': round( self.wait_seconds, 3 ),
+                     'rate': round( self.rate, 3 ),
+                     'max_rate': self.max_rate,
+                     'concurrency': int( self.limit ),
+                     'max_concurrency': self.max_concurrency,
+                     'in_flight': self.in_flight,
+                     'peak_in_flight': self.peak_in_flight }
+
+class RateLimiter( object ):
+    def __init__( self, max_rate, max_concurrency ):
+        """Create a limiter.
+
+        Args:
+          max_rate: maximum requests per second in each quota class.
+          max_concurrency: maximum requests in flight in each quota class.
+        """
+        self.max_rate = max_rate
+        self.max_concurrency = max_concurrency
+        self.classes = { name: QuotaClass( name, max_rate, max_concurrency ) for name in ( 'metadata', 'download' ) }
+        limiters.add( self )
+
+    def after_fork( self ):
+        for quota in self.classes.values():
+            quota.cond = threading.Condition()
+            quota.in_flight = 0
+
+    def acquire( self, name, tokens=1 ):
+        self.classes[ name ].acquire( tokens )
+
+    def release( self, name, throttled ):
+        self.classes[ name ].release( throttled )
+
+    def counters( self ):
+        return { name: quota.counters() for name, quota in self.classes.items() }
+
+    def summary( self ):
+        return '\n'.join(
+            f"API {name}: {c['requests']} requests, {c['throttled']} throttled, {c['wait_seconds']:.1f}s waiting, "
+            f"rate {c['rate']:.1f}/s of {c['max_rate']:g}/s, concurrency {c['concurrency']} of {c['max_concurrency']}, "
+            f"peak {c['peak_in_flight']}"
+            for name, c in self.counters().items() )
+
+# the limiters of this process.  A forked worker process has its own limiters, starting
+# with the parent's state, so they are reset by one hook, which holds no reference to
+# them.
+limiters = weakref.WeakSet()
+
+def reset_limiters_after_fork():
+    for limiter in list( limiters ):
+        limiter.after_fork()
+
+if hasattr( os, 'register_at_fork' ):
+    os.register_at_fork( after_in_child=reset_limiters_after_fork )
+
+class LimiterManager( BaseManager ):
+    pass
+
+LimiterManager.register( 'RateLimiter', RateLimiter, exposed=( 'acquire', 'release', 'counters', 'summary' ))
+
+def shared_rate_limiter( max_rate, max_concurrency ):
+    """Start a server process holding one RateLimiter, to be shared by several processes.
+
+    Returns:
+      the manager, which stops the server on shutdown(), and a proxy of the limiter,
+      which is passed to processes forked afterwards.  Each call to the proxy is a
+      round trip to the server, which is small next to a Google Drive request.
+    """
+    manager = LimiterManager( ctx=multiprocessing.get_context( 'fork' ))
+    manager.start()
+    return manager, manager.RateLimiter( max_rate, max_concurrency )
+
+# return the quota class of a request, or None if it is not a Google Drive API request,
+# eg. an OAuth token refresh.
+def quota_class( uri ):
+    url = urllib.parse.urlsplit( uri )
+    if 'alt=media' in url.query or 'export' in url.path or 'exportFormat=' in url.query:
+        return 'download'
+    if url.path.startswith(( '/drive/', '/batch/' )):
+        return 'metadata'
+    return None
+
+# return True if the response reports that a rate limit was exceeded.  A batch
+# response is throttled if any of its parts are.
+def is_throttled( resp, content ):
+    if resp.status == 429:
+        return True
+    if resp.status == 403 or resp.get( 'content-type', '' ).startswith( 'multipart/' ):
+        if isinstance( content, str ):
+            content = content.encode()
+        return b'ateLimitExceeded' in ( content or b'' )
+    return False
+
+class RateLimitedHttp( httplib2.Http ):
+    """An httplib2.Http whose Google Drive API requests are paced by a shared RateLimiter.
+
+    Each worker thread has its own RateLimitedHttp, and all of them share one limiter,
+    or a proxy of a limiter shared with other processes.  If a transport is given,
+    eg. an AsyncTransport, requests are sent over it rather than over this object's
+    own connection.
+    """
+    def __init__( self, limiter, transport=None, **kwargs ):
+        super().__init__( **kwargs )
+        self.limiter = limiter
+        self.transport = transport
+
+    def send( self, uri, method, body, headers, *args, **kwargs ):
+        if self.transport:
+            return self.transport.call( uri, method, body, headers )
+        return super().request( uri, method, body, headers, *args, **kwargs )
+
+    def request( self, uri, method='GET', body=None, headers=None, *args, **kwargs ):
+        name = quota_class( uri )
+        if name is None or self.limiter is None:
+            return self.send( uri, method, body, headers, *args, **kwargs )
+        # Google Drive counts each request in a batch against the quota.
+        tokens = 1
+        if body and uri.split( '?' )[0].endswith( '/batch/drive/v3' ):
+            tokens = max( 1, body.count( 'application/http' if isinstance( body, str ) else b'application/http' ))
+        self.limiter.acquire( name, tokens )
+        throttled = None
+        status, received = 'error', 0
+        start = time.perf_counter()
+        try:
+            resp, content = self.send( uri, method, body, headers, *args, **kwargs )
+            throttled = is_throttled( resp, content )
+            status, received = resp.status, len( content or b'' )
+            return resp, content
+        finally:
+            self.limiter.release( name, throttled )
+            run_stats.api_call( api_method( uri, method ), status, received, time.perf_counter() - start )
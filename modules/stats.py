@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""Copyright (C) 2019  Andres Barreto and Rich Murphey
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+Counters and timers of a kumodd run, saved as JSON or as a Prometheus textfile.
+
+Each phase of the work, such as listing, downloading or hashing, is timed
+each time it runs.  Phases run concurrently on worker threads, so a phase's
+seconds are the sum over all threads, and may exceed the run's duration.
+API requests are counted by method and HTTP status.
+"""
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import functools
+import json
+import os
+import re
+import threading
+import time
+import urllib.parse
+
+class RunStats( object ):
+    def __init__( self ):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset( self ):
+        with self.lock:
+            self.phases = defaultdict( lambda: [ 0, 0.0 ] )
+            self.api_calls = Counter()
+            self.api_seconds = Counter()
+            self.counters = Counter()
+
+    @contextmanager
+    def phase( self, name ):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                phase = self.phases[ name ]
+                phase[0] += 1
+                phase[1] += seconds
+
+    def timed( self, name ):
+        """Decorate a function, so that each call is timed as the named phase."""
+        def decorator( fn ):
+            @functools.wraps( fn )
+            def wrapper( *args, **kwargs ):
+                with self.phase( name ):
+                    return fn( *args, **kwargs )
+            return wrapper
+        return decorator
+
+    def count( self, name, n=1 ):
+        with self.lock:
+            self.counters[ name ] += n
+
+    def api_call( self, method, status, received, seconds ):
+        with self.lock:
+            self.api_calls[ ( method, status ) ] += 1
+            self.api_seconds[ method ] += seconds
+            self.counters['bytes_received'] += received
+
+    def take( self ):
+        """Return and clear the stats, eg. to send them from a worker process to the parent."""
+        with self.lock:
+            taken = ( dict( self.phases ), self.api_calls, self.api_seconds, self.counters )
+        self.reset()
+        return taken
+
+    def add( self, taken ):
+        """Add stats taken from another process."""
+        phases, api_calls, api_seconds, counters = taken
+        with self.lock:
+            for name, ( count, seconds ) in phases.items():
+                self.phases[ name ][0] += count
+                self.phases[ name ][1] += seconds
+            self.api_calls.update( api_calls )
+            self.api_seconds.update( api_seconds )
+            self.counters.update( counters )
+
+    def as_dict( self, **extra ):
+        with self.lock:
+            api = defaultdict( dict )
+            for ( method, status ), count in sorted( self.api_calls.items() ):
+                api[ method ][ str( status ) ] = count
+            return dict(
+                phases={ name: { 'count': count, 'seconds': round( seconds, 6 ) }
+                         for name, ( count, seconds ) in sorted( self.phases.items() ) },
+                api_calls=dict( api ),
+                api_seconds={ method: round( seconds, 6 ) for method, seconds in sorted( self.api_seconds.items() ) },
+                counters=dict( sorted( self.counters.items() )),
+                **extra )
+
+    def write_json( self, path, **extra ):
+        write_atomically( path, json.dumps( self.as_dict( **extra ), indent=2 ) + '\n' )
+
+    def write_prometheus( self, path, labels=None, **extra ):
+        """Write the stats in the Prometheus text format, eg. for the node exporter's textfile collector.
+
+        Numeric values in extra are written as kumodd_<name> gauges.
+        """
+        stats = self.as_dict()
+        lines = []
+        def metric( name, kind, help_text, samples ):
+            lines.append( f'# HELP kumodd_{name} {help_text}' )
+            lines.append( f'# TYPE kumodd_{name} {kind}' )
+            for sample_labels, value in samples:
+                lines.append( f'kumodd_{name}{format_labels( dict( labels or {}, **sample_labels ))} {value}' )
+        metric( 'phase_seconds_total', 'counter', 'Seconds spent in each phase, summed over threads.',
+                [( { 'phase': name }, phase['seconds'] ) for name, phase in stats['phases'].items() ])
+        metric( 'phase_runs_total', 'counter', 'Number of times each phase ran.',
+                [( { 'phase': name }, phase['count'] ) for name, phase in stats['phases'].items() ])
+        metric( 'api_requests_total', 'counter', 'Google Drive API requests, by method and HTTP status.',
+                [( { 'method': method, 'status': status }, count )
+                 for method, statuses in stats['api_calls'].items() for status, count in statuses.items() ])
+        metric( 'api_seconds_total', 'counter', 'Seconds spent waiting for Google Drive API responses, by method.',
+                [( { 'method': method }, seconds ) for method, seconds in stats['api_seconds'].items() ])
+        for name, value in stats['counters'].items():
+            metric( f'{name}_total', 'counter', f'Total {name.replace( "_", " " )}.', [( {}, value )])
+        for name, value in extra.items():
+            if isinstance( value, ( int, float )) and not isinstance( value, bool ):
+                metric( name, 'gauge', f'{name.replace( "_", " " ).capitalize()}.', [( {}, value )])
+        write_atomically( path, '\n'.join( lines ) + '\n' )
+
+def format_labels( labels ):
+    if not labels:
+        return ''
+    return '{' + ','.join( f'{name}="{escape_label( value )}"' for name, value in labels.items() ) + '}'
+
+def escape_label( value ):
+    return str( value ).replace( '\\', '\\\\' ).replace( '"', '\\"' ).replace( '\n', '\\n' )
+
+# write a file under a temporary name, then rename it, so that a collector never reads
+# a partial file.
+def write_atomically( path, text ):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open( tmp, 'w' ) as handle:
+        handle.write( text )
+    os.replace( tmp, path )
+
+# return the name of the Google Drive API method of a request, eg. 'files.list'.
+def api_method( uri, method='GET' ):
+    url = urllib.parse.urlsplit( uri )
+    path = url.path
+    if '/batch/' in path:
+        return 'batch'
+    match = re.search( r'/drive/v3/(.*)$', path )
+    if not match:
+        return 'exportLinks' if 'export' in path else 'other'
+    parts = match.group( 1 ).split( '/' )
+    resource = parts[0]
+    if resource == 'files' and len( parts ) >= 3:
+        if parts[2] == 'revisions':
+            return 'revisions.list' if len( parts ) == 3 else 'revisions.get'
+        return f'files.{parts[2]}'
+    if len( parts ) >= 2 and resource == 'changes':
+        return f'changes.{parts[1]}'
+    if resource in ( 'files', 'changes' ):
+        if len( parts ) == 1:
+            return f'{resource}.list' if method == 'GET' else f'{resource}.create'
+        return f'{resource}.get_media' if 'alt=media' in url.query else f'{resource}.get'
+    return f'{resource}.get'
+
+# the stats of this run
+run_stats = RunStats()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""Copyright (C) 2019  Andres Barreto and Rich Murphey
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+An asyncio transport for Google Drive API requests, using aiohttp.
+
+httplib2 is not thread-safe, and sends one request at a time on a connection,
+so each kumodd worker thread has a connection of its own.  This transport sends
+all requests from one event loop thread, over a pool of keep-alive connections
+shared by all workers, so that many requests can be in flight with few
+connections.
+
+It is a drop-in HTTP backend, and does not change kumodd's threading model:
+call() blocks its worker thread until the response arrives, so each request in
+flight still occupies a worker thread, and the workers, not -connections, bound
+the requests in flight.
+
+A transport has two methods: request(), a coroutine, for coroutines running
+on the transport's loop, and call(), which runs request() from any other
+thread and waits for its response.  Both return ( httplib2.Response, content ),
+as httplib2.Http.request() does, so that RateLimitedHttp can send requests
+over a transport in place of its own connection, and googleapiclient and
+oauth2client work unchanged on top of it.
+
+aiohttp is optional.  Without it, AsyncTransport() raises ImportError.
+"""
+
+import asyncio
+import httplib2
+import os
+import threading
+import weakref
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+class AsyncTransport( object ):
+    def __init__( self, max_connections=100, proxy=None, connect_timeout=60, read_timeout=300 ):
+        """Create a transport.  Its loop thread is started on the first request.
+
+        Args:
+          max_connections: maximum number of connections open at once.  Further
+            requests wait for a connection.
+          proxy: URL of an HTTP proxy, eg. 'http://proxy:3128', or None.
+          connect_timeout: seconds to wait for a connection.
+          read_timeout: seconds to wait for each read of a response.
+        """
+        if aiohttp is None:
+            raise ImportError( 'the aiohttp transport requires the aiohttp package.  Install it with: pip install aiohttp' )
+        self.max_connections = max_connections
+        self.proxy = proxy
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.reset()
+        transports.add( self )
+
+    def reset( self ):
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+        self.session = None
+
+    # return the loop, starting its thread if it is not running.
+    def start( self ):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread( target=self.loop.run_forever, name='kumodd-transport', daemon=True )
+                self.thread.start()
+            return self.loop
+
+    async def request( self, uri, method='GET', body=None, headers=None ):
+        # the session is created on the loop, and only used there.
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector( limit=self.max_connections ),
+                timeout=aiohttp.ClientTimeout( sock_connect=self.connect_timeout, sock_read=self.read_timeout ))
+        # oauth2client may give header names and values as bytes.
+        headers = { as_str( name ): as_str( value ) for name, value in ( headers or {} ).items() }
+        try:
+            async with self.session.request( method, uri, data=body, headers=headers, proxy=self.proxy ) as response:
+                content = await response.read()
+        except aiohttp.ClientError as e:
+            # an OSError, like httplib2's socket errors, so that it is retried as one.
+            raise ConnectionError( f'{type( e ).__name__}: {e}' ) from e
+        info = { name.lower(): value for name, value in response.headers.items() }
+        # the content has been decompressed, so its encoding and length have changed.
+        info.pop( 'content-encoding', None )
+        info['content-length'] = str( len( content ))
+        info['status'] = str( response.status )
+        resp = httplib2.Response( info )
+        resp.reason = response.reason
+        return resp, content
+
+    def call( self, uri, method='GET', body=None, headers=None ):
+        """Send a request from a thread other than the loop's, and wait for its response."""
+        future = asyncio.run_coroutine_threadsafe( self.request( uri, method, body, headers ), self.start() )
+        return future.result()
+
+    def close( self ):
+        with self.lock:
+            loop, thread, session = self.loop, self.thread, self.session
+            self.loop = self.thread = self.session = None
+        if loop is None:
+            return
+        if session:
+            asyncio.run_coroutine_threadsafe( session.close(), loop ).result()
+        loop.call_soon_threadsafe( loop.stop )
+        thread.join()
+        loop.close()
+
+# the transports of this process.  A forked process has no loop thread, so each
+# transport is reset, by one hook holding no reference to them, and starts its own
+# loop on first use.
+transports = weakref.WeakSet()
+
+def reset_transports_after_fork():
+    for transport in list( transports ):
+        transport.reset()
+
+if hasattr( os, 'register_at_fork' ):
+    os.register_at_fork( after_in_child=reset_transports_after_fork )
+
+def as_str( value ):
+    return value.decode( 'latin-1' ) if isinstance( value, bytes ) else str( value )
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""Copyright (C) 2019  Andres Barreto and Rich Murphey
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+Tests of the content-addressed blob store.
+"""
+
+import errno
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from modules.blobstore import BlobStore
+
+class BlobStoreTest( unittest.TestCase ):
+    def setUp( self ):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup( self.tmp.cleanup )
+
+    def path( self, name ):
+        return os.path.join( self.tmp.name, name )
+
+    def write( self, name, data ):
+        with open( self.path( name ), 'wb' ) as handle:
+            handle.write( data )
+        return self.path( name ), hashlib.md5( data ).hexdigest()
+
+    def read( self, name ):
+        with open( self.path( name ), 'rb' ) as handle:
+            return handle.read()
+
+    def store( self, link_mode ):
+        return BlobStore( self.path( 'blobs' ), link_mode )
+
+    def test_add_and_link( self ):
+        for link_mode in ( 'reflink', 'hardlink', 'copy' ):
+            store = self.store( link_mode )
+            path, md5 = self.write( 'a', b'content' )
+            store.add( path, md5 )
+            self.assertTrue( store.has( md5, 7 ))
+            self.assertFalse( store.has( md5, 8 ))
+            self.assertTrue( store.link( md5, self.path( 'b' ), 7 ))
+            self.assertEqual( self.read( 'b' ), b'content' )
+            self.assertEqual( os.path.samefile( self.path( 'b' ), store.path( md5 )), link_mode == 'hardlink' )
+
+    def test_link_of_missing_or_other_size( self ):
+        store = self.store( 'copy' )
+        path, md5 = self.write( 'a', b'content' )
+        self.assertFalse( store.link( md5, self.path( 'b' )))
+        store.add( path, md5 )
+        self.assertFalse( store.link( md5, self.path( 'b' ), 8 ))
+        self.assertFalse( os.path.exists( self.path( 'b' )))
+
+    def test_corrupt_copy_is_discarded( self ):
+        store = self.store( 'copy' )
+        path, md5 = self.write( 'a', b'content' )
+        os.makedirs( os.path.dirname( store.path( md5 )))
+        with open( store.path( md5 ), 'wb' ) as handle:
+            handle.write( b'CONTENT' )
+        self.assertFalse( store.link( md5, self.path( 'b' ), 7 ))
+        self.assertFalse( store.has( md5 ))
+        self.assertEqual( store.discarded, 1 )
+
+    def test_place_replaces_dest( self ):
+        store = self.store( 'copy' )
+        src, md5 = self.write( 'a', b'new' )
+        dest, md5 = self.write( 'b', b'old' )
+        store.place( src, dest )
+        self.assertEqual( self.read( 'b' ), b'new' )
+        self.assertEqual( sorted( os.listdir( self.tmp.name )), [ 'a', 'b', 'blobs' ])
+
+    def test_failed_place_keeps_dest_and_removes_partial_copy( self ):
+        store = self.store( 'copy' )
+        src, md5 = self.write( 'a', b'new' )
+        dest, md5 = self.write( 'b', b'old' )
+        def partial_copy( src, tmp ):
+            with open( tmp, 'wb' ) as handle:
+                handle.write( b'ne' )
+            raise OSError( 'disk full' )
+        with mock.patch( 'modules.blobstore.shutil.copyfile', partial_copy ):
+            with self.assertRaises( OSError ):
+                store.place( src, dest )
+        self.assertEqual( self.read( 'b' ), b'old' )
+        self.assertEqual( sorted( os.listdir( self.tmp.name )), [ 'a', 'b', 'blobs' ])
+
+    def test_interrupted_place_removes_partial_copy( self ):
+        store = self.store( 'copy' )
+        src, md5 = self.write( 'a', b'new' )
+        def interrupted_copy( src, tmp ):
+            open( tmp, 'wb' ).close()
+            raise KeyboardInterrupt()
+        with mock.patch( 'modules.blobstore.shutil.copyfile', interrupted_copy ):
+            with self.assertRaises( KeyboardInterrupt ):
+                store.place( src, self.path( 'b' ))
+        self.assertEqual( sorted( os.listdir( self.tmp.name )), [ 'a', 'blobs' ])
+
+    def test_hardlink_falls_back_to_copy( self ):
+        store = self.store( 'hardlink' )
+        src, md5 = self.write( 'a', b'content' )
+        with mock.patch( 'modules.blobstore.os.link', side_effect=OSError( errno.EXDEV, 'Invalid cross-device link' )):
+            store.place( src, self.path( 'b' ))
+        self.assertEqual( self.read( 'b' ), b'content' )
+        self.assertFalse( os.path.samefile( src, self.path( 'b' )))
+
+    def test_hardlink_mode_links_duplicates_to_the_stored_copy( self ):
+        store = self.store( 'hardlink' )
+        a, md5 = self.write( 'a', b'content' )
+        b, md5 = self.write( 'b', b'content' )
+        store.add( a, md5 )
+        store.add( b, md5 )
+        self.assertTrue( os.path.samefile( a, b ))
+        self.assertEqual( store.added, 1 )
+
+if __name__ == '__main__':
+    unittest.main()
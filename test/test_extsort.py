@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Copyright (C) 2019  Andres Barreto and Rich Murphey
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+Tests of the external merge sort of CSV rows.
+"""
+
+import os
+import random
+import unittest
+
+from modules.extsort import ExternalSort
+
+class ExternalSortTest( unittest.TestCase ):
+    def rows( self, n, seed=1 ):
+        rng = random.Random( seed )
+        return [[ f'2019-01-{rng.randint( 1, 28 ):02}', str( rng.randint( 0, 99 )), f'file{i}' ] for i in range( n )]
+
+    def sort( self, rows, **kwargs ):
+        with ExternalSort( **kwargs ) as sort:
+            for row in rows:
+                sort.writerow( row )
+            return list( sort.sorted() ), sort.run_count
+
+    def test_in_memory( self ):
+        rows = self.rows( 100 )
+        result, runs = self.sort( rows )
+        self.assertEqual( result, sorted( rows ))
+        self.assertEqual( runs, 0 )
+
+    def test_merges_runs( self ):
+        rows = self.rows( 1000 )
+        result, runs = self.sort( rows, max_rows=64 )
+        self.assertEqual( result, sorted( rows ))
+        self.assertEqual( runs, 16 )
+
+    def test_merges_runs_in_passes( self ):
+        rows = self.rows( 1000 )
+        result, runs = self.sort( rows, max_rows=10, max_runs=4 )
+        self.assertEqual( result, sorted( rows ))
+        # 100 runs, merged four at a time, leave at most four runs for the last merge.
+        self.assertGreater( runs, 100 )
+
+    def test_values_are_written_as_strings( self ):
+        result, runs = self.sort([[ 'b', None ], [ 'a', 3 ], [ 'b', '' ]], max_rows=2 )
+        self.assertEqual( result, [[ 'a', '3' ], [ 'b', '' ], [ 'b', '' ]])
+
+    def test_quoted_values( self ):
+        rows = [[ 'b', 'x,y' ], [ 'a', 'line\nbreak' ], [ 'c', '"quoted"' ]]
+        result, runs = self.sort( rows, max_rows=1 )
+        self.assertEqual( result, sorted( rows ))
+
+    def test_runs_are_removed( self ):
+        sort = ExternalSort( max_rows=2 )
+        for row in self.rows( 10 ):
+            sort.writerow( row )
+        tmp = sort.tmp.name
+        list( sort.sorted() )
+        sort.close()
+        self.assertFalse( os.path.exists( tmp ))
+
+if __name__ == '__main__':
+    unittest.main()
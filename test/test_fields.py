@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Copyright (C) 2019  Andres Barreto and Rich Murphey
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+Tests of the projection of metadata onto a fields mask.
+"""
+
+import unittest
+
+from modules.gdrive import list_fields, parse_fields, project_fields, project_metadata
+
+class FieldsTest( unittest.TestCase ):
+    def test_parse_fields( self ):
+        self.assertEqual( parse_fields( 'id,name' ), { 'id': None, 'name': None })
+        self.assertEqual( parse_fields( 'id, owners(emailAddress,displayName),size' ),
+                          { 'id': None, 'owners': { 'emailAddress': None, 'displayName': None }, 'size': None })
+        self.assertEqual( parse_fields( 'a(b(c),d),e' ), { 'a': { 'b': { 'c': None }, 'd': None }, 'e': None })
+
+    def test_project_fields( self ):
+        mask = parse_fields( 'owners(emailAddress)' )['owners']
+        owners = [{ 'emailAddress': 'a@x.com', 'displayName': 'A' }, { 'emailAddress': 'b@x.com', 'kind': 'drive#user' }]
+        self.assertEqual( project_fields( owners, mask ), [{ 'emailAddress': 'a@x.com' }, { 'emailAddress': 'b@x.com' }])
+        self.assertEqual( project_fields( 'value', None ), 'value' )
+
+    def test_list_fields( self ):
+        self.assertEqual( list_fields( 'files', 'id,name' ), 'nextPageToken,files(id,name)' )
+        self.assertEqual( list_fields( 'files', '*' ), '*' )
+
+class ProjectMetadataTest( unittest.TestCase ):
+    saved = {
+        'id': '1',
+        'name': 'a.txt',
+        'starred': False,
+        'owners': [{ 'emailAddress': 'a@x.com', 'displayName': 'A' }],
+        'revisions': [{ 'id': 'r1', 'md5Checksum': '0f', 'keepForever': False }],
+        'path': './a',
+        'local_md5': '0f',
+    }
+
+    def test_all_fields( self ):
+        self.assertIs( project_metadata( self.saved, '*' ), self.saved )
+
+    def test_fields_not_requested_are_dropped( self ):
+        projected = project_metadata( self.saved, 'id,name,owners(emailAddress)' )
+        self.assertEqual( projected['owners'], [{ 'emailAddress': 'a@x.com' }])
+        self.assertNotIn( 'starred', projected )
+
+    def test_kumodd_fields_are_kept( self ):
+        projected = project_metadata( self.saved, 'id' )
+        self.assertEqual(( projected['path'], projected['local_md5'] ), ( './a', '0f' ))
+
+    def test_revisions_are_limited_to_the_revision_fields( self ):
+        projected = project_metadata( self.saved, 'id' )
+        self.assertEqual( projected['revisions'], [{ 'id': 'r1', 'md5Checksum': '0f' }])
+
+    def test_saved_and_retrieved_compare_equal( self ):
+        fields = 'id,name,owners(emailAddress)'
+        retrieved = { 'id': '1', 'name': 'a.txt', 'owners': [{ 'emailAddress': 'a@x.com' }],
+                      'revisions': [{ 'id': 'r1', 'md5Checksum': '0f' }], 'path': './a', 'local_md5': '0f' }
+        self.assertEqual( project_metadata( self.saved, fields ), project_metadata( retrieved, fields ))
+
+    def test_requested_field_no_longer_retrieved_differs( self ):
+        fields = 'id,name,starred'
+        retrieved = dict( self.saved )
+        del retrieved['starred']
+        self.assertNotEqual( project_metadata( self.saved, fields ), project_metadata( retrieved, fields ))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""Copyright (C) 2019  Andres Barreto and Rich Murphey
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+Tests of the MD5 cache of local files.
+"""
+
+import os
+import tempfile
+import unittest
+
+from modules.hashcache import HashCache
+
+class HashCacheTest( unittest.TestCase ):
+    def setUp( self ):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup( self.tmp.cleanup )
+        self.db_path = os.path.join( self.tmp.name, 'cache.db' )
+        self.file_path = os.path.join( self.tmp.name, 'file' )
+        self.write( b'first' )
+        self.hashed = []
+
+    def write( self, data, mtime_ns=None ):
+        with open( self.file_path, 'wb' ) as handle:
+            handle.write( data )
+        if mtime_ns is not None:
+            os.utime( self.file_path, ns=( mtime_ns, mtime_ns ))
+
+    def hash_file( self, path ):
+        with open( path, 'rb' ) as handle:
+            data = handle.read()
+        self.hashed.append( data )
+        return 'md5-' + data.decode()
+
+    def open_cache( self, **kwargs ):
+        cache = HashCache( self.db_path, **kwargs )
+        self.addCleanup( cache.close )
+        return cache
+
+    def test_unchanged_file_is_not_hashed_again( self ):
+        cache = self.open_cache()
+        self.assertEqual( cache.md5( self.file_path, self.hash_file ), 'md5-first' )
+        self.assertEqual( cache.md5( self.file_path, self.hash_file ), 'md5-first' )
+        self.assertEqual( self.hashed, [ b'first' ])
+        self.assertEqual(( cache.hits, cache.misses ), ( 1, 1 ))
+
+    def test_cache_persists_across_runs( self ):
+        cache = self.open_cache()
+        cache.md5( self.file_path, self.hash_file )
+        cache.close()
+        cache = self.open_cache()
+        self.assertEqual( cache.md5( self.file_path, self.hash_file ), 'md5-first' )
+        self.assertEqual( self.hashed, [ b'first' ])
+
+    def test_changed_size_is_hashed_again( self ):
+        cache = self.open_cache()
+        cache.md5( self.file_path, self.hash_file )
+        self.write( b'longer' )
+        self.assertEqual( cache.md5( self.file_path, self.hash_file ), 'md5-longer' )
+
+    def test_changed_mtime_is_hashed_again( self ):
+        self.write( b'first', mtime_ns=1000000000 )
+        cache = self.open_cache()
+        cache.md5( self.file_path, self.hash_file )
+        # the same size, rewritten with a different time stamp.
+        self.write( b'other', mtime_ns=2000000000 )
+        self.assertEqual( cache.md5( self.file_path, self.hash_file ), 'md5-other' )
+
+    def test_replaced_file_is_hashed_again( self ):
+        self.write( b'first', mtime_ns=1000000000 )
+        cache = self.open_cache()
+        cache.md5( self.file_path, self.hash_file )
+        # a new inode, having the same size and time stamp.
+        keep = self.file_path + '.keep'
+        os.rename( self.file_path, keep )
+        self.write( b'other', mtime_ns=1000000000 )
+        self.assertEqual( cache.md5( self.file_path, self.hash_file ), 'md5-other' )
+
+    def test_forget( self ):
+        cache = self.open_cache()
+        cache.md5( self.file_path, self.hash_file )
+        cache.forget( self.file_path )
+        cache.md5( self.file_path, self.hash_file )
+        self.assertEqual( len( self.hashed ), 2 )
+
+    def test_rehash_ignores_cached_values( self ):
+        cache = self.open_cache()
+        cache.md5( self.file_path, self.hash_file )
+        cache.close()
+        cache = self.open_cache( rehash=True )
+        cache.md5( self.file_path, self.hash_file )
+        self.assertEqual( len( self.hashed ), 2 )
+
+    def test_deferred_entries_are_added_by_another_cache( self ):
+        worker = self.open_cache( defer_writes=True )
+        worker.md5( self.file_path, self.hash_file )
+        entries, hits, misses = worker.take_deferred()
+        self.assertEqual(( len( entries ), hits, misses ), ( 1, 0, 1 ))
+        self.assertEqual( worker.take_deferred(), ( [], 0, 0 ))
+        cache = self.open_cache()
+        cache.add( entries, hits, misses )
+        self.assertEqual( cache.md5( self.file_path, self.hash_file ), 'md5-first' )
+        self.assertEqual( len( self.hashed ), 1 )
+        self.assertEqual(( cache.hits, cache.misses ), ( 1, 1 ))
+
+    def test_new_connection_after_fork( self ):
+        cache = self.open_cache()
+        inherited = cache.connection
+        cache.after_fork()
+        self.assertIsNot( cache.db, inherited )
+        self.assertEqual( cache.inherited, [ inherited ])
+        inherited.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Copyright (C) 2019  Andres Barreto and Rich Murphey
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+Tests of the pipeline of stages.
+"""
+
+import logging
+import random
+import threading
+import time
+import unittest
+
+from modules.pipeline import Pipeline, Stage
+from modules.stats import run_stats
+
+class PipelineTest( unittest.TestCase ):
+    def setUp( self ):
+        run_stats.reset()
+        logging.disable( logging.CRITICAL )
+        self.addCleanup( logging.disable, logging.NOTSET )
+        self.output = []
+        self.dropped = []
+
+    def run_items( self, stages, items, **kwargs ):
+        with Pipeline( stages, self.output.append, queue_size=4, dropped=self.dropped.append, **kwargs ) as pipeline:
+            for item in items:
+                pipeline.put( item )
+        return self.output
+
+    def test_ordered( self ):
+        rng = random.Random( 1 )
+        def slow( item ):
+            time.sleep( rng.random() / 1000 )
+            return item
+        stages = [ Stage( 'a', slow, 4 ), Stage( 'b', lambda item: item * 2, 2 ) ]
+        self.assertEqual( self.run_items( stages, range( 100 )), [ i * 2 for i in range( 100 )])
+
+    def test_unordered( self ):
+        stages = [ Stage( 'a', lambda item: item + 1, 4 ) ]
+        self.assertEqual( sorted( self.run_items( stages, range( 100 ), ordered=False )), list( range( 1, 101 )))
+
+    def test_stage_may_drop_items( self ):
+        stages = [ Stage( 'odd', lambda item: item if item % 2 else None, 2 ), Stage( 'b', lambda item: item, 1 ) ]
+        self.assertEqual( self.run_items( stages, range( 10 )), [ 1, 3, 5, 7, 9 ])
+        self.assertEqual( self.dropped, [] )
+
+    def test_batches( self ):
+        batches = []
+        def batch( items ):
+            batches.append( len( items ))
+            return [ item * 10 for item in items ]
+        stages = [ Stage( 'batch', batch, 1, batch_size=5, batch_wait=0.5 ) ]
+        self.assertEqual( self.run_items( stages, range( 12 )), [ i * 10 for i in range( 12 )])
+        self.assertEqual( sum( batches ), 12 )
+        self.assertLessEqual( max( batches ), 5 )
+
+    def test_error_drops_only_that_item( self ):
+        def fail_on_3( item ):
+            if item == 3:
+                raise ValueError( 'bad file' )
+            return item
+        stages = [ Stage( 'a', fail_on_3, 2 ), Stage( 'b', lambda item: item, 1 ) ]
+        self.assertEqual( self.run_items( stages, range( 8 )), [ 0, 1, 2, 4, 5, 6, 7 ])
+        self.assertEqual( self.dropped, [ 3 ])
+        self.assertEqual( run_stats.counters['pipeline_errors'], 1 )
+
+    def test_error_is_logged( self ):
+        logging.disable( logging.NOTSET )
+        def fail( item ):
+            raise ValueError( 'bad file' )
+        with self.assertLogs( level='CRITICAL' ) as logs:
+            self.run_items([ Stage( 'fetch', fail ) ], [ 'a.txt' ])
+        self.assertIn( 'fetch failed for a.txt: bad file', logs.output[0] )
+
+    def test_error_in_batch_drops_only_that_item( self ):
+        calls = []
+        def batch( items ):
+            calls.append( list( items ))
+            if 5 in items:
+                raise ValueError( 'bad file' )
+            return items
+        stages = [ Stage( 'batch', batch, 1, batch_size=4, batch_wait=0.5 ) ]
+        self.assertEqual( self.run_items( stages, range( 10 )), [ 0, 1, 2, 3, 4, 6, 7, 8, 9 ])
+        self.assertEqual( self.dropped, [ 5 ])
+        # the failed batch is called again on each item.
+        self.assertIn( [ 5 ], calls )
+
+    def test_error_in_output_drops_only_that_item( self ):
+        def output( item ):
+            if item == 2:
+                raise ValueError( 'cannot write' )
+            self.output.append( item )
+        with Pipeline([ Stage( 'a', lambda item: item ) ], output, dropped=self.dropped.append ) as pipeline:
+            for item in range( 5 ):
+                pipeline.put( item )
+        self.assertEqual( self.output, [ 0, 1, 3, 4 ])
+        self.assertEqual( self.dropped, [ 2 ])
+
+    def test_items_are_bounded( self ):
+        release = threading.Event()
+        def blocked( item ):
+            release.wait()
+            return item
+        pipeline = Pipeline([ Stage( 'blocked', blocked ) ], self.output.append, queue_size=2 )
+        put = []
+        def producer():
+            with pipeline:
+                for item in range( 100 ):
+                    pipeline.put( item )
+                    put.append( item )
+        thread = threading.Thread( target=producer, daemon=True )
+        thread.start()
+        time.sleep( 0.2 )
+        # the item held by the stage's thread, and the two in the queue before it.
+        self.assertEqual( len( put ), 3 )
+        release.set()
+        thread.join( 10 )
+        self.assertEqual( self.output, list( range( 100 )))
+
+if __name__ == '__main__':
+    unittest.main()
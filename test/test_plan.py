@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Copyright (C) 2019  Andres Barreto and Rich Murphey
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+Tests of download plans and their schedules.
+"""
+
+import io
+import os
+import tempfile
+import unittest
+
+from modules.plan import Plan, PlanEntry, PlanWriter, Progress, format_bytes, policies, schedule
+
+class ScheduleTest( unittest.TestCase ):
+    # listed in this order; entries of the same size keep it.
+    entries = [ PlanEntry( offset, size ) for offset, size in enumerate([ 30, 10, 50, 20, 10, 40 ]) ]
+
+    def sizes( self, policy ):
+        return [ entry.size for entry in schedule( self.entries, policy ) ]
+
+    def test_listed( self ):
+        self.assertEqual( self.sizes( 'listed' ), [ 30, 10, 50, 20, 10, 40 ])
+
+    def test_small_first( self ):
+        self.assertEqual( schedule( self.entries, 'small_first' )[:2], [ PlanEntry( 1, 10 ), PlanEntry( 4, 10 )])
+        self.assertEqual( self.sizes( 'small_first' ), [ 10, 10, 20, 30, 40, 50 ])
+
+    def test_large_first( self ):
+        self.assertEqual( self.sizes( 'large_first' ), [ 50, 40, 30, 20, 10, 10 ])
+        self.assertEqual( schedule( self.entries, 'large_first' )[-2:], [ PlanEntry( 1, 10 ), PlanEntry( 4, 10 )])
+
+    def test_interleaved( self ):
+        self.assertEqual( self.sizes( 'interleaved' ), [ 50, 10, 40, 10, 30, 20 ])
+        self.assertEqual( [ entry.size for entry in schedule( self.entries[:5], 'interleaved' )], [ 50, 10, 30, 10, 20 ])
+
+    def test_every_policy_schedules_every_entry_once( self ):
+        for policy in policies:
+            self.assertEqual( sorted( schedule( self.entries, policy )), sorted( self.entries ))
+            self.assertEqual( schedule( [], policy ), [] )
+
+    def test_unknown_policy( self ):
+        with self.assertRaises( ValueError ):
+            schedule( self.entries, 'random' )
+
+class PlanTest( unittest.TestCase ):
+    def setUp( self ):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup( self.tmp.cleanup )
+        self.path = os.path.join( self.tmp.name, 'plan.jsonl' )
+
+    def test_write_and_read( self ):
+        with PlanWriter( self.path, 'u@x.com' ) as writer:
+            writer.add({ 'id': 'a' }, './a', 300, True )
+            writer.add({ 'id': 'b' }, './b', 100, True )
+            writer.add({ 'id': 'c' }, './c', 200, False )
+        self.assertEqual( writer.summary(), 'Plan: 3 files, 600 bytes; 2 files, 400 bytes to download' )
+        plan = Plan( self.path )
+        self.assertEqual(( plan.user, plan.files, plan.bytes ), ( 'u@x.com', 3, 400 ))
+        # a file that was valid on disk has nothing to download.
+        self.assertEqual( list( plan.scheduled( 'small_first' )),
+                          [( { 'id': 'c' }, './c', 0 ), ( { 'id': 'b' }, './b', 100 ), ( { 'id': 'a' }, './a', 300 )])
+
+    def test_not_a_plan( self ):
+        with open( self.path, 'w' ) as handle:
+            handle.write( 'path,size\n' )
+        with self.assertRaises( ValueError ):
+            Plan( self.path )
+
+class ProgressTest( unittest.TestCase ):
+    def test_line( self ):
+        stream = io.StringIO()
+        with Progress( 4, 2000, interval=0, stream=stream ) as progress:
+            progress.done( 1000 )
+            progress.done( 1000 )
+            progress.done( 0 )
+            progress.done( 0 )
+        self.assertRegex( stream.getvalue(),
+                          r'^Progress: 4 of 4 files, 2.0 KB of 2.0 KB, 0 bytes remaining, .*/s, ETA 0:00:00\n$' )
+
+    def test_format_bytes( self ):
+        self.assertEqual( format_bytes( 999 ), '999 bytes' )
+        self.assertEqual( format_bytes( 1500 ), '1.5 KB' )
+        self.assertEqual( format_bytes( 2.5e9 ), '2.5 GB' )
+        self.assertEqual( format_bytes( 3e12 ), '3.0 TB' )
+
+if __name__ == '__main__':
+    unittest.main()
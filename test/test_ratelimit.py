@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Copyright (C) 2019  Andres Barreto and Rich Murphey
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+Tests of the adaptive rate limiter.
+"""
+
+import threading
+import unittest
+from unittest import mock
+
+import httplib2
+
+from modules import ratelimit
+from modules.ratelimit import QuotaClass, is_throttled, quota_class
+
+class TokenBucketTest( unittest.TestCase ):
+    def test_burst_does_not_wait( self ):
+        quota = QuotaClass( 'metadata', 10, 100 )
+        with mock.patch( 'modules.ratelimit.time.sleep' ) as sleep:
+            for i in range( 10 ):
+                quota.acquire()
+        sleep.assert_not_called()
+        self.assertEqual( quota.requests, 10 )
+
+    def test_waits_for_the_deficit( self ):
+        quota = QuotaClass( 'metadata', 10, 100 )
+        with mock.patch( 'modules.ratelimit.time.sleep' ) as sleep:
+            for i in range( 12 ):
+                quota.acquire()
+        # the eleventh and twelfth tokens refill at 10 per second.
+        delays = [ call.args[0] for call in sleep.call_args_list ]
+        self.assertEqual( len( delays ), 2 )
+        self.assertAlmostEqual( delays[0], 0.1, delta=0.01 )
+        self.assertAlmostEqual( delays[1], 0.2, delta=0.01 )
+
+    def test_batch_takes_a_token_per_request( self ):
+        quota = QuotaClass( 'metadata', 10, 100 )
+        with mock.patch( 'modules.ratelimit.time.sleep' ) as sleep:
+            quota.acquire( 15 )
+        self.assertAlmostEqual( sleep.call_args.args[0], 0.5, delta=0.01 )
+        self.assertEqual( quota.requests, 15 )
+
+    def test_concurrency_limit( self ):
+        quota = QuotaClass( 'download', 1000, 1 )
+        quota.acquire()
+        acquired = threading.Event()
+        def acquire():
+            quota.acquire()
+            acquired.set()
+        thread = threading.Thread( target=acquire, daemon=True )
+        thread.start()
+        self.assertFalse( acquired.wait( 0.1 ))
+        quota.release( False )
+        self.assertTrue( acquired.wait( 5 ))
+        thread.join()
+        self.assertEqual(( quota.in_flight, quota.peak_in_flight ), ( 1, 1 ))
+
+class AdaptTest( unittest.TestCase ):
+    def setUp( self ):
+        self.quota = QuotaClass( 'metadata', 100, 32 )
+
+    def request( self, throttled ):
+        with mock.patch( 'modules.ratelimit.time.sleep' ):
+            self.quota.acquire()
+        self.quota.release( throttled )
+
+    def test_throttle_halves_rate_and_concurrency( self ):
+        self.request( True )
+        self.assertEqual(( self.quota.rate, self.quota.limit ), ( 50, 16 ))
+        self.assertLessEqual( self.quota.tokens, 0 )
+        self.assertEqual( self.quota.throttled, 1 )
+
+    def test_burst_of_throttles_halves_once( self ):
+        for i in range( 5 ):
+            self.request( True )
+        self.assertEqual(( self.quota.rate, self.quota.limit ), ( 50, 16 ))
+        self.assertEqual( self.quota.throttled, 5 )
+
+    def test_throttles_after_the_interval_halve_again( self ):
+        self.request( True )
+        self.quota.last_decrease -= ratelimit.decrease_interval
+        self.request( True )
+        self.assertEqual(( self.quota.rate, self.quota.limit ), ( 25, 8 ))
+
+    def test_minimum( self ):
+        for i in range( 20 ):
+            self.quota.last_decrease = 0.0
+            self.request( True )
+        self.assertEqual(( self.quota.rate, self.quota.limit ), ( 1.0, 1.0 ))
+
+    def test_recovers_quickly_below_the_throttled_rate( self ):
+        self.request( True )
+        self.request( False )
+        self.assertAlmostEqual( self.quota.rate, 50.1 )
+        self.assertAlmostEqual( self.quota.limit, 16.1 )
+
+    def test_increases_slowly_above_the_throttled_rate( self ):
+        self.quota.max_rate = 200
+        self.quota.max_concurrency = 64
+        self.request( False )
+        self.assertAlmostEqual( self.quota.rate, 100 + 1 / 100 )
+        self.assertAlmostEqual( self.quota.limit, 32 + 1 / 32 )
+
+    def test_increase_stops_at_the_maximum( self ):
+        self.request( False )
+        self.assertEqual(( self.quota.rate, self.quota.limit ), ( 100, 32 ))
+
+    def test_failure_without_response_changes_nothing( self ):
+        self.request( None )
+        self.assertEqual(( self.quota.rate, self.quota.limit, self.quota.throttled ), ( 100, 32, 0 ))
+        self.assertEqual( self.quota.in_flight, 0 )
+
+class ResponseTest( unittest.TestCase ):
+    def test_quota_class( self ):
+        self.assertEqual( quota_class( 'https://www.googleapis.com/drive/v3/files?pageSize=1000' ), 'metadata' )
+        self.assertEqual( quota_class( 'https://www.googleapis.com/batch/drive/v3' ), 'metadata' )
+        self.assertEqual( quota_class( 'https://www.googleapis.com/drive/v3/files/1?alt=media' ), 'download' )
+        self.assertEqual( quota_class( 'https://www.googleapis.com/drive/v3/files/1/export?mimeType=application%2Fpdf' ), 'download' )
+        self.assertIsNone( quota_class( 'https://oauth2.googleapis.com/token' ))
+
+    def test_is_throttled( self ):
+        self.assertTrue( is_throttled( httplib2.Response({ 'status': 429 }), b'' ))
+        self.assertTrue( is_throttled( httplib2.Response({ 'status': 403 }), b'{"reason": "userRateLimitExceeded"}' ))
+        self.assertFalse( is_throttled( httplib2.Response({ 'status': 403 }), b'{"reason": "forbidden"}' ))
+        self.assertFalse( is_throttled( httplib2.Response({ 'status': 503 }), b'' ))
+        batch = httplib2.Response({ 'status': 200, 'content-type': 'multipart/mixed; boundary=x' })
+        self.assertTrue( is_throttled( batch, 'HTTP/1.1 403 Forbidden\n{"reason": "rateLimitExceeded"}' ))
+
+if __name__ == '__main__':
+    unittest.main()
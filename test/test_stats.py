@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Copyright (C) 2019  Andres Barreto and Rich Murphey
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+Tests of the counters and timers of a run.
+"""
+
+import json
+import os
+import tempfile
+import unittest
+
+from modules.stats import RunStats, api_method
+
+class RunStatsTest( unittest.TestCase ):
+    def test_phases_and_counters( self ):
+        stats = RunStats()
+        with stats.phase( 'hashing' ):
+            pass
+        @stats.timed( 'hashing' )
+        def hash_file():
+            return 'md5'
+        self.assertEqual( hash_file(), 'md5' )
+        stats.count( 'retries' )
+        stats.count( 'retries', 2 )
+        stats.api_call( 'files.list', 200, 100, 0.5 )
+        stats.api_call( 'files.list', 429, 0, 0.25 )
+        result = stats.as_dict( duration=3 )
+        self.assertEqual( result['phases']['hashing']['count'], 2 )
+        self.assertEqual( result['api_calls'], { 'files.list': { '200': 1, '429': 1 }})
+        self.assertEqual( result['api_seconds'], { 'files.list': 0.75 })
+        self.assertEqual( result['counters'], { 'bytes_received': 100, 'retries': 3 })
+        self.assertEqual( result['duration'], 3 )
+
+    def test_phase_is_timed_when_it_raises( self ):
+        stats = RunStats()
+        with self.assertRaises( ValueError ):
+            with stats.phase( 'download' ):
+                raise ValueError()
+        self.assertEqual( stats.phases['download'][0], 1 )
+
+    def test_take_and_add( self ):
+        worker, parent = RunStats(), RunStats()
+        for stats in ( worker, parent ):
+            with stats.phase( 'hashing' ):
+                pass
+            stats.count( 'retries' )
+            stats.api_call( 'files.get', 200, 10, 0.1 )
+        parent.add( worker.take() )
+        self.assertEqual( worker.as_dict()['counters'], {} )
+        result = parent.as_dict()
+        self.assertEqual( result['phases']['hashing']['count'], 2 )
+        self.assertEqual( result['api_calls'], { 'files.get': { '200': 2 }})
+        self.assertEqual( result['counters'], { 'bytes_received': 20, 'retries': 2 })
+
+    def test_write_json_and_prometheus( self ):
+        stats = RunStats()
+        stats.count( 'retries' )
+        stats.api_call( 'files.list', 200, 5, 0.1 )
+        with tempfile.TemporaryDirectory() as tmp:
+            stats.write_json( os.path.join( tmp, 'stats.json' ), user='u@x.com' )
+            stats.write_prometheus( os.path.join( tmp, 'kumodd.prom' ), { 'user': 'u"x' }, duration_seconds=2.5, user='u' )
+            with open( os.path.join( tmp, 'stats.json' )) as handle:
+                self.assertEqual( json.load( handle )['user'], 'u@x.com' )
+            with open( os.path.join( tmp, 'kumodd.prom' )) as handle:
+                lines = handle.read().splitlines()
+            self.assertEqual( sorted( os.listdir( tmp )), [ 'kumodd.prom', 'stats.json' ])
+        self.assertIn( 'kumodd_api_requests_total{user="u\\"x",method="files.list",status="200"} 1', lines )
+        self.assertIn( 'kumodd_retries_total{user="u\\"x"} 1', lines )
+        self.assertIn( 'kumodd_duration_seconds{user="u\\"x"} 2.5', lines )
+        self.assertFalse( any( line.startswith( 'kumodd_user' ) for line in lines ))
+
+class ApiMethodTest( unittest.TestCase ):
+    def test_api_method( self ):
+        base = 'https://www.googleapis.com/drive/v3/'
+        self.assertEqual( api_method( base + 'files?q=x' ), 'files.list' )
+        self.assertEqual( api_method( base + 'files/1?fields=id' ), 'files.get' )
+        self.assertEqual( api_method( base + 'files/1?alt=media' ), 'files.get_media' )
+        self.assertEqual( api_method( base + 'files/1/export?mimeType=x' ), 'files.export' )
+        self.assertEqual( api_method( base + 'files/1/revisions' ), 'revisions.list' )
+        self.assertEqual( api_method( base + 'files/1/revisions/2' ), 'revisions.get' )
+        self.assertEqual( api_method( base + 'changes/startPageToken' ), 'changes.startPageToken' )
+        self.assertEqual( api_method( base + 'about?fields=user' ), 'about.get' )
+        self.assertEqual( api_method( 'https://www.googleapis.com/batch/drive/v3', 'POST' ), 'batch' )
+        self.assertEqual( api_method( 'https://docs.google.com/feeds/download/export?id=1' ), 'exportLinks' )
+
+if __name__ == '__main__':
+    unittest.main()